@@ -4,5 +4,6 @@ directly from models.
 """
 from .chartdata import PivotDataPool, DataPool # noqa
 from .charts import PivotChart, Chart # noqa
+from .buckets import Bucket # noqa
 
 __version__ = '0.2.9'
@@ -0,0 +1,99 @@
+"""
+    Time buckets of date and datetime fields, computed by the database.
+"""
+
+from django.utils import six
+
+from .exceptions import APIInputError
+
+try:
+    from django.db.models.functions import Trunc
+except ImportError:
+    # Django < 1.10
+    Trunc = None
+
+
+def _kinds():
+    """Returns the kinds of buckets the database functions of the installed
+    Django version can truncate to."""
+    if Trunc is None:
+        return []
+    from django.db.models import functions
+    kinds = ['year', 'month', 'day', 'hour', 'minute', 'second']
+    if hasattr(functions, 'TruncQuarter'):
+        kinds.insert(1, 'quarter')
+    if hasattr(functions, 'TruncWeek'):
+        kinds.insert(-4, 'week')
+    return kinds
+
+
+KINDS = _kinds()
+
+
+class Bucket(object):
+    """Truncates the values of a ``DateField`` or ``DateTimeField`` to the
+    start of their year, quarter, month, week, day, hour, minute or second.
+
+    Can be used as a ``DataPool`` term, usually together with aggregate terms
+    and ``group_by``, and in the ``categories`` of a ``PivotDataPool``. The
+    truncation is done by the database with the ``Trunc`` function, so the
+    rows are bucketed and aggregated in a single grouped query. ::
+
+        DataPool(
+          series=[{
+            'options': {
+              'source': SalesHistory.objects.all(),
+              'group_by': 'month'},
+            'terms': [
+              {'month': Bucket('sale_date', 'month')},
+              {'total_qty': Sum('sale_qty')}]}])
+
+    Requires Django 1.10 or newer. ``'quarter'`` requires Django 2.0 and
+    ``'week'`` Django 2.1.
+    """
+
+    def __init__(self, field, kind, tz=None):
+        """
+        :Arguments:
+
+        - **field** (**required**) - the name of a ``DateField`` or
+          ``DateTimeField``. Lookups of related fields are valid too.
+        - **kind** (**required**) - the size of the buckets, one of
+          ``'year'``, ``'quarter'``, ``'month'``, ``'week'``, ``'day'``,
+          ``'hour'``, ``'minute'`` or ``'second'``.
+        - **tz** (*optional*) - a ``tzinfo`` object or the name of a time
+          zone. Datetimes are truncated in this time zone when ``USE_TZ``
+          is enabled. Defaults to the current time zone.
+
+        :Raises:
+
+        - **APIInputError** - if the arguments are invalid or the installed
+          Django version can't truncate to ``kind``.
+        """
+        if Trunc is None:
+            raise APIInputError("Bucket requires Django 1.10 or newer.")
+        if not isinstance(field, six.string_types):
+            raise APIInputError("'field' must be a field name. Got %s of "
+                                "type %s instead." % (field, type(field)))
+        if kind not in KINDS:
+            raise APIInputError("'kind' must be one of: %s. Got %s instead."
+                                % (', '.join(KINDS), kind))
+        if isinstance(tz, six.string_types):
+            import pytz
+            tz = pytz.timezone(tz)
+        self.field = field
+        self.kind = kind
+        self.tz = tz
+
+    @property
+    def name(self):
+        """The name used when the bucket is one of the ``categories`` of a
+        ``PivotDataPool``, for example ``'sale_date_month'``."""
+        return '%s_%s' % (self.field.replace('__', '_'), self.kind)
+
+    def expression(self):
+        """Returns the ``Trunc`` expression of the bucket."""
+        return Trunc(self.field, self.kind, tzinfo=self.tz)
+
+    def __repr__(self):
+        return 'Bucket(%r, %r)' % (self.field, self.kind)
@@ -0,0 +1,305 @@
+"""
+    Caching of the data retrieved by ``DataPool`` and ``PivotDataPool``.
+"""
+
+import datetime
+import decimal
+import hashlib
+import re
+import time
+import types
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db.models.query import RawQuerySet
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.utils import six
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # Django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+from .utils import _lookup_models
+
+
+def _code_fingerprint(code):
+    """Returns a digest of the bytecode of ``code``, the constants and names
+    it uses and the code of the functions defined in it."""
+    digest = hashlib.sha1(code.co_code)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            # the repr of a code object includes its address
+            const = _code_fingerprint(const)
+        digest.update(repr(const).encode('utf-8'))
+    digest.update(repr(code.co_names).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class _Unstable(Exception):
+    """Raised if a value has no representation which is the same in every
+    process."""
+
+
+# types whose repr doesn't include a memory address
+_STABLE_TYPES = (type(None), bool, float, decimal.Decimal, datetime.date,
+                 datetime.time, datetime.timedelta, type, types.ModuleType) \
+    + six.integer_types + six.string_types + (six.binary_type,)
+
+
+def _stable_repr(value, seen=()):
+    """Returns the repr of a primitive value, of a tuple or a frozenset of
+    such values or the fingerprint of a function.
+
+    :Raises:
+
+    - **_Unstable** - for all other values.
+    """
+    if isinstance(value, _STABLE_TYPES):
+        return repr(value)
+    if isinstance(value, tuple):
+        return '(%s)' % ', '.join(_stable_repr(v, seen) for v in value)
+    if isinstance(value, frozenset):
+        return 'frozenset(%s)' % sorted(_stable_repr(v, seen) for v in value)
+    if isinstance(value, types.FunctionType):
+        if value in seen:
+            # a recursive function closes over itself
+            return value.__name__
+        return repr(_fn_fingerprint(value, seen + (value,)))
+    raise _Unstable(value)
+
+
+def _fn_fingerprint(fn, seen=()):
+    """Identifies a term's ``fn`` by where it is defined, by its code, by
+    its default arguments and by the values of the variables it closes
+    over (or the object a method is bound to).
+
+    :Raises:
+
+    - **_Unstable** - if any of these values doesn't have a stable repr.
+    """
+    name = getattr(fn, '__qualname__', getattr(fn, '__name__', None))
+    if name is None:
+        # e.g. a functools.partial or a callable object
+        raise _Unstable(fn)
+    code = getattr(fn, '__code__', None)
+    closure = getattr(fn, '__closure__', None) or ()
+    kwdefaults = getattr(fn, '__kwdefaults__', None) or {}
+    return (getattr(fn, '__module__', None), name,
+            _code_fingerprint(code) if code is not None else None,
+            _stable_repr(getattr(fn, '__defaults__', None), seen),
+            _stable_repr(tuple(sorted(kwdefaults.items())), seen),
+            tuple(_stable_repr(cell.cell_contents, seen)
+                  for cell in closure),
+            _stable_repr(getattr(fn, '__self__', None), seen))
+
+
+def _lookup_terms(td):
+    """Returns the field lookups used by a ``DataPool`` or a
+    ``PivotDataPool`` term."""
+    lookups = (list(td.get('categories', ())) + list(td.get('legend_by', ())) +
+               list(td.get('group_by', ())))
+    if td.get('field'):
+        lookups.append(td['field'])
+    return lookups
+
+
+def _model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+def dependencies(tk_td_tuples, vqs):
+    """Returns the set of models whose rows the data of a query group is
+    retrieved from. These are the models of all tables joined by the query
+    and the models reached through the ``__`` lookups of the terms (which
+    covers model properties). For a ``RawQuerySet`` these are the models
+    whose table names appear in the SQL query."""
+    models_by_table = dict((m._meta.db_table, m) for m in
+                           apps.get_models(include_auto_created=True))
+    models = set([vqs.model])
+    if isinstance(vqs, RawQuerySet):
+        sql = vqs.raw_query.lower()
+        models.update(m for (table, m) in models_by_table.items()
+                      if re.search(r'\b%s\b' % re.escape(table.lower()), sql))
+    else:
+        models.update(models_by_table[join.table_name] for join in
+                      vqs.query.alias_map.values()
+                      if join.table_name in models_by_table)
+    for (_, td) in tk_td_tuples:
+        for lookup in _lookup_terms(td):
+            models.update(_lookup_models(vqs.model, lookup))
+    return models
+
+
+# (cache alias, key prefix) of every ChartDataCache created by this process
+_constructed = set()
+# whether the model signals are received
+_connected = False
+
+
+def _data_caches():
+    """Returns the ``(cache alias, key prefix)`` tuples of all caches which
+    may hold chart data, i.e. the ones in the ``CHARTIT_CACHES`` setting and
+    the ones of every ``ChartDataCache`` created by this process."""
+    configured = getattr(settings, 'CHARTIT_CACHES', None) or []
+    return set(tuple(c) for c in configured) | _constructed
+
+
+def _invalidate(sender, **kwargs):
+    """Receiver of the model signals which bumps the data version of the
+    model in every cache that may hold data depending on it. The version
+    is only bumped if it exists, otherwise nothing was cached for the
+    model."""
+    if kwargs.get('raw'):
+        # loading fixtures
+        return
+    if kwargs.get('action', 'post_').startswith('post_'):
+        for alias, key_prefix in _data_caches():
+            ChartDataCache(alias, key_prefix=key_prefix).bump_version(
+                sender, create=False)
+
+
+def _connect():
+    """Connects the receivers of the model signals. Only projects which
+    cache chart data pay for a cache round trip on every write."""
+    global _connected
+    if _connected:
+        return
+    _connected = True
+    post_save.connect(_invalidate, dispatch_uid='chartit_post_save')
+    post_delete.connect(_invalidate, dispatch_uid='chartit_post_delete')
+    m2m_changed.connect(_invalidate, dispatch_uid='chartit_m2m_changed')
+
+
+if settings.configured and getattr(settings, 'CHARTIT_CACHES', None):
+    _connect()
+
+
+class ChartDataCache(object):
+    """Stores the data of every query group of a ``DataPool`` or a
+    ``PivotDataPool`` in one of the configured Django caches.
+
+    The cache key is a fingerprint of the SQL query, its parameters, the
+    database alias and the fields and ``fn`` functions of the terms, so
+    identical query groups share the cached data even across different
+    ``DataPool`` objects.
+
+    The key also includes a version number of every model the query group
+    depends on. Versions are bumped on ``post_save``, ``post_delete`` and
+    ``m2m_changed``, which invalidates exactly the cached data that was
+    retrieved from the changed tables. Changes which don't send signals,
+    like ``QuerySet.update()`` or raw SQL, need ``bump_version()`` to be
+    called explicitly.
+
+    The versions are bumped in every cache listed in the ``CHARTIT_CACHES``
+    setting, a list of ``(cache alias, key prefix)`` tuples, and in the
+    cache of every ``ChartDataCache`` created by the process. The signals
+    are only received once either exists. Processes which only write the
+    data, like other web workers, task queues or the admin, rely on the
+    setting, so list every cache used for chart data in it (e.g.
+    ``[('default', 'chartit')]``) and add ``chartit`` to the
+    ``INSTALLED_APPS``.
+    """
+
+    def __init__(self, alias='default', timeout=DEFAULT_TIMEOUT,
+                 key_prefix='chartit'):
+        """
+        :Arguments:
+
+        - **alias** (*optional*) - the name of the cache in the ``CACHES``
+          setting. Defaults to ``'default'``.
+        - **timeout** (*optional*) - the number of seconds the data is
+          cached for. Defaults to the timeout of the cache.
+        - **key_prefix** (*optional*) - a prefix for all cache keys.
+        """
+        self.alias = alias
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+        _constructed.add((alias, key_prefix))
+        _connect()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _version_key(self, model):
+        return '%s:version:%s' % (self.key_prefix, _model_label(model))
+
+    def bump_version(self, model, create=True):
+        """Invalidates all cached data which depends on ``model``. If
+        ``create`` is ``False``, a missing version is left missing."""
+        key = self._version_key(model)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # the version is missing (or was evicted), start a new one
+            if create:
+                self.cache.add(key, int(time.time() * 1000), None)
+
+    def versions(self, models):
+        """Returns a sorted list of ``(model label, version)`` tuples."""
+        keys = dict((self._version_key(m), m) for m in models)
+        versions = self.cache.get_many(list(keys))
+        for key in set(keys) - set(versions):
+            # the current time never repeats a version after eviction
+            self.cache.add(key, int(time.time() * 1000), None)
+            versions[key] = self.cache.get(key)
+        return sorted((_model_label(keys[k]), v) for (k, v) in
+                      versions.items())
+
+    def data_version(self, pool):
+        """Returns a string which changes whenever the data of ``pool``
+        changes. Useful as a part of the key when caching rendered charts,
+        for example with the ``{% cache %}`` template tag.
+        """
+        models = set()
+        for tk_td_tuples, vqs in pool._generate_vqs():
+            models.update(dependencies(tk_td_tuples, vqs))
+        return hashlib.sha1(repr(self.versions(models))
+                            .encode('utf-8')).hexdigest()
+
+    def fingerprint(self, pool, tk_td_tuples, vqs):
+        """Returns the parts which identify the data of a query group.
+
+        :Raises:
+
+        - **EmptyResultSet** - if the query can't return any rows.
+        - **_Unstable** - if the ``fn`` of a term depends on values which
+          are different in every process, like objects identified by
+          their memory address.
+        """
+        if isinstance(vqs, RawQuerySet):
+            sql, params = vqs.raw_query, vqs.params
+        else:
+            sql, params = vqs.query.sql_with_params()
+        terms = sorted(repr((td.get('field'), _fn_fingerprint(td['fn'])
+                             if td.get('fn') else None))
+                       for (_, td) in tk_td_tuples)
+        models = dependencies(tk_td_tuples, vqs)
+        return (pool.__class__.__name__, pool.columnar, vqs.db,
+                sql, repr(params), terms, self.versions(models))
+
+    def make_key(self, pool, tk_td_tuples, vqs):
+        digest = hashlib.sha1(repr(self.fingerprint(pool, tk_td_tuples,
+                                                    vqs)).encode('utf-8'))
+        return '%s:%s' % (self.key_prefix, digest.hexdigest())
+
+    def get_or_fetch(self, pool, tk_td_tuples, vqs, fetch):
+        """Returns the cached data of the query group or calls ``fetch()``
+        and caches its result."""
+        try:
+            key = self.make_key(pool, tk_td_tuples, vqs)
+        except EmptyResultSet:
+            # nothing to query, nothing to cache
+            return fetch()
+        except _Unstable:
+            # the key would never be the same again
+            return fetch()
+        data = self.cache.get(key)
+        if data is None:
+            data = fetch()
+            self.cache.set(key, data, self.timeout)
+        return data
@@ -1,12 +1,31 @@
+import inspect
 import sys
 import warnings
+from array import array
 from collections import defaultdict, OrderedDict
+from multiprocessing.pool import ThreadPool
+from django.db import connections
 from django.db.models.query import RawQuerySet
 from django.core.exceptions import FieldError
-from itertools import groupby, chain, islice
+from django.db.models import F, IntegerField, Max, Q, Value
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.utils.six.moves import zip
+from heapq import nlargest, nsmallest
+from itertools import groupby, chain
 from operator import itemgetter
-from .utils import _getattr
-from .validation import clean_dps, clean_pdps, clean_sortf_mapf_mts
+from .exceptions import APIInputError
+from .utils import _getattr, _select_related, _then
+from .validation import clean_dps, clean_pdps, clean_sortf_mapf_mts, \
+    clean_columnar_chunk_size, clean_max_workers, clean_cache, \
+    clean_incremental_on, clean_dense
+from .matrix import PivotMatrix
+
+try:
+    from django.db.models import Window
+    from django.db.models.functions import DenseRank
+except ImportError:
+    # Django < 2.0
+    Window = None
 
 
 # in Python 3 the standard str type is unicode and the
@@ -14,11 +33,239 @@ from .validation import clean_dps, clean_pdps, clean_sortf_mapf_mts
 if sys.version_info.major >= 3:
     unicode = str
 
+# typecodes used to store homogeneous integer and float columns
+if sys.version_info.major >= 3:
+    _ARRAY_TYPECODES = {int: 'q', float: 'd'}
+else:
+    _ARRAY_TYPECODES = {int: 'l', long: 'l', float: 'd'}  # noqa: F821
+
+
+def _compact_column(column):
+    """Converts a list of values into an ``array`` if all of them are
+    integers or all of them are floats. Otherwise the list is returned
+    unchanged."""
+    types = set(map(type, column))
+    if len(types) == 1:
+        typecode = _ARRAY_TYPECODES.get(types.pop())
+        if typecode is not None:
+            try:
+                return array(typecode, column)
+            except OverflowError:
+                pass
+    return column
+
+
+class ColumnData(object):
+    """Holds the data of a single query group as one column (a ``list`` or
+    an ``array``) per field. Used by ``DataPool`` in columnar mode."""
+
+    def __init__(self, columns):
+        self.columns = OrderedDict(columns)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __setitem__(self, field, column):
+        self.columns[field] = column
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def extend(self, other):
+        """Appends the rows of another ``ColumnData`` with the same
+        fields."""
+        for field, column in other.columns.items():
+            stored = self.columns[field]
+            length = len(stored)
+            try:
+                stored.extend(column)
+            except (TypeError, OverflowError):
+                # for example floats appended to an array of integers
+                self.columns[field] = _compact_column(list(stored[:length]) +
+                                                      list(column))
+
+
+# annotation of the value of the incremental_on field of every row
+_MARK = '_chartit_mark'
+
+
+def _mark_positions(data, mark):
+    """Returns the positions of the rows of ``data`` whose
+    ``incremental_on`` field is ``mark``."""
+    if isinstance(data, ColumnData):
+        values = data[_MARK]
+    else:
+        values = (_getattr(row, _MARK) for row in data)
+    return [i for (i, value) in enumerate(values) if value == mark]
+
+
+def _take_rows(data, positions):
+    """Returns the rows of ``data`` at ``positions``, as a list of dicts
+    (or model instances) or as a ``dict`` of columns."""
+    if isinstance(data, ColumnData):
+        return dict((field, [column[i] for i in positions])
+                    for (field, column) in data.columns.items())
+    return [data[i] for i in positions]
+
+
+def _delete_rows(data, positions):
+    """Deletes the rows of ``data`` at the sorted ``positions``."""
+    columns = data.columns.values() if isinstance(data, ColumnData) \
+        else [data]
+    for column in columns:
+        for i in reversed(positions):
+            del column[i]
+
+
+def _apply_fns(tk_td_tuples, rows):
+    """Applies the ``fn`` of the terms, if any, to every row."""
+    fns = [(td['field'], td['fn']) for (_, td) in tk_td_tuples
+           if td.get('fn')]
+    for row in rows:
+        for field, fn in fns:
+            row[field] = fn(_getattr(row, field))
+        yield row
+
+
+def _is_column(model, field):
+    """Whether the value of ``field`` can be read from a column of a raw
+    query, as opposed to model properties and related objects which need
+    model instances."""
+    if '__' in field:
+        return False
+    for f in model._meta.concrete_fields:
+        if field in (f.name, f.attname):
+            return field == f.attname or not f.is_relation
+    # annotated columns of the raw query aren't model attributes
+    return not hasattr(model, field)
+
+
+def _raw_rows(vqs, fields, chunk_size=GET_ITERATOR_CHUNK_SIZE):
+    """Executes the ``RawQuerySet`` ``vqs`` and returns an iterator over
+    tuples of the values of ``fields``, read straight from the cursor with
+    ``fetchmany()`` instead of building model instances. Returns ``None`` if
+    any of the ``fields`` isn't a column of the query."""
+    if not all(_is_column(vqs.model, f) for f in fields):
+        return None
+    connection = connections[vqs.db]
+    query = vqs.query.clone(using=vqs.db)
+    # executes the query
+    columns = [vqs.translations.get(c, c) for c in query.get_columns()]
+    if not all(f in columns for f in fields):
+        # e.g. deferred model fields, which are loaded per instance
+        query.cursor.close()
+        return None
+    positions = [columns.index(f) for f in fields]
+    model_fields = [vqs.model_fields.get(columns[p]) for p in positions]
+    compiler = connection.ops.compiler('SQLCompiler')(query, connection,
+                                                      vqs.db)
+    # the same conversions as for model instances, e.g. Decimal and dates
+    converters = compiler.get_converters([
+        f.get_col(f.model._meta.db_table) if f else None
+        for f in model_fields])
+    return _fetch_rows(query.cursor, positions, compiler, converters,
+                       chunk_size)
+
+
+def _convert_rows(compiler, rows, converters):
+    """Applies the database ``converters`` of ``compiler`` to a list of
+    rows read from a cursor."""
+    if converters and inspect.isgeneratorfunction(compiler.apply_converters):
+        # Django >= 2.0 converts all rows at once
+        return compiler.apply_converters(rows, converters)
+    elif converters:
+        return [compiler.apply_converters(row, converters) for row in rows]
+    return rows
+
+
+def _fetch_rows(cursor, positions, compiler, converters, chunk_size):
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            rows = [tuple(row[p] for p in positions) for row in rows]
+            for row in _convert_rows(compiler, rows, converters):
+                yield row
+    finally:
+        cursor.close()
+
+
+def _raw_dicts(tk_td_tuples, vqs, chunk_size=GET_ITERATOR_CHUNK_SIZE):
+    """Returns an iterator over the rows of the ``RawQuerySet`` ``vqs`` as
+    dicts, or ``None`` if model instances are needed."""
+    fields = [td['field'] for (_, td) in tk_td_tuples]
+    rows = _raw_rows(vqs, fields, chunk_size)
+    if rows is None:
+        return None
+    return (dict(zip(fields, row)) for row in rows)
+
+
+class StreamedData(object):
+    """The data of a single query group when ``DataPool`` is in streaming
+    mode. The query is executed every time this object is iterated over and
+    the rows are fetched in chunks of ``chunk_size``, so they are never all
+    held in memory at the same time."""
+
+    def __init__(self, tk_td_tuples, vqs, chunk_size):
+        self.tk_td_tuples = tk_td_tuples
+        self.vqs = vqs
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        if isinstance(self.vqs, RawQuerySet):
+            rows = _raw_dicts(self.tk_td_tuples, self.vqs, self.chunk_size)
+            if rows is not None:
+                return _apply_fns(self.tk_td_tuples, rows)
+        try:
+            rows = self.vqs.iterator(chunk_size=self.chunk_size)
+        except TypeError:
+            # chunk_size is new in Django 2.0 and isn't supported by
+            # RawQuerySet, fall back to the default chunk size
+            rows = self.vqs.iterator()
+        return _apply_fns(self.tk_td_tuples, rows)
+
+    def count(self):
+        """Counts the rows with a ``COUNT()`` query."""
+        return self.vqs.count()
+
+    def order_by(self, *fields):
+        """Returns a copy whose rows are ordered by ``fields`` in the
+        database."""
+        return StreamedData(self.tk_td_tuples, self.vqs.order_by(*fields),
+                            self.chunk_size)
+
+
+class _LazyTermDict(dict):
+    """A term dict which retrieves the data of its ``DataPool`` the first
+    time the ``_data`` key is accessed."""
+
+    def __init__(self, pool, term, *args, **kwargs):
+        super(_LazyTermDict, self).__init__(*args, **kwargs)
+        self._pool = pool
+        self._term = term
+
+    def __missing__(self, key):
+        if key == '_data' and self._pool is not None:
+            self._pool._load_terms([self._term])
+            return self[key]
+        raise KeyError(key)
+
 
 class DataPool(object):
     """DataPool holds the data retrieved from various models (tables)."""
 
-    def __init__(self, series):
+    columnar = False
+    chunk_size = None
+    max_workers = 1
+    cache = None
+    incremental_on = None
+    used_terms = None
+
+    def __init__(self, series, lazy=False, columnar=False, chunk_size=None,
+                 max_workers=None, cache=None, incremental_on=None):
         """Create a DataPool object as specified by the ``series``.
 
         :Arguments:
@@ -28,10 +275,12 @@ class DataPool(object):
 
             [{'options': {
                'source': a django model, Manager or QuerySet,
+               'group_by': ['a_valid_field_name', ...] (optional),
                },
              'terms': [
                'a_valid_field_name', ... ,
                {'any_name': 'a_valid_field_name', ... },
+               {'any_name': django Aggregate, ... },
                ]
             },
             ...
@@ -48,14 +297,83 @@ class DataPool(object):
             1. a ``str`` - needs to be a valid model field for the
                corresponding ``source``, or
             2. a ``dict`` - need to be of the form
-               ``{'any_name': 'a_valid_field_name', ...}``.
+               ``{'any_name': 'a_valid_field_name', ...}``, or
+            3. a ``dict`` of the form ``{'any_name': django Aggregate}``,
+               for example ``{'total_qty': Sum('sale_qty')}``. The
+               aggregates are computed by the database, grouped by the
+               fields listed in ``group_by``, so only a single row per
+               group is retrieved. ``group_by`` is required for aggregates
+               and all other terms of the series must be ``group_by``
+               fields. For example, the daily total of sales is retrieved
+               with ::
+
+                 [{'options': {
+                     'source': SalesHistory.objects.all(),
+                     'group_by': 'sale_date'},
+                   'terms': [
+                     'sale_date',
+                     {'total_qty': Sum('sale_qty')}]}]
 
           To retrieve data from multiple models or QuerySets, just add more
           dictionaries with the corresponding ``options`` and terms.
 
+        - **lazy** (*optional*) - a ``bool``. If ``True`` the ``series`` are
+          validated right away but no queries are executed until the data
+          of a term is accessed for the first time, for example when a
+          ``Chart`` is created from this ``DataPool``. Defaults to ``False``.
+
+        - **columnar** (*optional*) - a ``bool``. If ``True`` the rows are
+          retrieved as tuples and stored as one column per field instead of
+          one ``dict`` per row. Integer and float columns are stored as an
+          ``array`` which needs a lot less memory for large data sets. The
+          ``_data`` of the terms is then a ``ColumnData`` object.
+          Defaults to ``False``.
+
+        - **chunk_size** (*optional*) - an ``int``. If specified the data is
+          not stored in the ``DataPool``. Instead the rows are streamed
+          straight into the chart, ``chunk_size`` rows at a time (using
+          server-side cursors where the database supports them). The rows
+          are ordered by the x-axis term in the database and downsampled
+          with min/max buckets, sized with a ``COUNT()`` query, while they
+          are retrieved, so every series of the chart needs
+          ``max_points``. The ``_data`` of the terms is then a
+          ``StreamedData`` object and every iteration over it executes the
+          query again. Can't be combined with ``columnar``.
+
+        - **max_workers** (*optional*) - an ``int``. The maximum number of
+          threads used to execute the queries. Terms from different sources
+          are retrieved with different queries. If this is greater than 1
+          these queries are executed concurrently, each thread using its own
+          database connection. Defaults to ``1``, i.e. the queries are
+          executed one after another.
+
+        - **cache** (*optional*) - either ``True`` or a
+          ``chartit.cache.ChartDataCache`` object. If specified the data of
+          every query is stored in (and retrieved from) a Django cache. The
+          cache key is derived from the SQL query, its parameters and the
+          terms, so identical queries from different ``DataPool`` objects
+          share the cached data. Queries with a term ``fn`` which closes
+          over (or is bound to) objects other than numbers, strings, dates,
+          tuples, frozensets and functions aren't cached, as these objects
+          are different in every process. ``True`` uses the ``'default'``
+          cache with its default timeout. Not used together with
+          ``chunk_size``.
+
+        - **incremental_on** (*optional*) - the name of a field whose values
+          never decrease as rows are added, like an auto-incremented id or
+          the date of an append-only table. The maximum value retrieved
+          (the high-water mark) is remembered for every query and
+          ``refresh()`` then only retrieves the rows at or beyond it. The
+          rows at the high-water mark replace the ones retrieved before,
+          since rows with the same value may have been added, and the
+          others are appended to the data. Every row also holds its value
+          of the field as ``_chartit_mark``. With ``group_by``, the field
+          must be one of the ``group_by`` fields. Can't be used with
+          ``chunk_size``, ``RawQuerySet`` sources or sliced QuerySets.
+
         :Raises:
 
-        - **APIInputError** - sif the ``series`` argument has any invalid
+        - **APIInputError** - if the ``series`` argument has any invalid
           parameters.
 
 
@@ -93,9 +411,27 @@ class DataPool(object):
               {'foo_2': 'foo'}]}]
          """
         self.series = clean_dps(series)
-        self.query_groups = self._group_terms_by_query()
-        # Now get data
-        self._get_data()
+        self.columnar, self.chunk_size = clean_columnar_chunk_size(columnar,
+                                                                   chunk_size)
+        self.max_workers = clean_max_workers(max_workers)
+        self.cache = clean_cache(cache)
+        self.incremental_on = clean_incremental_on(incremental_on,
+                                                   self.series,
+                                                   self.chunk_size)
+        # high-water mark of every query group, by its first term
+        self.high_water_marks = {}
+        self._pending_marks = {}
+        # positions of the rows at the high-water mark, by the first term
+        self._boundary_rows = {}
+        # whether the last refresh() replaced rows at a high-water mark
+        self.boundary_replaced = False
+        if lazy:
+            # _data is retrieved on first access, see _LazyTermDict
+            for tk, td in self.series.items():
+                self.series[tk] = _LazyTermDict(self, tk, td)
+        self.query_groups = self._group_terms_by_query(None, 'group_by')
+        if not lazy:
+            self._get_data()
 
     def _group_terms_by_query(self, sort_by_term=None, *addl_grp_terms):
         """Groups all the terms that can be extracted in a single query. This
@@ -112,7 +448,8 @@ class DataPool(object):
         # if there is a better way. - PG
         def sort_grp_fn(td_tk):
             return tuple(chain(str(td_tk[1]['source'].query),
-                               [list(td_tk[1][t]) for t in addl_grp_terms]))
+                               [list(td_tk[1].get(t) or ())
+                                for t in addl_grp_terms]))
 
         def sort_by_term_fn(td_tk):
             return -1 * (abs(td_tk[1][sort_by_term]))
@@ -129,43 +466,592 @@ class DataPool(object):
         qg = [sorted(itr, key=sort_by_fn) for (grp, itr) in qg]
         return qg
 
+    def use_terms(self, *terms):
+        """Retrieves only the data of ``terms``, and of the terms which were
+        already retrieved, from now on. Useful with ``lazy=True``, so that
+        the columns which are never plotted are not selected. ``Chart``
+        calls this with the terms it plots. When the same ``DataPool`` is
+        used by multiple charts, call it with the terms of all charts before
+        the first chart is created. The data of other terms is still
+        retrieved, with another query, when it is accessed.
+
+        :Raises:
+
+        - **APIInputError** - if any of the ``terms`` are not in the
+          ``series`` of this ``DataPool``.
+        """
+        for term in terms:
+            if term not in self.series:
+                raise APIInputError("%s is not one of the terms of the "
+                                    "DataPool. Allowed values are: %s"
+                                    % (term, ', '.join(self.series)))
+        if self.used_terms is None:
+            self.used_terms = set()
+        self.used_terms.update(terms)
+
+    def _same_query_group(self, tk, other_tk):
+        """Whether the data of both terms is retrieved by the same query."""
+        for tk_td_tuples in self.query_groups:
+            tks = [t for (t, _) in tk_td_tuples]
+            if tk in tks:
+                return other_tk in tks
+        return False
+
+    def _projection(self, tk_td_tuples):
+        """Returns the ``(tk, td)`` tuples of a query group whose data needs to
+        be retrieved."""
+        if self.used_terms is None:
+            return tk_td_tuples
+        return [(tk, td) for (tk, td) in tk_td_tuples
+                if tk in self.used_terms or '_data' in td]
+
+    def _fields(self, tk_td_tuples):
+        """Returns the fields selected by the query of a query group."""
+        fields = [td['field'] for (_, td) in tk_td_tuples]
+        if self.incremental_on:
+            fields.append(_MARK)
+        return fields
+
     def _generate_vqs(self):
         # query_groups is a list of lists.
         for tk_td_tuples in self.query_groups:
+            tk_td_tuples = self._projection(tk_td_tuples)
+            if not tk_td_tuples:
+                continue
             src = tk_td_tuples[0][1]['source']
+            fields = self._fields(tk_td_tuples)
+            group_by = tk_td_tuples[0][1].get('group_by')
+            if group_by:
+                # the database returns a single row per group, with the
+                # aggregates annotated by the names of their terms
+                ann_terms = OrderedDict((td['field'], td['func']) for
+                                        (tk, td) in tk_td_tuples
+                                        if 'func' in td)
+                src = src.values(*group_by).annotate(**ann_terms)
+                # b/c Meta.ordering would be added to GROUP BY
+                src = src.order_by(*group_by)
+            if self.incremental_on:
+                src = src.annotate(**{_MARK: F(self.incremental_on)})
             try:
                 # RawQuerySet doesn't support values
                 if isinstance(src, RawQuerySet):
                     vqs = src
+                elif self.columnar:
+                    vqs = src.values_list(*fields)
                 else:
-                    vqs = src.values(*(td['field']
-                                       for (tk, td) in tk_td_tuples))
+                    vqs = src.values(*fields)
             except FieldError:
-                # model attributes can't be resolved into fields
-                vqs = src
-            vqs2 = []
-            for v in vqs:
-                for (_, td) in tk_td_tuples:
-                    f = td.get('fn')
-                    if f:
-                        v[td['field']] = f(_getattr(v, td['field']))
-                vqs2.append(v)
-            yield tk_td_tuples, vqs2
+                # model attributes can't be resolved into fields, follow the
+                # relations in a few queries instead of a few per instance
+                vqs = _select_related(src, fields)
+            yield tk_td_tuples, vqs
+
+    def _get_rows(self, tk_td_tuples, vqs):
+        """Returns the data of a query group as a list of dicts (or model
+        instances), one per row."""
+        rows = None
+        if isinstance(vqs, RawQuerySet):
+            rows = _raw_dicts(tk_td_tuples, vqs)
+        return list(_apply_fns(tk_td_tuples, vqs if rows is None else rows))
+
+    def _get_columns(self, tk_td_tuples, vqs):
+        """Returns the data of a query group as a ``ColumnData`` object."""
+        fields = self._fields(tk_td_tuples)
+        rows = None
+        if isinstance(vqs, RawQuerySet):
+            rows = _raw_rows(vqs, fields)
+        if rows is None:
+            # the rows aren't kept in the result cache of vqs, only in the
+            # columns. prefetch_related() is ignored by iterator() though
+            objs = vqs if getattr(vqs, '_prefetch_related_lookups', None) \
+                else vqs.iterator()
+            if getattr(vqs, '_fields', None) is None:
+                # model instances, from a RawQuerySet or b/c of model
+                # properties
+                rows = ([_getattr(obj, f) for f in fields] for obj in objs)
+            else:
+                rows = objs
+        columns = [[] for _ in fields]
+        appends = [column.append for column in columns]
+        for row in rows:
+            for append, value in zip(appends, row):
+                append(value)
+        data = ColumnData(zip(fields, columns))
+        for (_, td) in tk_td_tuples:
+            f = td.get('fn')
+            if f:
+                data[td['field']] = [f(v) for v in data[td['field']]]
+        for field, column in list(data.columns.items()):
+            data[field] = _compact_column(column)
+        return data
+
+    def _fetch(self, tk_td_tuples, vqs):
+        """Returns the data of a single query group."""
+        if self.chunk_size:
+            return StreamedData(tk_td_tuples, vqs, self.chunk_size)
+        elif self.columnar:
+            return self._get_columns(tk_td_tuples, vqs)
+        return self._get_rows(tk_td_tuples, vqs)
+
+    def _beyond_high_water_mark(self, tk_td_tuples, vqs):
+        """Limits ``vqs`` to the rows added since the data of the query group
+        was last retrieved.
+
+        :returns:
+
+        - a tuple with the limited queryset and its high-water mark.
+        """
+        field = self.incremental_on
+        low = self.high_water_marks.get(tk_td_tuples[0][0])
+        # the rows up to the high-water mark are retrieved in another query,
+        # rows added in between are left for the next refresh
+        high = vqs.aggregate(Max(field))[field + '__max']
+        if high is None or (low is not None and high < low):
+            return vqs.none(), low
+        lookups = {field + '__lte': high}
+        if low is not None:
+            # rows with the value of the mark may have been added since
+            lookups[field + '__gte'] = low
+        return vqs.filter(**lookups), high
+
+    def _fetch_group(self, tk_td_tuples, vqs):
+        """Returns the data of a single query group, from the cache if there
+        is one."""
+        if self.incremental_on:
+            vqs, self._pending_marks[tk_td_tuples[0][0]] = \
+                self._beyond_high_water_mark(tk_td_tuples, vqs)
+        if self.cache is None or self.chunk_size:
+            return self._fetch(tk_td_tuples, vqs)
+        return self.cache.get_or_fetch(
+            self, tk_td_tuples, vqs,
+            lambda: self._fetch(tk_td_tuples, vqs))
+
+    def _fetch_in_thread(self, tk_td_tuples_vqs):
+        tk_td_tuples, vqs = tk_td_tuples_vqs
+        try:
+            return self._fetch_group(tk_td_tuples, vqs)
+        finally:
+            # every thread opens its own connection, don't leak it. Django
+            # doesn't close connections to in-memory SQLite databases, which
+            # the garbage collector would then close at any time, even in
+            # the middle of a query on another connection to the database
+            connection = connections[vqs.db]
+            connection.close()
+            if connection.connection is not None:
+                connection.connection.close()
+                connection.connection = None
+
+    def _vqs_to_fetch(self, missing_only=False):
+        """Returns the ``(tk_td_tuples, vqs)`` tuples of all query groups or
+        only of those with terms whose data hasn't been retrieved yet."""
+        return [(tk_td_tuples, vqs) for (tk_td_tuples, vqs)
+                in self._generate_vqs()
+                if not missing_only or
+                any('_data' not in td for (_, td) in tk_td_tuples)]
+
+    def _fetch_all(self, missing_only=False):
+        """Returns a list of ``(tk_td_tuples, data)`` tuples, one for each
+        query group. If ``max_workers`` allows it, the queries are executed
+        concurrently on a thread pool."""
+        all_vqs = self._vqs_to_fetch(missing_only)
+        workers = min(self.max_workers, len(all_vqs))
+        if workers > 1 and not self.chunk_size:
+            pool = ThreadPool(workers)
+            try:
+                all_data = pool.map(self._fetch_in_thread, all_vqs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            all_data = [self._fetch_group(tk_td_tuples, vqs)
+                        for (tk_td_tuples, vqs) in all_vqs]
+        return [(tk_td_tuples, data) for ((tk_td_tuples, _), data)
+                in zip(all_vqs, all_data)]
+
+    def aload(self, executor=None):
+        """Retrieves the data without blocking the running ``asyncio`` event
+        loop. Meant to be used with ``lazy=True`` in asynchronous views ::
+
+            ds = DataPool(series=[...], lazy=True)
+            await ds.aload()
+
+        The queries are executed concurrently in ``executor`` (the default
+        executor of the event loop if ``None``) because the Django ORM is
+        synchronous.
+
+        :returns:
+
+        - an awaitable which resolves to this object once all data is
+          loaded.
+        """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        all_vqs = self._vqs_to_fetch(missing_only=True)
+        fetches = asyncio.gather(*[
+            loop.run_in_executor(executor, self._fetch_in_thread,
+                                 tk_td_tuples_vqs)
+            for tk_td_tuples_vqs in all_vqs])
+
+        def _loaded(all_data):
+            self._set_data([(tk_td_tuples, data) for ((tk_td_tuples, _), data)
+                            in zip(all_vqs, all_data)])
+            return self
+        return _then(fetches, _loaded)
 
     def _get_data(self):
-        for tk_td_tuples, vqs in self._generate_vqs():
-            vqs_list = list(vqs)
+        self._set_data(self._fetch_all(missing_only=True))
+
+    def _load_terms(self, terms):
+        """Retrieves the data of the lazy ``terms`` which wasn't retrieved
+        yet, together with the other terms of their query groups."""
+        if self.used_terms is not None:
+            self.used_terms.update(terms)
+        if any('_data' not in self.series[tk] for tk in terms):
+            self._get_data()
+
+    def _update_high_water_marks(self, fetched):
+        # only after all data was retrieved successfully
+        if self.incremental_on:
+            for tk_td_tuples, data in fetched:
+                tk = tk_td_tuples[0][0]
+                self._boundary_rows[tk] = _mark_positions(
+                    data, self._pending_marks.get(tk))
+        self.high_water_marks.update(self._pending_marks)
+        self._pending_marks = {}
+
+    def _append_beyond_mark(self, tk, data):
+        """Appends the rows of ``data``, retrieved at or beyond the
+        high-water mark of the query group of ``tk``, to its stored data.
+        The rows at the mark replace the stored ones if they differ.
+
+        :returns:
+
+        - ``True`` if the stored rows at the mark were replaced.
+        """
+        stored = self.series[tk]['_data']
+        low = self.high_water_marks.get(tk)
+        high = self._pending_marks.get(tk)
+        positions = self._boundary_rows.get(tk, [])
+        refetched = _mark_positions(data, low)
+        replaced = (_take_rows(stored, positions) !=
+                    _take_rows(data, refetched))
+        if replaced:
+            _delete_rows(stored, positions)
+        else:
+            # only the rows beyond the mark are new
+            _delete_rows(data, refetched)
+        length = len(stored)
+        stored.extend(data)
+        if high != low or replaced:
+            positions = [length + i for i in _mark_positions(data, high)]
+        self._boundary_rows[tk] = positions
+        return replaced
+
+    def refresh(self):
+        """Retrieves the data again. If the ``DataPool`` is
+        ``incremental_on`` a field and its data was already retrieved, only
+        the rows at or beyond the high-water marks are retrieved. The rows
+        at a high-water mark replace the stored ones if they changed, for
+        example when rows with the same date were added or a group of
+        ``group_by`` grew, and ``boundary_replaced`` is then ``True``. The
+        other rows are appended to the data of the terms.
+
+        :returns:
+
+        - a ``dict`` with the retrieved data (only the new and replaced rows
+          for an incremental refresh) of every term.
+        """
+        loaded = all('_data' in td for tk_td_tuples in self.query_groups
+                     for (_, td) in self._projection(tk_td_tuples))
+        fetched = self._fetch_all()
+        self.boundary_replaced = False
+        if self.incremental_on and loaded:
+            for tk_td_tuples, data in fetched:
+                if self._append_beyond_mark(tk_td_tuples[0][0], data):
+                    self.boundary_replaced = True
+            self.high_water_marks.update(self._pending_marks)
+            self._pending_marks = {}
+        else:
+            self._set_data(fetched)
+        return dict((tk, data) for (tk_td_tuples, data) in fetched
+                    for (tk, _) in tk_td_tuples)
+
+    def _set_data(self, fetched):
+        """Stores the ``(tk_td_tuples, data)`` tuples returned by
+        ``_fetch_all()``."""
+        for tk_td_tuples, data in fetched:
             for tk, _ in tk_td_tuples:
-                # everything has a reference to the same list
-                self.series[tk]['_data'] = vqs_list
+                # everything has a reference to the same data
+                self.series[tk]['_data'] = data
+        self._update_high_water_marks(fetched)
+        # data is loaded, lazy terms don't need a reference to the pool
+        for td in self.series.values():
+            if isinstance(td, _LazyTermDict) and '_data' in td:
+                td._pool = None
+
+
+# prefix of the annotations which rank the rows of a category
+_RANK_PREFIX = '_chartit_rank_'
+# prefix of the annotations of the categories in the top_n and rollup queries
+_CAT_PREFIX = '_chartit_cat_'
+# annotation of the number of categories grouped by in the rollup query
+_LEVEL = '_chartit_level'
+
+
+def _supports_window_functions(db):
+    return Window is not None and \
+        getattr(connections[db].features, 'supports_over_clause', False)
+
+
+def _rank_per_cat(vqs, tk_td_tuples):
+    """Annotates ``vqs`` with the ``DENSE_RANK()`` of every row by the value
+    of every term, within the category of the row."""
+    td = tk_td_tuples[0][1]
+    partition_by = [F(c) for c in td['categories']]
+    ranks = OrderedDict()
+    for i, (tk, _) in enumerate(tk_td_tuples):
+        order_by = F(tk).desc() if td['top_n_per_cat'] > 0 else F(tk).asc()
+        ranks['%s%d' % (_RANK_PREFIX, i)] = Window(
+            expression=DenseRank(), partition_by=partition_by,
+            order_by=order_by)
+    return vqs.annotate(**ranks)
+
+
+def _top_n_per_cat_sql(tk_td_tuples, vqs):
+    """Returns the SQL and the parameters of the query which filters the
+    ranks annotated by ``_rank_per_cat()``, together with the compiler of
+    ``vqs`` and the names of the columns of its rows, in the order of the
+    ``SELECT`` clause (the same names ``values()`` uses)."""
+    td = tk_td_tuples[0][1]
+    qn = connections[vqs.db].ops.quote_name
+    query = vqs.query
+    compiler = query.get_compiler(using=vqs.db)
+    sql, params = compiler.as_sql()
+    names = (list(query.extra_select) + list(query.values_select) +
+             list(query.annotation_select))
+    # keeps all ties, i.e. the same rows as the groupby() of _set_data()
+    where = ' OR '.join('%s <= %d' % (qn(n), abs(td['top_n_per_cat']))
+                        for n in names if n.startswith(_RANK_PREFIX))
+    # the columns of the inner query may have the same names, so order by
+    # position instead
+    order_by = ['%d' % (names.index(c) + 1) for c in td['categories']]
+    order_by.append('%d %s' % (names.index(tk_td_tuples[0][0]) + 1,
+                               'DESC' if td['top_n_per_cat'] > 0 else 'ASC'))
+    sql = 'SELECT * FROM (%s) %s WHERE %s ORDER BY %s' % (
+        sql, qn('chartit_ranked'), where, ', '.join(order_by))
+    return sql, params, compiler, names
+
+
+def _fetch_top_n_per_cat(tk_td_tuples, vqs):
+    """Returns the rows of ``vqs`` which are among the top ``top_n_per_cat``
+    values of any term in their category. Window functions can't be used in
+    ``filter()``, so the query is wrapped in an outer query which filters
+    the ranks and keeps the order of ``vqs``."""
+    sql, params, compiler, names = _top_n_per_cat_sql(tk_td_tuples, vqs)
+    with connections[vqs.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = compiler.results_iter(results=[cursor.fetchall()])
+        return [dict((n, v) for (n, v) in zip(names, row)
+                     if not n.startswith(_RANK_PREFIX))
+                for row in rows]
+
+
+def _fetch_top_n_cvs(td, top_n):
+    """Returns the category values with the ``top_n`` largest (or smallest
+    if negative) sums of the values of the term over its legend values,
+    i.e. the ``cv`` kept by ``PivotDataPool._set_data()``. The sums are
+    computed by the database in an outer query over the pivot query of the
+    term."""
+    categories = td['categories']
+    aliases = ['%s%d' % (_CAT_PREFIX, i) for i in range(len(categories))]
+    value = '%svalue' % _CAT_PREFIX
+    vqs = (td['source']
+           .annotate(**dict((a, F(c)) for (a, c) in zip(aliases, categories)))
+           .values(*chain(aliases, td['legend_by']))
+           .annotate(**{value: td['func']})
+           .order_by())
+    connection = connections[vqs.db]
+    qn = connection.ops.quote_name
+    compiler = vqs.query.get_compiler(using=vqs.db)
+    sql, params = compiler.as_sql()
+    columns = ', '.join(qn(a) for a in aliases)
+    sql = 'SELECT %s FROM (%s) %s GROUP BY %s ORDER BY SUM(%s) %s' % (
+        columns, sql, qn('chartit_top_n'), columns, qn(value),
+        'DESC' if top_n > 0 else 'ASC')
+    if connection.vendor != 'oracle':
+        # only the top_n rows are transferred, even by client-side cursors
+        sql += ' LIMIT %d' % abs(top_n)
+    selected = dict((alias, expr) for (expr, _, alias) in compiler.select)
+    converters = compiler.get_converters([selected[a] for a in aliases])
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchmany(abs(top_n))
+    return list(_convert_rows(compiler, rows, converters))
+
+
+def _filter_cvs(vqs, categories, cvs):
+    """Limits ``vqs`` to the rows with the category values ``cvs``."""
+    if not cvs:
+        return vqs.none()
+    q = Q()
+    for cv in cvs:
+        q |= Q(**dict(('%s__isnull' % c, True) if v is None else (c, v)
+                      for (c, v) in zip(categories, cv)))
+    return vqs.filter(q)
+
+
+def _cumulative_percentages(values):
+    """Returns the running totals of ``values`` as percentages of their
+    sum."""
+    values = [float(v or 0) for v in values]
+    total = sum(values)
+    cum = 0
+    percentages = []
+    for value in values:
+        cum += value
+        percentages.append(100 * cum / total if total else None)
+    return percentages
+
+
+def _supports_rollup(db):
+    """Whether the database groups by ``ROLLUP`` and tells the rolled up
+    ``NULL`` values from the ones in the data with ``GROUPING()``."""
+    connection = connections[db]
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'mysql':
+        # MariaDB (versions 10 and newer) has no GROUPING()
+        return (8, 0, 1) <= connection.mysql_version < (10,)
+    return False
+
+
+def _rollup(vqs, categories, legend_by, ann_terms, order_by):
+    """Returns the pivot query grouped by all ``categories``, by every
+    shorter prefix of them and by none of them, i.e. the subtotals and the
+    grand total of ``GROUP BY ROLLUP``. The categories are annotated as
+    ``_chartit_cat_<i>``, the ones which are rolled up are ``NULL`` and
+    ``_chartit_level`` is the number of categories grouped by.
+
+    If the database supports ``ROLLUP``, only the query grouped by all
+    categories is returned and ``_fetch_rollup()`` adds the ``ROLLUP`` to its
+    SQL. Otherwise the levels are combined with ``UNION ALL`` into a single
+    query."""
+    aliases = ['%s%d' % (_CAT_PREFIX, i) for i in range(len(categories))]
+    query = vqs.all().query
+    native = _supports_rollup(vqs.db)
+    levels = []
+    for level in ([len(categories)] if native else
+                  range(len(categories), -1, -1)):
+        qs = vqs
+        # one annotation at a time, the columns of all levels must be in
+        # the same order
+        for i, (alias, c) in enumerate(zip(aliases, categories)):
+            if i < level:
+                expr = F(c)
+            else:
+                output_field = F(c).resolve_expression(query).output_field
+                expr = Value(None, output_field=output_field)
+            qs = qs.annotate(**{alias: expr})
+        if native:
+            qs = qs.values(*chain(legend_by, aliases))
+        else:
+            qs = qs.annotate(**{_LEVEL: Value(level,
+                                              output_field=IntegerField())})
+            qs = qs.values(*chain(legend_by, aliases, [_LEVEL]))
+        for tk, func in ann_terms.items():
+            qs = qs.annotate(**{tk: func})
+        levels.append(qs.order_by())
+    if native:
+        return levels[0]
+    return levels[0].union(*levels[1:], all=True).order_by(
+        *chain(aliases, ['-' + _LEVEL], order_by))
+
+
+def _rollup_sql(tk_td_tuples, vqs):
+    """Returns the SQL and the parameters of the query which groups the
+    query returned by ``_rollup()`` by ``ROLLUP``, together with the compiler
+    of ``vqs`` and the names of the columns of its rows. The
+    ``_chartit_level`` is the first column of the query."""
+    tk, td = tk_td_tuples[0]
+    connection = connections[vqs.db]
+    qn = connection.ops.quote_name
+    query = vqs.query
+    compiler = query.get_compiler(using=vqs.db)
+    _, _, group_by = compiler.pre_sql_setup()
+    sql, params = compiler.as_sql()
+    names = list(query.values_select) + list(query.annotation_select)
+    # the categories and the legend_by are columns, without parameters
+    columns = dict(zip(names, (col_sql for (_, (col_sql, _), _)
+                               in compiler.select)))
+    legend = [columns[lookup] for lookup in td['legend_by']]
+    cats = [columns['%s%d' % (_CAT_PREFIX, i)]
+            for i in range(len(td['categories']))]
+    level = '%d - (%s)' % (len(cats), ' + '.join('GROUPING(%s)' % c
+                                                 for c in cats))
+    where = ''
+    if connection.vendor == 'mysql':
+        # WITH ROLLUP rolls up the legend_by too, those rows are left out
+        grouping = '%s WITH ROLLUP' % ', '.join(legend + cats)
+        if legend:
+            level = 'CASE WHEN %s = 0 THEN %s END' % (
+                ' + '.join('GROUPING(%s)' % c for c in legend), level)
+            where = ' WHERE %s IS NOT NULL' % qn(_LEVEL)
+        # the ORDER BY NULL of grouped queries can't be used with ROLLUP
+        if sql.endswith(' ORDER BY NULL'):
+            sql = sql[:-len(' ORDER BY NULL')]
+    else:
+        grouping = ', '.join(legend + ['ROLLUP(%s)' % ', '.join(cats)])
+    sql = sql.replace('GROUP BY %s' % ', '.join(g for (g, _) in group_by),
+                      'GROUP BY %s' % grouping)
+    sql = 'SELECT %s AS %s, %s' % (level, qn(_LEVEL), sql[len('SELECT '):])
+    order_by = [qn(a) for a in names if a.startswith(_CAT_PREFIX)]
+    order_by.append('%s DESC' % qn(_LEVEL))
+    if td['top_n_per_cat']:
+        order_by.append('%s %s' % (
+            qn(tk), 'DESC' if td['top_n_per_cat'] > 0 else 'ASC'))
+    sql = 'SELECT * FROM (%s) %s%s ORDER BY %s' % (
+        sql, qn('chartit_rollup'), where, ', '.join(order_by))
+    return sql, params, compiler, names
+
+
+def _fetch_rollup(tk_td_tuples, vqs):
+    """Returns the rows of the query returned by ``_rollup()``, grouped by
+    ``ROLLUP`` in the database."""
+    sql, params, compiler, names = _rollup_sql(tk_td_tuples, vqs)
+    with connections[vqs.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    levels = [int(row[0]) for row in rows]
+    rows = compiler.results_iter(results=[[row[1:] for row in rows]])
+    data = []
+    for level, row in zip(levels, rows):
+        vd = dict(zip(names, row))
+        vd[_LEVEL] = level
+        data.append(vd)
+    return data
+
+
+def _rollup_cv_getter(categories, label):
+    """Returns a function which returns the category value of a row of the
+    ``_rollup()`` query, with ``label`` in place of the rolled up
+    categories."""
+    aliases = ['%s%d' % (_CAT_PREFIX, i) for i in range(len(categories))]
+
+    def cv_getter(vd):
+        level = vd[_LEVEL]
+        return tuple(vd[a] if i < level else label
+                     for (i, a) in enumerate(aliases))
+    return cv_getter
 
 
 class PivotDataPool(DataPool):
     """PivotDataPool holds the data retrieved from various tables (models) and
     then *pivoted* against the category fields."""
 
+    _top_n_cvs = None
+
     def __init__(self, series, top_n_term=None, top_n=None, pareto_term=None,
-                 sortf_mapf_mts=None):
+                 sortf_mapf_mts=None, lazy=False, cache=None, dense=False):
         """ Creates a PivotDataPool object.
 
         :Arguments:
@@ -232,6 +1118,18 @@ class PivotDataPool(DataPool):
               ``county/cities`` with highest rainfall for each of the
               ``country/state``, then ``top_n_per_cat = 3``.
 
+            + **rollup** (*optional*) - ``True`` or a string. Adds the
+              subtotals of every prefix of the ``categories`` and the grand
+              total as extra category values, like ``GROUP BY ROLLUP``. For
+              ``categories = ['country', 'state']`` these are
+              ``('USA', 'Total')`` for every ``country`` and
+              ``('Total', 'Total')``. A string is used as the label instead
+              of ``'Total'``. All levels are retrieved in a single query,
+              grouped by ``ROLLUP`` on PostgreSQL and MySQL and combined with
+              ``UNION ALL`` on other databases. Terms with subtotals can't be
+              the ``top_n_term`` or the ``pareto_term``. Requires Django 1.11
+              or newer.
+
           - **terms** - is a ``dict``. The keys can be any strings (but helps
             if they are meaningful aliases for the field). The values can
             either be
@@ -343,6 +1241,24 @@ class PivotDataPool(DataPool):
             sorted, which would yield an order like ``Apr``, ``Aug``,
             ``Dec``, etc. (not what we want).
 
+        - **lazy** (*optional*) - a ``bool``. If ``True`` the queries are
+          not executed until the pivoted data is accessed for the first
+          time, for example when a ``PivotChart`` is created from this
+          ``PivotDataPool``, or until ``aload()`` is awaited.
+          Defaults to ``False``.
+
+        - **cache** (*optional*) - either ``True`` or a
+          ``chartit.cache.ChartDataCache`` object. The results of the
+          queries are cached the same way as for ``DataPool``.
+
+        - **dense** (*optional*) - a ``bool``. If ``True`` the pivoted data
+          of every term is also stored in a NumPy matrix of legend values x
+          category values (see ``chartit.matrix``), from which
+          ``PivotChart`` slices its series. Much faster for thousands of
+          categories and hundreds of legend values. Terms with few values
+          compared to the size of the matrix keep using dicts. Requires
+          NumPy. Defaults to ``False``.
+
         :Raises:
 
         - **APIInputError** - if the ``series`` argument has any invalid
@@ -416,12 +1332,43 @@ class PivotDataPool(DataPool):
                                 isinstance(top_n, int)) else 0)
         self.pareto_term = (pareto_term if pareto_term in
                             self.series.keys() else None)
+        for term in (self.top_n_term, self.pareto_term):
+            if term is not None and \
+                    self.series[term].get('rollup') is not None:
+                raise APIInputError("The subtotals of '%s' can't be ranked. "
+                                    "Terms with 'rollup' can't be the "
+                                    "top_n_term or the pareto_term." % term)
         self.sortf, self.mapf, self.mts = clean_sortf_mapf_mts(sortf_mapf_mts)
+        self.cache = clean_cache(cache)
+        self.dense = clean_dense(dense)
         # query groups and data
         self.query_groups = self._group_terms_by_query(
-                                'top_n_per_cat', 'categories', 'legend_by'
+                                'top_n_per_cat', 'categories', 'legend_by',
+                                'rollup'
                             )
-        self._get_data()
+        if not lazy:
+            self._get_data()
+
+    def __getattr__(self, name):
+        # only called when the attribute doesn't exist, i.e. for lazy pools
+        # which haven't retrieved their data yet
+        if name in ('cv', 'cv_raw', 'pareto_cum_pct') and \
+                'query_groups' in self.__dict__:
+            self._get_data()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _fetch_all(self, missing_only=False):
+        # the top_n categories are retrieved first, so that the pivot queries
+        # don't retrieve the rows of the other categories
+        if self.top_n and \
+                self.series[self.top_n_term]['top_n_per_cat'] == 0:
+            self._top_n_cvs = _fetch_top_n_cvs(self.series[self.top_n_term],
+                                               self.top_n)
+        try:
+            return super(PivotDataPool, self)._fetch_all(missing_only)
+        finally:
+            self._top_n_cvs = None
 
     def _generate_vqs(self):
         """Generates and yields the value query set for each query in the
@@ -436,13 +1383,12 @@ class PivotDataPool(DataPool):
             qs = td['source']
             categories = td['categories']
             legend_by = td['legend_by']
-            # vqs = values queryset
-            values_terms = chain(categories, legend_by)
-            vqs = qs.values(*values_terms)
+            if self._top_n_cvs is not None and \
+                    categories == self.series[self.top_n_term]['categories']:
+                qs = _filter_cvs(qs, categories, self._top_n_cvs)
             # NOTE: Order of annotation is important!!!
             # So need an OrderedDict. Can't use a regular dict.
             ann_terms = OrderedDict((k, d['func']) for k, d in tk_td_tuples)
-            vqs = vqs.annotate(**ann_terms)
             # Now order by
             top_n_per_cat = td['top_n_per_cat']
             if top_n_per_cat > 0:
@@ -451,132 +1397,155 @@ class PivotDataPool(DataPool):
                 order_by = (tk,)
             else:
                 order_by = ()
+            if td.get('rollup') is not None:
+                yield tk_td_tuples, _rollup(qs, categories, legend_by,
+                                            ann_terms, order_by)
+                continue
+            # vqs = values queryset
+            values_terms = chain(categories, legend_by)
+            vqs = qs.values(*values_terms)
+            vqs = vqs.annotate(**ann_terms)
             order_by_terms = chain(categories, order_by)
             vqs = vqs.order_by(*order_by_terms)
+            if top_n_per_cat != 0 and _supports_window_functions(vqs.db):
+                # only the top rows per category are retrieved
+                vqs = _rank_per_cat(vqs, tk_td_tuples)
             yield tk_td_tuples, vqs
 
-    def _get_data(self):
+    def _fetch(self, tk_td_tuples, vqs):
+        if tk_td_tuples[0][1].get('rollup') is not None and \
+                _supports_rollup(vqs.db):
+            return _fetch_rollup(tk_td_tuples, vqs)
+        if any(a.startswith(_RANK_PREFIX) for a in
+               vqs.query.annotation_select):
+            return _fetch_top_n_per_cat(tk_td_tuples, vqs)
+        return list(vqs)
+
+    def _group_rows(self, tk_td_tuples, vqs, interned):
+        """Walks the rows of a query group once and yields a ``(cv, rows,
+        lvs)`` tuple for every category value, with the rows of the category
+        and their legend values. The category and legend values are tuples
+        of unicode strings, interned in the ``interned`` dict."""
+        # All (tk, td) tuples within the list tk_td_tuples, share the same
+        # source, categories and legend_by. So we can extract these two
+        # from the first tuple in the list.
+        td = tk_td_tuples[0][1]
+        categories = td['categories']
+        legend_by = td['legend_by']
+        # vqs is a list of dicts. For example
+        # [{'continent': 'NA', 'country': 'USA', 'pop__sum': 300}]
+        # cv: category value. For example,
+        # if categories = ('continent', 'country'), then
+        # cv = ('NA', 'USA'), ('Asia', 'India'), etc.
+        # lv: legend value. For example, if legend = ('year', 'quarter'),
+        # then lv = (2010, 2)
+        if td.get('rollup') is not None:
+            cv_getter = _rollup_cv_getter(categories, td['rollup'])
+        else:
+            cv_getter = itemgetter(*categories)
+        # there may be nothing to legend by, i.e. legend_by=()
+        lv_getter = itemgetter(*legend_by) if legend_by else lambda vd: ()
+        # legend values as retrieved from the DB -> lv
+        lv_by_value = {}
+        for cv, rows in groupby(vqs, cv_getter):
+            if not isinstance(cv, tuple):
+                cv = (cv,)
+            cv = tuple(map(unicode, cv))
+            cv = interned.setdefault(cv, cv)
+            rows = list(rows)
+            lvs = []
+            for vd in rows:
+                value = lv_getter(vd)
+                lv = lv_by_value.get(value)
+                if lv is None:
+                    lv = value if isinstance(value, tuple) else (value,)
+                    lv = tuple(map(unicode, lv))
+                    lv = lv_by_value[value] = interned.setdefault(lv, lv)
+                lvs.append(lv)
+            yield cv, rows, lvs
+
+    def _set_data(self, fetched):
+        """Pivots the ``(tk_td_tuples, rows)`` tuples returned by
+        ``_fetch_all()``."""
         # These are some of the attributes that will used to store some
         # temporarily generated data.
         self.cv_raw = set([])
         _pareto_by_cv = defaultdict(int)
         _cum_dfv_by_cv = defaultdict(int)
-        for tk_td_tuples, vqs in self._generate_vqs():
-            # tk: term key, td: term dict
-            # All (tk, td) tuples within the list tk_td_tuples, share the same
-            # source, categories and legend_by. So we can extract these three
-            # from the first tuple in the list.
-            tk, td = tk_td_tuples[0]
-            categories = td['categories']
-            legend_by = td['legend_by']
-            for i, (tk, td) in enumerate(tk_td_tuples):
-                # cv_lv_dfv: dict with category value, legend value as keys
-                # and datafunc-values as values.
-                # For example, if
-                # category = ['continent'], legend_by = ['country'] and
-                # func = Sum('population_millions')
-                # cv_lv_dfv = {'Asia': {'India': 1001, 'China': 1300},
-                #              'Europe': {'UK': 61.8, 'France': 62.6},
-                #              ... }
-                cv_lv_dfv = defaultdict(dict)
-                # lv_set is the set of legend_values
-                # For instance, lv_set for the above example is
-                # set(['India', 'China', 'UK', 'France'])
-                lv_set = set()
-                # cv: category value. For example,
-                # if categories = ('continent', 'country'), then
-                # cv = ('NA', 'USA'), ('Asia', 'India'), etc.
-                # g_vqs_by_cv = grouped ValueQuerySet (grouped by cv)
-                # i.e. grouped by ('NA', 'USA'), ('Asia', 'India'), etc.
-                #
-                # vqs is a list of dicts. For example
-                # [{'continent': 'NA', 'country': 'USA', 'pop__sum': 300}]
-                for cv, g_vqs_by_cv in groupby(vqs, itemgetter(*categories)):
-                    if not isinstance(cv, tuple):
-                        cv = (cv,)
-                    cv = tuple(map(unicode, cv))
-                    self.cv_raw |= set([cv])
-                    # For the first loop (i==0), the queryset is already
-                    # pre-sorted by value of the data func alias (for example
-                    # pop__sum) when retrieved from the DB. So don't
-                    # sort it again. If we need to retrieve all the
-                    # elements (not just top n) per category
-                    # (fd['top_n_per_group'] == 0), we don't care about the
-                    # sort order. Don't sort in this case.
-                    if i != 0 and td['top_n_per_cat'] != 0:
-                        g_vqs_by_cv.sort(key=itemgetter(tk),
-                                         reverse=(td['top_n_per_cat'] > 0))
-                    # g_vqs_by_cv_dfv: Grouped Value QuerySet (grouped by
-                    # category and then by datafunc value.
-                    # alias = 'population__sum'
-                    # itemgetter('pop__sum') = 10 etc.
-                    # So grouped by pop__sum = 10, 9, etc.
-                    # NOTE: Need this step to make sure we retain duplicates
-                    # in the top n if there are multiple entries. For example
-                    # if pop__sum is 10, 10, 9, 9, 7, 3, 2, 1 and we want
-                    # top 3, then the result should we 10, 10, 9, 9, 7 and
-                    # not just 10, 10, 9. A simple list slice will only retain
-                    # 10, 10, 9. So it is not useful. An alternative is to
-                    # group_by and then slice.
-                    g_vqs_by_cv_dfv = groupby(g_vqs_by_cv, itemgetter(tk))
-                    # Now that this is grouped by datafunc value, slice off
-                    # if we only need the top few per each category
-                    if td['top_n_per_cat'] != 0:
-                        g_vqs_by_cv_dfv = islice(g_vqs_by_cv_dfv, 0,
-                                                 abs(td['top_n_per_cat']))
-                    # Now build the result dictionary
-                    # dfv = datafunc value
-                    # vqs_by_c_dfv =  ValuesQuerySet by cat. and datafunc value
-                    for dfv, vqs_by_cv_dfv in g_vqs_by_cv_dfv:
-                        if tk == self.top_n_term:
-                            _cum_dfv_by_cv[cv] += dfv
-                        if tk == self.pareto_term:
-                            _pareto_by_cv[cv] += dfv
-                        for vd in vqs_by_cv_dfv:
-                            # vd: values dict
-                            # vd: {'continent': 'NA', 'country': 'USA',
-                            #      'year': 2010, 'quarter': 2,
-                            #      'population__avg': 301,
-                            #      'gdp__avg': 14.12}
-                            # category = ('continent', 'country',)
-                            # legend = ('year', 'quarter')
-                            # lv = (2010, 2)
-                            # dfa = 'price__max'
-                            # cv_lv_dfv[('NA', 'USA')][(2010, 2)] = 301
-                            try:
-                                lv = itemgetter(*legend_by)(vd)
-                                if not isinstance(lv, tuple):
-                                    lv = (lv,)
-                                lv = tuple(map(unicode, lv))
-                            # If there is nothing to legend by i.e.
-                            # legend_by=() then itemgetter raises a TypeError.
-                            # Handle it.
-                            except TypeError:
-                                lv = ()
-                            cv_lv_dfv[cv][lv] = vd[tk]
-                            lv_set |= set([lv])
-                td['_cv_lv_dfv'] = cv_lv_dfv
-                td['_lv_set'] = lv_set
+        # the same category and legend values are shared by all terms
+        interned = {}
+        for tk_td_tuples, vqs in fetched:
+            for tk, td in tk_td_tuples:
+                td['_cv_lv_dfv'] = defaultdict(dict)
+                td['_lv_set'] = set()
+            for cv, rows, lvs in self._group_rows(tk_td_tuples, vqs,
+                                                  interned):
+                self.cv_raw.add(cv)
+                for i, (tk, td) in enumerate(tk_td_tuples):
+                    # cv_lv_dfv: dict with category value, legend value as
+                    # keys and datafunc-values as values. For example, if
+                    # category = ['continent'], legend_by = ['country'] and
+                    # func = Sum('population_millions')
+                    # cv_lv_dfv = {'Asia': {'India': 1001, 'China': 1300},
+                    #              'Europe': {'UK': 61.8, 'France': 62.6},
+                    #              ... }
+                    lv_dfv = td['_cv_lv_dfv'][cv]
+                    lv_set = td['_lv_set']
+                    top_n_per_cat = td['top_n_per_cat']
+                    dfv_lv = ((vd[tk], lv) for (vd, lv) in zip(rows, lvs))
+                    # For the first term (i==0), the rows are already
+                    # pre-sorted by its value when retrieved from the DB. If
+                    # we need to retrieve all the elements (not just top n)
+                    # per category we don't care about the sort order.
+                    if i != 0 and top_n_per_cat != 0:
+                        dfv_lv = sorted(dfv_lv, key=itemgetter(0),
+                                        reverse=top_n_per_cat > 0)
+                    # Runs of the same value count once, e.g. to retain
+                    # duplicates in the top n. If the values are 10, 10, 9,
+                    # 9, 7, 3 and we want the top 3, then the result should
+                    # be 10, 10, 9, 9, 7 and not just 10, 10, 9.
+                    if tk == self.top_n_term and top_n_per_cat == 0:
+                        # the total of the category, like the SUM() of
+                        # _fetch_top_n_cvs()
+                        _cum_dfv_by_cv[cv] += sum(
+                            vd[tk] for vd in rows if vd[tk] is not None)
+                    runs = 0
+                    last_dfv = None
+                    for dfv, lv in dfv_lv:
+                        if runs == 0 or dfv != last_dfv:
+                            if top_n_per_cat and runs == abs(top_n_per_cat):
+                                break
+                            runs += 1
+                            last_dfv = dfv
+                            if tk == self.top_n_term and top_n_per_cat:
+                                _cum_dfv_by_cv[cv] += dfv
+                            if tk == self.pareto_term:
+                                _pareto_by_cv[cv] += dfv
+                        lv_dfv[lv] = dfv
+                        lv_set.add(lv)
+        if self.dense:
+            cv_index = dict((cv, i) for i, cv in enumerate(self.cv_raw))
+            for tk, td in self.series.items():
+                td['_matrix'] = PivotMatrix.from_dict(
+                    td['_cv_lv_dfv'], td['_lv_set'], cv_index)
         # If we only need top n items, remove the other items from self.cv_raw
         if self.top_n_term:
-            cum_cv_dfv_items = sorted(_cum_dfv_by_cv.items(),
-                                      key=itemgetter(1),
-                                      reverse=self.top_n > 0)
-            cv_dfv_top_n_items = cum_cv_dfv_items[0:abs(self.top_n)]
-            self.cv_raw = [cv_dfv[0] for cv_dfv in cv_dfv_top_n_items]
+            select = nlargest if self.top_n > 0 else nsmallest
+            self.cv_raw = select(abs(self.top_n), _cum_dfv_by_cv,
+                                 key=_cum_dfv_by_cv.__getitem__)
         else:
             self.cv_raw = list(self.cv_raw)
         # If we need to pareto, order the category values in pareto order.
+        self.pareto_cum_pct = None
         if self.pareto_term:
-            pareto_cv_dfv_items = sorted(_pareto_by_cv.items(),
-                                         key=itemgetter(1),
-                                         reverse=True)
-            pareto_cv = [cv_dfv[0] for cv_dfv in pareto_cv_dfv_items]
             if self.top_n_term:
-                self.cv_raw = [_cv for _cv in pareto_cv if cv in self.cv_raw]
-            else:
-                self.cv_raw = pareto_cv
-
+                top_n_cvs = set(self.cv_raw)
+                _pareto_by_cv = dict((cv, dfv) for (cv, dfv) in
+                                     _pareto_by_cv.items() if cv in top_n_cvs)
+            self.cv_raw = sorted(_pareto_by_cv, key=_pareto_by_cv.__getitem__,
+                                 reverse=True)
+            self.pareto_cum_pct = _cumulative_percentages(
+                _pareto_by_cv[cv] for cv in self.cv_raw)
             if self.mapf is None:
                 self.cv = self.cv_raw
             else:
@@ -1,14 +1,20 @@
+import calendar
 import sys
-import copy
 import warnings
 from collections import defaultdict, OrderedDict
+from datetime import date, datetime
 from itertools import groupby
 
-from .utils import _getattr, RecursiveDefaultDict
-from .validation import clean_pcso, clean_cso, clean_x_sortf_mapf_mts
+from django.utils import timezone
+from django.utils.six.moves import zip
+
+from .utils import _getattr, _then, RecursiveDefaultDict, SeriesOptions
+from .validation import clean_pcso, clean_cso, clean_x_sortf_mapf_mts, \
+    clean_pareto_line, clean_streamed_cso
 from .exceptions import APIInputError
-from .chartdata import PivotDataPool, DataPool
-import json
+from .chartdata import PivotDataPool, DataPool, ColumnData, StreamedData
+from .downsampling import downsample, min_max_stream
+from .serialization import dumps
 
 
 # in Python 3 the standard str type is unicode and the
@@ -17,6 +23,128 @@ if sys.version_info.major >= 3:
     unicode = str
 
 
+def _x_y_values(data, x_field, y_fields):
+    """Iterates over ``(x_value, y_values)`` pairs in the ``_data`` of a term.
+    ``data`` is either a list of dicts/model instances or ``ColumnData``."""
+    if isinstance(data, ColumnData):
+        return zip(data[x_field], zip(*[data[f] for f in y_fields]))
+    return ((_getattr(value_obj, x_field),
+             [_getattr(value_obj, y_field) for y_field in y_fields])
+            for value_obj in data)
+
+
+def _align_x_y_values(sources):
+    """Joins the ``(x_value, y_values)`` pairs of several sources on their x
+    values, in a single pass over each source.
+
+    ``sources`` is a list of ``(number of y values, pairs)`` tuples. Returns
+    an ``OrderedDict`` of every x value, in the order they are first seen,
+    to the list of the y values of all sources, with ``None`` where a
+    source doesn't have the x value. If a source has the same x value more
+    than once, its last y values are kept."""
+    width = sum(n for (n, _) in sources)
+    aligned = OrderedDict()
+    get = aligned.get
+    offset = 0
+    for n, pairs in sources:
+        end = offset + n
+        for x_value, y_values in pairs:
+            row = get(x_value)
+            if row is None:
+                row = aligned[x_value] = [None] * width
+            row[offset:end] = y_values
+        offset = end
+    return aligned
+
+
+def _utc(value):
+    """Converts a date or datetime into a naive datetime in UTC. Naive
+    datetimes are taken to be in UTC already, like Highcharts does."""
+    if not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    if timezone.is_aware(value):
+        return timezone.make_naive(value, timezone.utc)
+    return value
+
+
+def _epoch_ms(value):
+    """Returns the milliseconds since the epoch of a UTC datetime."""
+    return (calendar.timegm(value.timetuple()) * 1000 +
+            value.microsecond // 1000)
+
+
+def _is_datetime_axis(x_axis, x_values):
+    """Whether the x values are plotted on a ``datetime`` axis, i.e. if the
+    ``type`` of the axis is ``'datetime'`` or if it doesn't have a ``type``
+    and all x values are dates or datetimes."""
+    axis_type = x_axis.get('type')
+    if axis_type is not None:
+        return axis_type == 'datetime'
+    return bool(x_values) and all(isinstance(x, date) for x in x_values)
+
+
+def _x_ms(x_values):
+    """Returns the x values of a ``datetime`` axis in milliseconds since the
+    epoch."""
+    if all(isinstance(x, date) for x in x_values):
+        return [_epoch_ms(_utc(x)) for x in x_values]
+    # e.g. already in milliseconds
+    return x_values
+
+
+def _point_interval(x_ms):
+    """Returns the ``pointStart`` and ``pointInterval`` options of x values
+    which are regularly spaced in milliseconds, or ``None``. Calendar months
+    and years have different lengths and are plotted as ``[x, y]`` pairs,
+    as the ``pointIntervalUnit`` option needs Highcharts 4.1 or newer."""
+    if len(x_ms) < 2:
+        return None
+    interval = x_ms[1] - x_ms[0]
+    if interval > 0 and all(b - a == interval for (a, b) in
+                            zip(x_ms, x_ms[1:])):
+        return {'pointStart': x_ms[0], 'pointInterval': interval}
+    return None
+
+
+def _plot_points(x_axis, y_hco_list, data):
+    """Plots the ``(x_value, y_values)`` pairs of ``data`` into the x-axis
+    ``x_axis`` and the series ``y_hco_list``.
+
+    The x values are the ``categories`` of the axis, unless they are plotted
+    on a ``datetime`` axis. Then the x values are converted to milliseconds
+    since the epoch and the series have ``pointStart`` and
+    ``pointInterval`` options if the x values are regularly spaced, or
+    ``[x, y]`` pairs otherwise.
+    """
+    data = list(data)
+    x_values = [x for (x, _) in data]
+    if not _is_datetime_axis(x_axis, x_values):
+        x_axis['categories'] = x_values
+        for i, opts in enumerate(y_hco_list):
+            opts['data'] = [y_values[i] for (_, y_values) in data]
+        return
+    x_axis['type'] = 'datetime'
+    x_axis.pop('categories', None)
+    x_ms = _x_ms(x_values)
+    options = _point_interval(x_ms)
+    for i, opts in enumerate(y_hco_list):
+        if options is not None:
+            opts.update(options)
+            opts['data'] = [y_values[i] for (_, y_values) in data]
+        else:
+            opts['data'] = [[x, y_values[i]] for (x, (_, y_values)) in
+                            zip(x_ms, data)]
+
+
+def _sorts_after(new, old):
+    """Whether the sorted x-axis categories ``new`` can be appended to the
+    sorted categories ``old`` without changing their order."""
+    try:
+        return not (old and new) or new[0] > old[-1]
+    except TypeError:
+        return False
+
+
 class BaseChart(object):
     """
         Common ancestor class for all charts to avoid code duplication.
@@ -25,6 +153,24 @@ class BaseChart(object):
         self.hcoptions = RecursiveDefaultDict({})
         self.PY2 = sys.version_info.major == 2
 
+    @classmethod
+    def acreate(cls, datasource, *args, **kwargs):
+        """Creates the chart in asynchronous views without blocking the
+        running ``asyncio`` event loop while the data is retrieved ::
+
+            ds = DataPool(series=[...], lazy=True)
+            cht = await Chart.acreate(ds, series_options=[...])
+
+        The ``datasource`` is loaded with its ``aload()`` method and the
+        remaining arguments are passed to the chart constructor.
+
+        :returns:
+
+        - an awaitable which resolves to the chart object.
+        """
+        return _then(datasource.aload(),
+                     lambda datasource: cls(datasource, *args, **kwargs))
+
     def to_json(self):
         """Load Chart's data as JSON
         Useful in Ajax requests. Example:
@@ -41,7 +187,7 @@ class BaseChart(object):
                 });
             });
         """
-        return json.dumps(self.hcoptions)
+        return dumps(self.hcoptions)
 
 
 class Chart(BaseChart):
@@ -88,6 +234,25 @@ class Chart(BaseChart):
                invalid options are just passed to Highcharts JS which silently
                ignores them.
 
+            The following chartit specific options are also accepted and are
+            not passed to Highcharts:
+
+            + **max_points** (*optional*) - an ``int`` greater than 2. Large
+              line, area, column, etc. series are downsampled to at most this
+              many points before they are sent to the browser. All series
+              plotted against the same x-axis categories need to specify
+              ``max_points``, otherwise all points are kept. Points on a
+              ``datetime`` axis are downsampled by their time, other points
+              by their position. Not supported by scatter and pie series.
+              Required for every series if the ``DataPool`` has a
+              ``chunk_size``.
+            + **downsample** (*optional*) - the downsampling algorithm.
+              Either ``'lttb'`` (Largest-Triangle-Three-Buckets, the default)
+              or ``'minmax'`` (minimum and maximum value of every bucket).
+              Both preserve the peaks of the series. Series streamed from a
+              ``DataPool`` with a ``chunk_size`` are always downsampled with
+              ``'minmax'``, by the position of the points.
+
           - **terms** (**required**) - a ``dict``. keys are the x-axis terms
             and the values are lists of y-axis terms for that particular
             x-axis term. Both x-axis and y-axis terms must be present in the
@@ -145,6 +310,16 @@ class Chart(BaseChart):
              Any invalid options are just passed to Highcharts JS which
              silently ignores them.
 
+          Line, area, column, etc. series whose x values are all dates or
+          datetimes are plotted on a ``datetime`` x-axis: the x values are
+          sent as milliseconds since the epoch (UTC), as ``pointStart`` and
+          ``pointInterval`` if they are a fixed time apart or as ``[x, y]``
+          pairs otherwise, e.g. for months or years, which works with the
+          bundled Highcharts 2.
+          Set the ``type`` of the x-axis to ``'category'`` to plot them as
+          categories instead, or to ``'datetime'`` for x values which are
+          already in milliseconds.
+
         **Raises**:
 
         - ``APIInputError`` if any of the terms are not present in the
@@ -157,11 +332,23 @@ class Chart(BaseChart):
                                 % datasource)
         self.datasource = datasource
         self.series_options = clean_cso(series_options, self.datasource)
+        # a lazy datasource doesn't retrieve the terms which aren't plotted
+        terms = self._terms()
+        self.datasource.use_terms(*terms)
+        self.datasource._load_terms(terms)
         self.x_sortf_mapf_mts = clean_x_sortf_mapf_mts(x_sortf_mapf_mts)
+        clean_streamed_cso(self.series_options, self.datasource,
+                           self.x_sortf_mapf_mts)
         self.x_axis_vqs_groups = self._groupby_x_axis_and_vqs()
         self._set_default_hcoptions(chart_options)
         self.generate_plot()
 
+    def _terms(self):
+        """Returns the terms of the datasource this chart plots."""
+        terms = set(self.series_options)
+        terms.update(so['_x_axis_term'] for so in self.series_options.values())
+        return terms
+
     def _groupby_x_axis_and_vqs(self):
         """
         Here is an example of what this function would return ::
@@ -305,7 +492,98 @@ class Chart(BaseChart):
             if self.hcoptions['yAxis'][1]['opposite'] is not False:
                 self.hcoptions['yAxis'][1]['opposite'] = True
 
-    def generate_plot(self):
+    def _downsample(self, data, y_terms, x_axis):
+        """Reduces the number of ``(x_value, y_values)`` items in ``data``
+        according to the ``max_points`` option of the ``y_terms``.
+
+        All series which share the same x-axis categories must keep the same
+        items. That's why the items selected for every series are merged and
+        nothing is removed unless all ``y_terms`` specify ``max_points``.
+
+        The x values are the positions of the categories, or the
+        milliseconds since the epoch if ``x_axis`` is a ``datetime`` axis.
+        """
+        limits = [(self.series_options[y_term].get('max_points'),
+                   self.series_options[y_term].get('downsample', 'lttb'))
+                  for y_term in y_terms]
+        if any(max_points is None for (max_points, _) in limits):
+            return data
+
+        data = list(data)
+        x_values = [x for (x, _) in data]
+        if _is_datetime_axis(x_axis, x_values):
+            x_values = [float(x) for x in _x_ms(x_values)]
+        else:
+            # the position on a category axis is the actual x value
+            x_values = list(range(len(data)))
+        keep = set()
+        for i, (max_points, algorithm) in enumerate(limits):
+            positions = [pos for pos, (_, y_values) in enumerate(data)
+                         if y_values[i] is not None]
+            points = [(x_values[pos], float(data[pos][1][i]))
+                      for pos in positions]
+            keep.update(positions[j] for j in
+                        downsample(points, max_points, algorithm))
+        return [data[pos] for pos in sorted(keep)]
+
+    def _downsample_stream(self, data, x_field, y_fields, y_terms):
+        """Orders the rows of the ``StreamedData`` ``data`` by ``x_field``
+        in the database and downsamples their ``(x_value, y_values)`` items
+        with min/max buckets, chunk by chunk, according to the
+        ``max_points`` option of the ``y_terms``."""
+        data = data.order_by(x_field)
+        limits = [self.series_options[y_term]['max_points']
+                  for y_term in y_terms]
+        return min_max_stream(_x_y_values(data, x_field, y_fields),
+                              data.count(), limits)
+
+    def refresh(self):
+        """Refreshes the ``DataPool`` and updates the chart.
+
+        If the ``DataPool`` is ``incremental_on`` a field, the points of the
+        new rows are appended to the series and the x-axis categories that
+        were already built, as long as the new categories sort after the
+        existing ones. Otherwise, or if rows at a high-water mark were
+        replaced, the series are downsampled, the x-axis values are sorted
+        or mapped with ``x_sortf_mapf_mts`` or are plotted on a
+        ``datetime`` axis, the whole chart is plotted again.
+        """
+        new_data = self.datasource.refresh()
+        if (not self.datasource.incremental_on or
+                self.datasource.boundary_replaced or
+                any('max_points' in opts for opts in
+                    self.series_options.values()) or
+                any(x_sortf is not None or x_mapf is not None for
+                    (x_sortf, x_mapf, _) in self.x_sortf_mapf_mts) or
+                any(x_axis.get('type') == 'datetime' for x_axis in
+                    self.hcoptions['xAxis'])):
+            self.generate_plot()
+            return
+
+        x_axes = self.hcoptions['xAxis']
+        series = self.hcoptions['series']
+        categories = [x_axis.get('categories') for x_axis in x_axes]
+        # plot only the new rows, then append the result to the old plot
+        self.generate_plot(new_data)
+        new_categories = [x_axis.get('categories') for x_axis in x_axes]
+        if not all(_sorts_after(new, old) for (old, new) in
+                   zip(categories, new_categories)):
+            self.generate_plot()
+            return
+
+        # the axes hold the new categories, prepend the old ones in place
+        filled = set()
+        for old, new in zip(categories, new_categories):
+            if old and id(new) not in filled:
+                filled.add(id(new))
+                new[:0] = old
+        for opts, new_opts in zip(series, self.hcoptions['series']):
+            opts['data'].extend(new_opts['data'])
+        self.hcoptions['series'][:] = series
+
+    def generate_plot(self, data_by_term=None):
+        """Plots the ``_data`` of the terms, or the data in
+        ``data_by_term`` if specified, into ``hcoptions``."""
         # find all x's from different datasources that need to be plotted on
         # same xAxis and also find their corresponding y's
         def cht_typ_grp(y_term):
@@ -336,11 +614,12 @@ class Chart(BaseChart):
                 y_aliases_multi = []
                 y_types_multi = []
                 y_hco_list_multi = []
-                y_values_multi = OrderedDict()
+                sources_multi = []
                 y_terms_multi = []
                 for x_term, y_terms in x_y_terms_tuples:
                     # x related
-                    x_vqs = dss[x_term]['_data']
+                    x_vqs = (dss[x_term]['_data'] if data_by_term is None
+                             else data_by_term[x_term])
                     x_field = dss[x_term]['field']
                     # y related
                     y_fields = [dss[y_term]['field'] for y_term in y_terms]
@@ -348,27 +627,31 @@ class Chart(BaseChart):
                                  in y_terms]
                     y_types = [self.series_options[y_term].get('type', 'line')
                                for y_term in y_terms]
-                    y_hco_list = [RecursiveDefaultDict(
-                                    copy.deepcopy(
-                                        self.series_options[y_term])) for
-                                  y_term in y_terms]
-                    for opts, alias, typ in zip(
-                                                y_hco_list,
-                                                y_aliases,
-                                                y_types):
+                    y_hco_list = [SeriesOptions(self.series_options[y_term],
+                                                {'name': alias,
+                                                 'type': typ,
+                                                 'data': []})
+                                  for (y_term, alias, typ) in
+                                  zip(y_terms, y_aliases, y_types)]
+                    for opts in y_hco_list:
                         opts.pop('_x_axis_term')
-                        opts['name'] = alias
-                        opts['type'] = typ
-                        opts['data'] = []
+                        # used only by _downsample()
+                        opts.pop('max_points', None)
+                        opts.pop('downsample', None)
 
                     if ptype == 'scatter' or (ptype == 'line' and
                                               len(x_y_terms_tuples) == 1):
-                        if x_mts:
+                        streamed = isinstance(x_vqs, StreamedData)
+                        if streamed:
+                            data = self._downsample_stream(
+                                x_vqs, x_field, y_fields, y_terms)
+                            if x_mapf:
+                                data = [(x_mapf(x), y) for (x, y) in data]
+                        elif x_mts:
                             if x_mapf:
-                                data = ((x_mapf(_getattr(value_obj, x_field)),
-                                         [_getattr(value_obj, y_field)
-                                          for y_field in y_fields])
-                                        for value_obj in x_vqs)
+                                data = ((x_mapf(x_value), y_values)
+                                        for (x_value, y_values) in
+                                        _x_y_values(x_vqs, x_field, y_fields))
                                 sort_key = ((lambda x_y: x_sortf(x_y[0]))
                                             if x_sortf is not None else None)
                                 data = sorted(data, key=sort_key)
@@ -376,10 +659,7 @@ class Chart(BaseChart):
                             sort_key = ((lambda x_y: x_sortf(x_y[1]))
                                         if x_sortf is not None else None)
                             data = sorted(
-                                    ((_getattr(value_obj, x_field),
-                                     [_getattr(value_obj, y_field)
-                                      for y_field in y_fields])
-                                     for value_obj in x_vqs),
+                                    _x_y_values(x_vqs, x_field, y_fields),
                                     key=sort_key)
                             if x_mapf:
                                 data = [(x_mapf(x), y) for (x, y) in data]
@@ -409,44 +689,28 @@ class Chart(BaseChart):
                                                   (x_axis_num -
                                                    (len(hco_x_axis) -
                                                     1)))
-                            hco_x_axis[x_axis_num]['categories'] = []
-                            for x_value, y_value_tuple in data:
-                                hco_x_axis[x_axis_num]['categories']\
-                                  .append(x_value)
-                                for opts, y_value in zip(y_hco_list,
-                                                         y_value_tuple):
-                                    opts['data'].append(y_value)
+                            if not streamed:
+                                data = self._downsample(
+                                    data, y_terms, hco_x_axis[x_axis_num])
+                            _plot_points(hco_x_axis[x_axis_num], y_hco_list,
+                                         data)
                             self.hcoptions['series'].extend(y_hco_list)
                     else:
-                        data = ((_getattr(value_obj, x_field),
-                                 [_getattr(value_obj, y_field) for y_field in
-                                  y_fields])
-                                for value_obj in x_vqs)
+                        sources_multi.append(
+                            (len(y_terms),
+                             _x_y_values(x_vqs, x_field, y_fields)))
 
                         y_terms_multi.extend(y_terms)
                         y_fields_multi.extend(y_fields)
                         y_aliases_multi.extend(y_aliases)
                         y_types_multi.extend(y_types)
                         y_hco_list_multi.extend(y_hco_list)
-
-                        len_y_terms_multi = len(y_terms_multi)
-                        ext_len = len(y_terms_multi) - len(y_terms)
-                        for x_value, y_value_tuple in data:
-                            try:
-                                cur_y = y_values_multi[x_value]
-                                cur_y.extend(y_value_tuple)
-                            except KeyError:
-                                y_values_multi[x_value] = [None]*ext_len
-                                y_values_multi[x_value].extend(y_value_tuple)
-                        for _y_vals in y_values_multi.values():
-                            if len(_y_vals) != len_y_terms_multi:
-                                _y_vals.extend([None]*len(y_terms))
                 if y_terms_multi:
+                    y_values_multi = _align_x_y_values(sources_multi)
                     hco_x_axis = self.hcoptions['xAxis']
                     if len(hco_x_axis) - 1 < x_axis_num:
                         hco_x_axis.extend([RecursiveDefaultDict({})] *
                                           (x_axis_num - (len(hco_x_axis)-1)))
-                    hco_x_axis[x_axis_num]['categories'] = []
 
                     if x_mts:
                         if x_mapf:
@@ -465,17 +729,17 @@ class Chart(BaseChart):
                         if x_mapf:
                             data = [(x_mapf(x), y) for (x, y) in data]
 
-                    for x_value, y_vals in data:
-                        hco_x_axis[x_axis_num]['categories']\
-                          .append(x_value)
-                        for opts, y_value in zip(y_hco_list_multi, y_vals):
-                            opts['data'].append(y_value)
+                    data = self._downsample(data, y_terms_multi,
+                                            hco_x_axis[x_axis_num])
+                    _plot_points(hco_x_axis[x_axis_num], y_hco_list_multi,
+                                 data)
                     self.hcoptions['series'].extend(y_hco_list_multi)
 
 
 class PivotChart(BaseChart):
 
-    def __init__(self, datasource, series_options, chart_options=None):
+    def __init__(self, datasource, series_options, chart_options=None,
+                 pareto_line=None):
         """Creates the PivotChart object.
 
         **Arguments**:
@@ -573,6 +837,14 @@ class PivotChart(BaseChart):
              Any invalid options are just passed to Highcharts JS which
              silently ignores them.
 
+        - **pareto_line** (*optional*) - ``True`` or a ``dict``. Adds a line
+          series with the cumulative percentage of the ``pareto_term`` of the
+          datasource over the plotted categories, on a new ``yAxis`` from 0
+          to 100 on the opposite side of the chart. A ``dict`` can override
+          any of the options of the series, e.g. ``{'name': 'Share',
+          'color': 'red'}``. Requires a ``PivotDataPool`` with a
+          ``pareto_term``.
+
         **Raises**:
 
         - ``APIInputError`` if any of the terms are not present in the
@@ -587,6 +859,7 @@ class PivotChart(BaseChart):
                                 datasource)
         self.datasource = datasource
         self.series_options = clean_pcso(series_options, self.datasource)
+        self.pareto_line = clean_pareto_line(pareto_line, self.datasource)
         if chart_options is None:
             chart_options = RecursiveDefaultDict({})
         self.set_default_hcoptions()
@@ -626,15 +899,38 @@ class PivotChart(BaseChart):
         hco_series = []
         for term, options in self.series_options.items():
             dss = self.datasource.series
-            for lv in dss[term]['_lv_set']:
-                data = [dss[term]['_cv_lv_dfv'][cv].get(lv, None) for cv
-                        in cv_raw]
+            lvs = list(dss[term]['_lv_set'])
+            if dss[term].get('_matrix') is not None:
+                all_data = dss[term]['_matrix'].series(lvs, cv_raw)
+            else:
+                all_data = ([dss[term]['_cv_lv_dfv'][cv].get(lv, None)
+                             for cv in cv_raw] for lv in lvs)
+            for lv, data in zip(lvs, all_data):
                 term_pretty_name = term.replace('_', ' ')
                 name = term_pretty_name.title() if not lv else "-".join(lv)
-                hco = copy.deepcopy(options)
-                hco['data'] = data
-                hco['name'] = name
-                hco_series.append(hco)
+                hco_series.append(SeriesOptions(options, {'data': data,
+                                                          'name': name}))
+        if self.pareto_line is not None:
+            hco_series.append(self._pareto_series())
         self.hcoptions['series'] = hco_series
         self.hcoptions['xAxis']['categories'] = [':'.join(cv) for cv in
                                                  self.datasource.cv]
+
+    def _pareto_series(self):
+        """Adds a secondary ``yAxis`` and returns the options of the
+        cumulative percentage series on it."""
+        if isinstance(self.hcoptions['yAxis'], dict):
+            self.hcoptions['yAxis'] = [self.hcoptions['yAxis']]
+        y_axes = self.hcoptions['yAxis']
+        y_axes.append(RecursiveDefaultDict({
+            'title': {'text': 'Cumulative %'},
+            'min': 0,
+            'max': 100,
+            'opposite': True}))
+        hco = {'name': 'Cumulative %',
+               'type': 'line',
+               'yAxis': len(y_axes) - 1,
+               'tooltip': {'valueSuffix': '%'}}
+        hco.update(self.pareto_line)
+        hco['data'] = self.datasource.pareto_cum_pct
+        return hco
@@ -0,0 +1,124 @@
+"""
+    Downsampling algorithms used to reduce the number of points of large
+    series before they are sent to the browser.
+
+    All algorithms accept a list of ``(x, y)`` tuples with numeric values,
+    sorted by ``x``, and return a sorted list of the indices of the points
+    which need to be kept.
+"""
+
+
+def lttb(points, threshold):
+    """Largest-Triangle-Three-Buckets. Keeps the first and the last point
+    and from every bucket in between the point which forms the largest
+    triangle with the previously selected point and the average of the next
+    bucket. Preserves the visual shape of the series including its peaks.
+    """
+    length = len(points)
+    if threshold >= length or threshold < 3:
+        return list(range(length))
+
+    every = float(length - 2) / (threshold - 2)
+    a = 0
+    sampled = [a]
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, length)
+        avg_len = avg_end - avg_start
+        avg_x = sum(p[0] for p in points[avg_start:avg_end]) / avg_len
+        avg_y = sum(p[1] for p in points[avg_start:avg_end]) / avg_len
+
+        a_x, a_y = points[a]
+        max_area = -1
+        next_a = None
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((a_x - avg_x) * (points[j][1] - a_y) -
+                       (a_x - points[j][0]) * (avg_y - a_y))
+            if area > max_area:
+                max_area = area
+                next_a = j
+        sampled.append(next_a)
+        a = next_a
+    sampled.append(length - 1)
+    return sampled
+
+
+def min_max(points, threshold):
+    """Splits the points in ``threshold / 2`` buckets and keeps the minimum
+    and the maximum point of every bucket.
+    """
+    length = len(points)
+    buckets = threshold // 2
+    if threshold >= length or buckets < 1:
+        return list(range(length))
+
+    sampled = []
+    for i in range(buckets):
+        bucket = range(i * length // buckets, (i + 1) * length // buckets)
+        lowest = min(bucket, key=lambda j: points[j][1])
+        highest = max(bucket, key=lambda j: points[j][1])
+        sampled.extend(sorted(set([lowest, highest])))
+    return sampled
+
+
+ALGORITHMS = {
+    'lttb': lttb,
+    'minmax': min_max,
+}
+
+
+def downsample(points, threshold, algorithm='lttb'):
+    """Returns the indices of the ``points`` which need to be kept so that
+    at most ``threshold`` points are left.
+    """
+    return ALGORITHMS[algorithm](points, threshold)
+
+
+def min_max_stream(items, length, thresholds):
+    """``min_max()`` for the ``(x, y_values)`` items of a stream of
+    ``length`` items sorted by ``x``, with a threshold for every y value.
+    Returns the items kept for any of the y values, in their order.
+
+    The items are consumed one at a time and only the minimum and the
+    maximum item of the current bucket of every y value are held, besides
+    the items already kept. The buckets are the positions of the items,
+    ``None`` y values are skipped and items beyond ``length`` fall into the
+    last bucket.
+    """
+    series = []
+    for threshold in thresholds:
+        buckets = threshold // 2
+        if threshold >= length or buckets < 1:
+            buckets = None
+        # buckets, current bucket, its end, its (lowest, highest) items
+        series.append([buckets, 0, length // buckets if buckets else None,
+                       None, None])
+    kept = {}
+
+    def close(state):
+        for candidate in state[3:]:
+            if candidate is not None:
+                kept[candidate[1]] = candidate[2]
+        state[3] = state[4] = None
+
+    for position, item in enumerate(items):
+        for i, state in enumerate(series):
+            buckets = state[0]
+            y = item[1][i]
+            if buckets is None:
+                if y is not None:
+                    kept[position] = item
+                continue
+            if position >= state[2] and state[1] < buckets - 1:
+                close(state)
+                state[1] += 1
+                state[2] = (state[1] + 1) * length // buckets
+            if y is None:
+                continue
+            if state[3] is None or y < state[3][0]:
+                state[3] = (y, position, item)
+            if state[4] is None or y > state[4][0]:
+                state[4] = (y, position, item)
+    for state in series:
+        close(state)
+    return [kept[pos] for pos in sorted(kept)]
@@ -0,0 +1,83 @@
+"""
+    Dense category x legend matrices of the data of a ``PivotDataPool``,
+    built with NumPy.
+
+    Category and legend values are encoded as integer codes and the values
+    of a term are scattered into a matrix with one row per legend value and
+    one column per category value, so that the series of a ``PivotChart``
+    are slices of the matrix instead of a dict lookup per point.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+#: matrices with a smaller fraction of values than this are not built, the
+#: data stays in the dicts, which are a sparse representation
+MIN_DENSITY = 0.1
+
+
+class PivotMatrix(object):
+    """The values of a single term. ``matrix[i, j]`` is the value of the
+    ``i``-th legend value and the ``j``-th category value and ``filled[i,
+    j]`` tells whether there is a value at all."""
+
+    def __init__(self, matrix, filled, lv_index, cv_index):
+        self.matrix = matrix
+        self.filled = filled
+        self.lv_index = lv_index
+        self.cv_index = cv_index
+
+    @classmethod
+    def from_dict(cls, cv_lv_dfv, lvs, cv_index, min_density=MIN_DENSITY):
+        """Builds the matrix of the ``_cv_lv_dfv`` dict of a term.
+
+        :Arguments:
+
+        - **cv_lv_dfv** (**required**) - a ``dict`` of category value ->
+          legend value -> value.
+        - **lvs** (**required**) - all legend values of the term.
+        - **cv_index** (**required**) - a ``dict`` of category value -> code
+          of all category values of the ``PivotDataPool``.
+        - **min_density** (*optional*) - the minimum fraction of values.
+
+        :returns:
+
+        - a ``PivotMatrix`` or ``None`` if there are less than
+          ``min_density`` values.
+        """
+        lv_index = dict((lv, i) for i, lv in enumerate(lvs))
+        lv_codes, cv_codes, values = [], [], []
+        for cv, lv_dfv in cv_lv_dfv.items():
+            cv_code = cv_index[cv]
+            for lv, dfv in lv_dfv.items():
+                lv_codes.append(lv_index[lv])
+                cv_codes.append(cv_code)
+                values.append(dfv)
+        shape = (len(lv_index), len(cv_index))
+        if not values or len(values) < min_density * shape[0] * shape[1]:
+            return None
+        # ints, floats or objects, e.g. Decimal, dates or None
+        values = numpy.array(values)
+        matrix = numpy.empty(shape, dtype=values.dtype)
+        filled = numpy.zeros(shape, dtype=bool)
+        matrix[lv_codes, cv_codes] = values
+        filled[lv_codes, cv_codes] = True
+        return cls(matrix, filled, lv_index, cv_index)
+
+    def series(self, lvs, cvs):
+        """Yields the list of values of every legend value in ``lvs``, for
+        the category values ``cvs`` and with ``None`` for missing values."""
+        columns = [self.cv_index[cv] for cv in cvs]
+        matrix = self.matrix[:, columns]
+        filled = self.filled[:, columns]
+        for lv in lvs:
+            i = self.lv_index[lv]
+            if filled[i].all():
+                yield matrix[i].tolist()
+            else:
+                row = matrix[i].astype(object)
+                row[~filled[i]] = None
+                yield row.tolist()
@@ -0,0 +1,106 @@
+"""
+    JSON serialization of the Highcharts options of charts, shared by
+    ``BaseChart.to_json()`` and the ``{% load_charts %}`` template tag.
+
+    The options are converted to JSON-native types first, a whole column
+    at a time where possible, so that the JSON encoder doesn't need to call
+    back into Python for every ``Decimal`` or date. They are then encoded
+    with ``orjson`` or ``ujson`` when installed, or with the standard
+    ``json`` module otherwise. The ``CHARTIT_JSON_BACKEND`` setting selects
+    one of ``'orjson'``, ``'ujson'`` or ``'json'`` explicitly.
+"""
+
+import json
+from array import array
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils import six
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# types which all JSON encoders handle natively
+_NATIVE_TYPES = frozenset((six.text_type, str, float, bool, type(None)) +
+                          six.integer_types)
+_DECIMAL = frozenset([Decimal])
+
+
+def to_native(obj):
+    """Converts ``obj`` into ``dict``, ``list``, string, number, ``bool``
+    and ``None`` objects. ``Decimal`` objects become floats and dates,
+    datetimes and times their ISO 8601 format, like the previous
+    ``json_serializer()``. Lists whose values are all JSON-native are
+    returned as they are."""
+    if type(obj) in _NATIVE_TYPES:
+        return obj
+    if isinstance(obj, dict):
+        return dict((k if isinstance(k, six.string_types)
+                     else six.text_type(k), to_native(v))
+                    for (k, v) in obj.items())
+    if isinstance(obj, (list, tuple, array)):
+        types = set(map(type, obj))
+        if types <= _NATIVE_TYPES:
+            return obj if isinstance(obj, list) else list(obj)
+        if types == _DECIMAL:
+            return list(map(float, obj))
+        if types <= _NATIVE_TYPES | _DECIMAL:
+            # e.g. the values of a DecimalField, with gaps
+            return [float(v) if type(v) is Decimal else v for v in obj]
+        return [to_native(value) for value in obj]
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    if hasattr(obj, 'tolist'):
+        # NumPy arrays and scalars
+        return to_native(obj.tolist())
+    return obj
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj).decode('utf-8')
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj)
+
+
+def _json_dumps(obj):
+    return json.dumps(obj)
+
+
+_BACKENDS = {'orjson': _orjson_dumps, 'ujson': _ujson_dumps,
+             'json': _json_dumps}
+
+
+def backend():
+    """Returns the name of the JSON encoder used by ``dumps()``."""
+    name = getattr(settings, 'CHARTIT_JSON_BACKEND', None)
+    if name is None:
+        if orjson is not None:
+            return 'orjson'
+        if ujson is not None:
+            return 'ujson'
+        return 'json'
+    if name not in _BACKENDS:
+        raise ValueError("CHARTIT_JSON_BACKEND must be one of: %s. Got %s "
+                         "instead." % (', '.join(sorted(_BACKENDS)), name))
+    if name != 'json' and globals()[name] is None:
+        raise ImportError("CHARTIT_JSON_BACKEND is %s but it isn't "
+                          "installed." % name)
+    return name
+
+
+def dumps(obj):
+    """Returns the JSON representation of ``obj``, e.g. of the
+    ``hcoptions`` of a chart, as a string."""
+    return _BACKENDS[backend()](to_native(obj))
@@ -2,9 +2,7 @@
     Implements the {% load_charts %} template tag!
 """
 
-import json
 import posixpath
-from decimal import Decimal
 
 from django import template
 from django.utils.safestring import mark_safe
@@ -12,6 +10,7 @@ from django.utils import six
 from django.conf import settings
 
 from ..charts import Chart, PivotChart
+from ..serialization import dumps, to_native
 
 try:
     CHARTIT_JS_REL_PATH = settings.CHARTIT_JS_REL_PATH
@@ -28,13 +27,10 @@ CHART_LOADER_URL = posixpath.join(settings.STATIC_URL,
 def json_serializer(obj):
     """
         Return JSON representation of some special data types.
+        Kept for ``json.dumps(..., default=json_serializer)``, the template
+        tag uses ``chartit.serialization.dumps()``.
     """
-    if hasattr(obj, 'isoformat'):
-        return obj.isoformat()
-    elif isinstance(obj, Decimal):
-        return float(obj)
-    else:
-        return obj
+    return to_native(obj)
 
 
 register = template.Library()
@@ -84,9 +80,7 @@ def load_charts(chart_list=None, render_to=''):
                 chart_list, render_to_list):
             if render_to:
                 hco['chart']['renderTo'] = render_to
-        embed_script = (embed_script % (json.dumps(chart_list,
-                                                   default=json_serializer),
-                                        CHART_LOADER_URL))
+        embed_script = embed_script % (dumps(chart_list), CHART_LOADER_URL)
     else:
         embed_script = embed_script % ((), CHART_LOADER_URL)
     return mark_safe(embed_script)
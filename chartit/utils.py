@@ -2,8 +2,11 @@
     utility and helper functions.
 """
 
+import copy
 from functools import reduce
 
+from django.core.exceptions import FieldDoesNotExist
+
 
 def _getattr(obj, attr):
     """Recurses through an attribute chain to get the ultimate value."""
@@ -19,19 +22,142 @@ def _getattr(obj, attr):
     return value
 
 
+def _lookup_models(model, lookup):
+    """Returns ``model`` and all related models reached while following the
+    ``__`` separated field ``lookup``."""
+    models = [model]
+    for name in lookup.split('__'):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            # model properties, annotations, etc.
+            break
+        if not field.is_relation or field.related_model is None:
+            break
+        model = field.related_model
+        models.append(model)
+    return models
+
+
+def _related_plan(model, lookup, query):
+    """Returns a ``(select_related, prefetch_related, only)`` tuple of sets
+    of the lookups needed to follow the ``__`` separated ``lookup`` on model
+    instances without querying the database for every instance. ``only`` is
+    ``None`` if all fields of ``model`` are needed, e.g. by a model property.
+    """
+    select, prefetch, only = set(), set(), set()
+    if lookup in query.annotations or lookup in query.extra:
+        return select, prefetch, only
+    path = []
+    prefetching = False
+    for name in lookup.split('__'):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            field = None
+        if field is None or not field.is_relation:
+            if prefetching:
+                pass
+            elif field is not None:
+                only.add('__'.join(path + [name]))
+            elif path:
+                # a property of a related model can use any of its fields
+                only.add('__'.join(path))
+            else:
+                only = None
+            break
+        if field.auto_created and not field.concrete and \
+                field.get_accessor_name() != name:
+            # reverse relations are followed by their accessor, not the name
+            # of the lookup, so the lookup can't be followed on instances
+            break
+        path.append(name)
+        if not prefetching and field.related_model is not None and \
+                (field.many_to_one or field.one_to_one):
+            select.add('__'.join(path))
+        else:
+            # generic foreign keys, many-to-many and reverse foreign keys
+            if not prefetching:
+                # the instances the relation starts from need all fields
+                if len(path) == 1:
+                    only = None
+                else:
+                    only.add('__'.join(path[:-1]))
+            prefetching = True
+            prefetch.add('__'.join(path))
+        model = field.related_model
+        if model is None:
+            break
+    else:
+        # the related object itself is the value
+        if not prefetching:
+            only.add('__'.join(path))
+    return select, prefetch, only
+
+
+def _select_related(queryset, lookups):
+    """Returns ``queryset`` with ``select_related()``, ``prefetch_related()``
+    and ``only()`` applied so that the ``lookups`` can be followed on its
+    model instances with a constant number of queries."""
+    select, prefetch, only = set(), set(), set()
+    for lookup in lookups:
+        s, p, o = _related_plan(queryset.model, lookup, queryset.query)
+        select.update(s)
+        prefetch.update(p)
+        only = None if only is None or o is None else only | o
+    # don't override what the queryset asked for explicitly
+    if select and queryset.query.select_related is not True:
+        queryset = queryset.select_related(*sorted(select))
+    if prefetch:
+        queryset = queryset.prefetch_related(*sorted(prefetch))
+    if only and not queryset.query.deferred_loading[0]:
+        queryset = queryset.only(*sorted(only))
+    return queryset
+
+
+def _then(future, fn):
+    """Returns an ``asyncio`` future which resolves to
+    ``fn(future.result())`` once ``future`` is done."""
+    import asyncio
+    result = asyncio.get_event_loop().create_future()
+
+    def _done(future):
+        if result.cancelled():
+            return
+        if future.cancelled():
+            result.cancel()
+            return
+        try:
+            result.set_result(fn(future.result()))
+        except Exception as exc:  # pylint: disable=broad-except
+            result.set_exception(exc)
+
+    future.add_done_callback(_done)
+    return result
+
+
+#: options whose values are data, e.g. the points of a series or the
+#: categories of an axis, and are stored as they are
+_PAYLOAD_KEYS = frozenset(['data', 'categories'])
+
+
 def _convert_to_rdd(obj):
     """Accepts a dict or a list of dicts and converts it to a
-    RecursiveDefaultDict."""
+    RecursiveDefaultDict. Lists which don't contain dicts or lists are
+    returned as they are."""
+    if isinstance(obj, SeriesOptions):
+        # already converted, its base must not be copied
+        return obj
     if isinstance(obj, dict):
         rdd = RecursiveDefaultDict()
         for k, v in obj.items():
-            rdd[k] = _convert_to_rdd(v)
+            dict.__setitem__(rdd, k, v if k in _PAYLOAD_KEYS
+                             else _convert_to_rdd(v))
         return rdd
     elif isinstance(obj, list):
-        rddlst = []
-        for ob in obj:
-            rddlst.append(_convert_to_rdd(ob))
-        return rddlst
+        if not any(isinstance(ob, (dict, list)) for ob in obj):
+            return obj
+        return [_convert_to_rdd(ob) for ob in obj]
     else:
         return obj
 
@@ -40,29 +166,88 @@ class RecursiveDefaultDict(dict):
     """
         Behaves exactly the same as a collections.defaultdict
         but works with pickle.loads. Fixes #10.
+
+        Assigned dicts are converted into RecursiveDefaultDicts, except the
+        values of ``data`` and ``categories`` which are stored as they are.
     """
     def __init__(self, data=None):
-        if data is not None:
-            self.data = _convert_to_rdd(data)
-            self.update(self.data)
-            del self.data
+        if data:
+            self.update(data)
 
-    def __getitem__(self, key):
+    def __missing__(self, key):
         # create a default object if this key
         # isn't in the dictionary
-        if key not in self.keys():
-            item = self.__class__()
-            self[key] = item
-            return item
-        else:
-            return super(RecursiveDefaultDict, self).__getitem__(key)
+        item = RecursiveDefaultDict()
+        dict.__setitem__(self, key, item)
+        return item
 
     def __setitem__(self, key, item):
-        if not isinstance(item, RecursiveDefaultDict):
-            super(RecursiveDefaultDict, self).__setitem__(
-                key, _convert_to_rdd(item))
-        else:
-            super(RecursiveDefaultDict, self).__setitem__(key, item)
+        if not (key in _PAYLOAD_KEYS or
+                isinstance(item, RecursiveDefaultDict)):
+            item = _convert_to_rdd(item)
+        super(RecursiveDefaultDict, self).__setitem__(key, item)
+
+    def update(self, element):
+        for k, v in dict(element).items():
+            dict.__setitem__(self, k, v if k in _PAYLOAD_KEYS
+                             else _convert_to_rdd(v))
+
+
+class SeriesOptions(RecursiveDefaultDict):
+    """
+        The Highcharts options of a single series: the options of its term,
+        shared by all series of the term, overlaid with the options of the
+        series like ``name`` and ``data``.
+
+        Only the top level of ``base`` is copied. Its nested dicts and lists
+        are copied the first time they are accessed, so ``base`` is never
+        modified and the series which don't touch them, i.e. nearly all of
+        them, are serialized straight from the shared values.
+    """
+    def __init__(self, base=None, overlay=None):
+        super(SeriesOptions, self).__init__()
+        if base:
+            dict.update(self, base)
+            self._shared = set(k for (k, v) in base.items()
+                               if isinstance(v, (dict, list)))
+        if overlay:
+            self.update(overlay)
+
+    def _own(self, key):
+        """Replaces the value of ``key`` with a copy if it is shared."""
+        shared = self.__dict__.get('_shared')
+        if shared and key in shared:
+            shared.discard(key)
+            dict.__setitem__(self, key, _convert_to_rdd(
+                copy.deepcopy(dict.__getitem__(self, key))))
+
+    def __getitem__(self, key):
+        self._own(key)
+        return super(SeriesOptions, self).__getitem__(key)
+
+    def __setitem__(self, key, item):
+        shared = self.__dict__.get('_shared')
+        if shared:
+            shared.discard(key)
+        super(SeriesOptions, self).__setitem__(key, item)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def get(self, key, default=None):
+        self._own(key)
+        return super(SeriesOptions, self).get(key, default)
+
+    def pop(self, key, *default):
+        self._own(key)
+        return super(SeriesOptions, self).pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        self._own(key)
+        return super(SeriesOptions, self).setdefault(key, default)
 
     def update(self, element):
-        super(RecursiveDefaultDict, self).update(_convert_to_rdd(element))
+        shared = self.__dict__.get('_shared')
+        if shared:
+            shared.difference_update(element)
+        super(SeriesOptions, self).update(element)
@@ -4,7 +4,10 @@
 """
 
 import copy
+from collections import OrderedDict
+from itertools import chain
 
+from django.core.exceptions import FieldError
 from django.db.models.aggregates import Aggregate
 from django.db.models.base import ModelBase
 from django.db.models.manager import Manager
@@ -12,7 +15,11 @@ from django.db.models.query import QuerySet, RawQuerySet
 from django.db.models.sql.query import RawQuery
 from django.utils import six
 
+from .buckets import Bucket
+from .cache import ChartDataCache
+from .downsampling import ALGORITHMS
 from .exceptions import APIInputError
+from .matrix import numpy
 
 
 def get_all_field_names(meta):
@@ -106,6 +113,20 @@ def _clean_source(source):
                         % (source, type(source)))
 
 
+def _annotate_buckets(source, buckets):
+    """Annotates the ``source`` with the expressions of the ``buckets``, an
+    ``OrderedDict`` of names and ``Bucket`` objects."""
+    source = _clean_source(source)
+    if isinstance(source, RawQuerySet):
+        raise APIInputError("Bucket can't be used with a RawQuerySet. Got %s."
+                            % ', '.join(buckets))
+    try:
+        return source.annotate(**OrderedDict(
+            (name, bucket.expression()) for (name, bucket) in buckets.items()))
+    except (FieldError, ValueError) as e:
+        raise APIInputError("Can't bucket %s: %s" % (', '.join(buckets), e))
+
+
 def _validate_func(func):
     if not isinstance(func, Aggregate):
         raise APIInputError("'func' must an instance of django Aggregate. "
@@ -158,6 +179,22 @@ def _validate_top_n_per_cat(top_n_per_cat):
                             % (top_n_per_cat, type(top_n_per_cat)))
 
 
+def _clean_rollup(rollup):
+    """Returns the label of the subtotal categories or ``None`` if there
+    aren't any."""
+    if rollup is None or rollup is False:
+        return None
+    if not hasattr(QuerySet, 'union'):
+        raise APIInputError("'rollup' requires Django 1.11 or newer.")
+    if rollup is True:
+        return u'Total'
+    if isinstance(rollup, six.string_types):
+        return rollup
+    raise APIInputError("'rollup' must be a bool or the label of the "
+                        "subtotals. Got %s of type %s instead."
+                        % (rollup, type(rollup)))
+
+
 def _clean_field_aliases(fa_actual, fa_cat, fa_lgby):
     fa = copy.copy(fa_lgby)
     fa.update(fa_cat)
@@ -190,7 +227,7 @@ def _convert_pdps_to_dict(series_list):
                 else:
                     raise APIInputError("Expecting a dict or django Aggregate "
                                         "in place of: %s" % tv)
-                opts = copy.deepcopy(options)
+                opts = dict(options)
                 opts.update(tv)
                 series_dict.update({tk: opts})
         else:
@@ -223,6 +260,16 @@ def clean_pdps(series):
             except KeyError:
                 raise APIInputError("Missing 'func': %s" % td)
             # categories
+            categories = td.get('categories')
+            if isinstance(categories, Bucket):
+                categories = [categories]
+            if isinstance(categories, (tuple, list)):
+                buckets = OrderedDict((c.name, c) for c in categories
+                                      if isinstance(c, Bucket))
+                if buckets:
+                    td['source'] = _annotate_buckets(td['source'], buckets)
+                    td['categories'] = [c.name if isinstance(c, Bucket)
+                                        else c for c in categories]
             try:
                 td['categories'], fa_cat = _clean_categories(td['categories'],
                                                              td['source'])
@@ -239,6 +286,9 @@ def clean_pdps(series):
                 _validate_top_n_per_cat(td['top_n_per_cat'])
             except KeyError:
                 td['top_n_per_cat'] = 0
+            # rollup
+            if 'rollup' in td:
+                td['rollup'] = _clean_rollup(td['rollup'])
             # field_aliases
             try:
                 fa_actual = td['field_aliases']
@@ -253,6 +303,20 @@ def clean_pdps(series):
     return series
 
 
+def _bucket_terms(terms):
+    """Returns an ``OrderedDict`` of the names and the ``Bucket`` objects in
+    the DataPool ``terms``."""
+    if isinstance(terms, dict):
+        items = terms.items()
+    elif isinstance(terms, list):
+        items = chain.from_iterable(term.items() for term in terms
+                                    if isinstance(term, dict))
+    else:
+        items = ()
+    return OrderedDict((tk, tv) for (tk, tv) in items
+                       if isinstance(tv, Bucket))
+
+
 def _convert_dps_to_dict(series_list):
     series_list = copy.deepcopy(series_list)
     series_dict = {}
@@ -270,18 +334,31 @@ def _convert_dps_to_dict(series_list):
             terms = sd['terms']
         except KeyError:
             raise APIInputError("%s is missing the 'terms' key." % sd)
+        buckets = _bucket_terms(terms)
+        if buckets:
+            # all terms of the series need to share the annotated source
+            options = dict(options, source=_annotate_buckets(
+                options.get('source'), buckets))
         if isinstance(terms, list):
             for term in terms:
                 if isinstance(term, six.string_types):
-                    series_dict[term] = copy.deepcopy(options)
+                    series_dict[term] = dict(options)
                 elif isinstance(term, dict):
                     for tk, tv in term.items():
                         if isinstance(tv, six.string_types):
-                            opts = copy.deepcopy(options)
+                            opts = dict(options)
                             opts['field'] = tv
                             series_dict[tk] = opts
+                        elif isinstance(tv, Aggregate):
+                            opts = dict(options)
+                            opts['func'] = tv
+                            series_dict[tk] = opts
+                        elif isinstance(tv, Bucket):
+                            opts = dict(options)
+                            opts['field'] = tk
+                            series_dict[tk] = opts
                         elif isinstance(tv, dict):
-                            opts = copy.deepcopy(options)
+                            opts = dict(options)
                             opts.update(tv)
                             series_dict[tk] = opts
                         else:
@@ -291,23 +368,31 @@ def _convert_dps_to_dict(series_list):
                     t, fn = term
                     if isinstance(t, dict):
                         for tk, tv in t.items():
-                            opt = copy.deepcopy(options)
+                            opt = dict(options)
                             opt['fn'] = fn
                             opt['field'] = tv
                             series_dict[tk] = opt
                     else:
-                        opt = copy.deepcopy(options)
+                        opt = dict(options)
                         opt['fn'] = fn
                         series_dict[t] = opt
 
         elif isinstance(terms, dict):
             for tk, tv in terms.items():
                 if isinstance(tv, six.string_types):
-                    opts = copy.deepcopy(options)
+                    opts = dict(options)
                     opts['field'] = tv
                     series_dict[tk] = opts
+                elif isinstance(tv, Aggregate):
+                    opts = dict(options)
+                    opts['func'] = tv
+                    series_dict[tk] = opts
+                elif isinstance(tv, Bucket):
+                    opts = dict(options)
+                    opts['field'] = tk
+                    series_dict[tk] = opts
                 elif isinstance(tv, dict):
-                    opts = copy.deepcopy(options)
+                    opts = dict(options)
                     opts.update(tv)
                     series_dict[tk] = opts
                 else:
@@ -319,6 +404,36 @@ def _convert_dps_to_dict(series_list):
     return series_dict
 
 
+def _clean_group_by(tk, td):
+    """Clean the aggregate and the ``group_by`` fields of a DataPool term."""
+    source = td['source']
+    group_by = td.get('group_by') or []
+    if isinstance(group_by, six.string_types):
+        group_by = [group_by]
+    if not isinstance(group_by, (list, tuple)):
+        raise APIInputError("'group_by' must be a str or a list. Got %s of "
+                            "type %s instead." % (group_by, type(group_by)))
+    if isinstance(source, RawQuerySet):
+        raise APIInputError("'group_by' and aggregates can't be used with a "
+                            "RawQuerySet. Got %s." % tk)
+    for field in group_by:
+        _validate_field_lookup_term(source.model, field, source.query)
+    if 'func' in td:
+        _validate_func(td['func'])
+        if not group_by:
+            raise APIInputError("%s is an aggregate. The fields to group "
+                                "by must be specified in 'group_by'." % tk)
+        if tk in get_all_field_names(source.model._meta):
+            raise APIInputError("The aggregate %s conflicts with a field of "
+                                "%s. Use another name." % (tk, source.model))
+        td['field'] = tk
+    elif group_by and td.get('field', tk) not in group_by:
+        raise APIInputError("%s must either be an aggregate or one of the "
+                            "'group_by' fields: %s."
+                            % (tk, ', '.join(group_by)))
+    td['group_by'] = list(group_by)
+
+
 def clean_dps(series):
     """Clean the DataPool series input from the user.
     """
@@ -330,9 +445,16 @@ def clean_dps(series):
                 td['source'] = _clean_source(td['source'])
             except KeyError:
                 raise APIInputError("%s is missing the 'source' key." % td)
+            if 'group_by' in td or 'func' in td:
+                _clean_group_by(tk, td)
             td.setdefault('field', tk)
-            fa = _validate_field_lookup_term(td['source'].model, td['field'],
-                                             td['source'].query)
+            if 'func' in td:
+                # the aggregate is annotated with the name of the term
+                fa = tk
+            else:
+                fa = _validate_field_lookup_term(td['source'].model,
+                                                 td['field'],
+                                                 td['source'].query)
             # If the user supplied term is not a field name, use it as an alias
             if tk != td['field']:
                 fa = tk
@@ -346,6 +468,98 @@ def clean_dps(series):
     return series
 
 
+def clean_columnar_chunk_size(columnar, chunk_size):
+    """Clean the DataPool storage options."""
+    if chunk_size is not None:
+        if not isinstance(chunk_size, int) or chunk_size < 1:
+            raise APIInputError("'chunk_size' must be a positive int. Got %s "
+                                "of type %s instead."
+                                % (chunk_size, type(chunk_size)))
+        if columnar:
+            raise APIInputError("'columnar' and 'chunk_size' can't be used "
+                                "together.")
+    return bool(columnar), chunk_size
+
+
+def clean_max_workers(max_workers):
+    """Clean the maximum number of threads used to execute queries."""
+    if max_workers is None:
+        return 1
+    if not isinstance(max_workers, int) or max_workers < 1:
+        raise APIInputError("'max_workers' must be a positive int. Got %s of "
+                            "type %s instead."
+                            % (max_workers, type(max_workers)))
+    return max_workers
+
+
+def clean_cache(cache):
+    """Clean the cache used to store the retrieved data."""
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return ChartDataCache()
+    if not isinstance(cache, ChartDataCache):
+        raise APIInputError("'cache' must be True or a ChartDataCache. Got "
+                            "%s of type %s instead." % (cache, type(cache)))
+    return cache
+
+
+def clean_dense(dense):
+    """Clean the flag which stores the pivoted data in NumPy matrices."""
+    if dense and numpy is None:
+        raise APIInputError("'dense' requires NumPy to be installed.")
+    return bool(dense)
+
+
+def clean_pareto_line(pareto_line, ds):
+    """Clean the options of the cumulative percentage series of a
+    ``PivotChart``."""
+    if pareto_line is None or pareto_line is False:
+        return None
+    if ds.pareto_term is None:
+        raise APIInputError("'pareto_line' requires a PivotDataPool with a "
+                            "'pareto_term'.")
+    if pareto_line is True:
+        return {}
+    if not isinstance(pareto_line, dict):
+        raise APIInputError("'pareto_line' must be a bool or a dict. Got %s "
+                            "of type %s instead."
+                            % (pareto_line, type(pareto_line)))
+    return pareto_line
+
+
+def clean_incremental_on(incremental_on, series, chunk_size):
+    """Clean the field used as the high-water mark of incremental
+    refreshes."""
+    if incremental_on is None:
+        return None
+    if not isinstance(incremental_on, six.string_types):
+        raise APIInputError("'incremental_on' must be a field name. Got %s "
+                            "of type %s instead."
+                            % (incremental_on, type(incremental_on)))
+    if chunk_size is not None:
+        raise APIInputError("'incremental_on' and 'chunk_size' can't be "
+                            "used together.")
+    for td in series.values():
+        source = td['source']
+        if isinstance(source, RawQuerySet) or not source.query.can_filter():
+            raise APIInputError("'incremental_on' requires sources which "
+                                "can be filtered. %s is a RawQuerySet or "
+                                "has been sliced." % source)
+        try:
+            source.filter(**{incremental_on + '__isnull': True})
+        except FieldError:
+            raise APIInputError("%s is not a valid field of %s."
+                                % (incremental_on, source.model))
+        group_by = td.get('group_by')
+        if group_by and incremental_on not in group_by:
+            raise APIInputError("'incremental_on' must be one of the "
+                                "'group_by' fields %s, otherwise new rows "
+                                "change groups retrieved before. Got %s "
+                                "instead." % (group_by, incremental_on))
+    return incremental_on
+
+
 def _convert_pcso_to_dict(series_options):
     series_options_dict = {}
     for stod in series_options:
@@ -363,14 +577,14 @@ def _convert_pcso_to_dict(series_options):
         if isinstance(terms, list):
             for term in terms:
                 if isinstance(term, six.string_types):
-                    opts = copy.deepcopy(options)
+                    opts = dict(options)
                     series_options_dict.update({term: opts})
                 elif isinstance(term, dict):
                     for tk, tv in term.items():
                         if not isinstance(tv, dict):
                             raise APIInputError("Expecting a dict in place "
                                                 "of: %s" % tv)
-                        opts = copy.deepcopy(options)
+                        opts = dict(options)
                         opts.update(tv)
                         series_options_dict.update({tk: opts})
         else:
@@ -426,11 +640,11 @@ def _convert_cso_to_dict(series_options):
                 if isinstance(td, list):
                     for yterm in td:
                         if isinstance(yterm, six.string_types):
-                            opts = copy.deepcopy(options)
+                            opts = dict(options)
                             opts['_x_axis_term'] = tk
                             series_options_dict[yterm] = opts
                         elif isinstance(yterm, dict):
-                            opts = copy.deepcopy(options)
+                            opts = dict(options)
                             opts.update(list(yterm.values())[0])
                             opts['_x_axis_term'] = tk
                             series_options_dict[list(yterm.keys())[0]] = opts
@@ -447,6 +661,22 @@ def _convert_cso_to_dict(series_options):
     return series_options_dict
 
 
+def _validate_downsampling(sod):
+    max_points = sod.get('max_points')
+    if max_points is not None:
+        if not isinstance(max_points, int) or max_points < 3:
+            raise APIInputError("'max_points' must be an int greater than 2. "
+                                "Got %s of type %s instead."
+                                % (max_points, type(max_points)))
+        if sod.get('type') in ('scatter', 'pie'):
+            raise APIInputError("'max_points' is not supported by %s "
+                                "series." % sod['type'])
+    algorithm = sod.get('downsample', 'lttb')
+    if algorithm not in ALGORITHMS:
+        raise APIInputError("'downsample' must be one of: %s. Got %s instead."
+                            % (', '.join(sorted(ALGORITHMS)), algorithm))
+
+
 def clean_cso(series_options, ds):
     """Clean the Chart series_options input from the user.
     """
@@ -470,9 +700,10 @@ def clean_cso(series_options, ds):
                                          ', '.join(ds.series.keys())))
             except KeyError:
                 raise APIInputError("Expecting a '_x_axis_term' for %s." % sod)
-            if ds.series[sok]['_data'] != ds.series[_x_axis_term]['_data']:
+            if not ds._same_query_group(sok, _x_axis_term):
                 raise APIInputError("%s and %s do not belong to the same "
                                     "table." % (sok, _x_axis_term))
+            _validate_downsampling(sod)
     elif isinstance(series_options, list):
         series_options = _convert_cso_to_dict(series_options)
         clean_cso(series_options, ds)
@@ -520,3 +751,47 @@ def clean_x_sortf_mapf_mts(x_sortf_mapf_mts):
         x_mts = bool(x_s_m_mts[2])
         cleaned_x_s_m_mts.append((x_sortf, x_mapf, x_mts))
     return cleaned_x_s_m_mts
+
+
+def clean_streamed_cso(series_options, ds, x_sortf_mapf_mts):
+    """Clean the Chart series_options and x_sortf_mapf_mts for a DataPool
+    with a chunk_size, whose rows are ordered by the x-axis term in the
+    database and downsampled with min/max buckets while they are streamed.
+    """
+    if not ds.chunk_size:
+        return
+    for (x_sortf, _, x_mts) in x_sortf_mapf_mts:
+        if x_sortf is not None or x_mts:
+            raise APIInputError("The x values of a DataPool with a "
+                                "'chunk_size' are sorted by the database. "
+                                "Got a sort function or mts=True in %s."
+                                % (x_sortf_mapf_mts,))
+    x_axis_terms = {}
+    for sok, sod in series_options.items():
+        if sod.get('max_points') is None:
+            raise APIInputError("%s needs 'max_points' to be streamed from a "
+                                "DataPool with a 'chunk_size'." % sok)
+        if sod.get('downsample', 'minmax') != 'minmax':
+            raise APIInputError("Series streamed from a DataPool with a "
+                                "'chunk_size' are downsampled with "
+                                "'minmax'. Got %s for %s instead."
+                                % (sod['downsample'], sok))
+        x_term = sod['_x_axis_term']
+        x_td = ds.series[x_term]
+        source = x_td['source']
+        if isinstance(source, RawQuerySet) or not source.query.can_filter():
+            raise APIInputError("The rows can't be ordered by %s in the "
+                                "database. Its source is a RawQuerySet or "
+                                "has been sliced." % x_term)
+        try:
+            source.values(x_td['field'])
+        except FieldError:
+            raise APIInputError("The rows can't be ordered by %s in the "
+                                "database. %s is not a field of %s."
+                                % (x_term, x_td['field'], source.model))
+        other_x_term = x_axis_terms.setdefault(sod.get('xAxis', 0), x_term)
+        if not ds._same_query_group(x_term, other_x_term):
+            raise APIInputError("%s and %s are plotted on the same x-axis "
+                                "but don't belong to the same table, which "
+                                "isn't supported for a DataPool with a "
+                                "'chunk_size'." % (x_term, other_x_term))
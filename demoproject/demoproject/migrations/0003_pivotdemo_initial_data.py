@@ -2,10 +2,11 @@
 from __future__ import unicode_literals
 import os
 import json
+from django.core.management.color import no_style
 from django.db import migrations
 
 
-def initial_data(apps, _):
+def initial_data(apps, schema_editor):
     path = os.path.abspath(os.path.dirname(__file__))
     path = os.path.join(path, 'pivotdemo.json')
 
@@ -81,6 +82,16 @@ def initial_data(apps, _):
         obj.pk = record['pk']
         obj.save()
 
+    # the primary keys were set explicitly, so databases with sequences
+    # like PostgreSQL need them reset before more objects are created
+    connection = schema_editor.connection
+    models = [apps.get_model("demoproject", name) for name in
+              set(record['model'] for record in data)]
+    models.extend([BookAuthors, BookRelated])
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
+
 
 class Migration(migrations.Migration):
 
@@ -1,14 +1,34 @@
+import json
+from decimal import Decimal
+import pickle
 import sys
+from array import array
+from collections import defaultdict, OrderedDict
+from datetime import date, datetime, time, timedelta
+from operator import itemgetter
+from unittest import skipIf, skipUnless
+import pytz
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase, override_settings
-from django.db.models import Avg, Sum
+from django.test.utils import CaptureQueriesContext
+from django.db.models import Avg, Count, Max, Sum
+from django.db.models.signals import post_save, post_delete, m2m_changed
 
 from chartit import PivotDataPool, DataPool, Chart, PivotChart
+from chartit import buckets, chartdata, charts, downsampling, matrix, \
+    serialization, Bucket
+from chartit import cache as chartit_cache
+from chartit.cache import ChartDataCache, dependencies
+from chartit.chartdata import ColumnData, StreamedData
+from chartit.utils import _getattr, _select_related, SeriesOptions, \
+    RecursiveDefaultDict
 from chartit.exceptions import APIInputError
 from chartit.templatetags import chartit
 from chartit.validation import clean_pdps, clean_dps, clean_pcso, clean_cso
 
 from demoproject.models import SalesHistory, MonthlyWeatherByCity, \
-    MonthlyWeatherSeattle
+    MonthlyWeatherSeattle, DailyWeather, Author, Book, BookStore, City, Genre
 from utils import assertOptionDictsEqual
 
 TestCase.assertOptionDictsEqual = assertOptionDictsEqual
@@ -1639,6 +1659,8 @@ class BadChartOptionsTests(TestCase):
         self.assertRaises(APIInputError, clean_cso, so_input, self.ds)
 
 
+# the assertions match the formatting of the json module
+@override_settings(CHARTIT_JSON_BACKEND='json')
 class ChartitTemplateTagTests(TestCase):
 
     def test_load_charts_with_None_chart(self):
@@ -1868,3 +1890,1840 @@ class ChartitJSRelPathTests(TestCase):
         self.assertIn('<script type="text/javascript">', html)
         self.assertIn('var _chartit_hco_array = ();', html)
         self.assertIn('<script src="/static/chartit/js/chartloader.js" type="text/javascript">', html) # noqa
+
+
+class LazyDataPoolTests(TestCase):
+
+    def setUp(self):
+        self.series = [{
+            'options': {
+                'source': SalesHistory.objects.all()
+            },
+            'terms': ['sale_date', 'sale_qty']
+        }]
+        self.series_options = [{
+            'options': {
+                'type': 'line'
+            },
+            'terms': {
+                'sale_date': ['sale_qty']
+            }
+        }]
+
+    def test_lazy_pool_does_not_query_on_init(self):
+        with self.assertNumQueries(0):
+            ds = DataPool(series=self.series, lazy=True)
+        with self.assertNumQueries(1):
+            Chart(datasource=ds, series_options=self.series_options)
+
+    def test_lazy_pool_produces_same_chart(self):
+        eager = Chart(datasource=DataPool(series=self.series),
+                      series_options=self.series_options)
+        lazy = Chart(datasource=DataPool(series=self.series, lazy=True),
+                     series_options=self.series_options)
+        self.assertEqual(eager.hcoptions, lazy.hcoptions)
+
+    def test_invalid_lazy_pool_raises_on_init(self):
+        series = [{
+            'options': {
+                'source': SalesHistory.objects.all()
+            },
+            'terms': ['no_such_field']
+        }]
+        self.assertRaises(APIInputError, DataPool, series=series, lazy=True)
+
+
+class ColumnarDataPoolTests(TestCase):
+
+    def assertSameChart(self, series, series_options):
+        rows = Chart(datasource=DataPool(series=series),
+                     series_options=series_options)
+        columns = Chart(datasource=DataPool(series=series, columnar=True),
+                        series_options=series_options)
+        # the order of the sources may differ under Python 2
+        self.assertEqual(
+            sorted(rows.hcoptions['series'], key=itemgetter('name')),
+            sorted(columns.hcoptions['series'], key=itemgetter('name')))
+        self.assertEqual(rows.hcoptions['xAxis'],
+                         columns.hcoptions['xAxis'])
+
+    def test_rows_are_not_cached_by_the_query_set(self):
+        ds = DataPool(
+            series=[{
+                'options': {'source': SalesHistory.objects.all()},
+                'terms': ['sale_date', 'sale_qty']
+            }],
+            columnar=True, lazy=True)
+        (tk_td_tuples, vqs), = ds._generate_vqs()
+        data = ds._get_columns(tk_td_tuples, vqs)
+        self.assertEqual(len(data), SalesHistory.objects.count())
+        self.assertIsNone(vqs._result_cache)
+
+    def test_columns_are_compacted(self):
+        ds = DataPool(
+            series=[{
+                'options': {
+                    'source': SalesHistory.objects.all()
+                },
+                'terms': ['sale_date', 'sale_qty', 'price']
+            }],
+            columnar=True)
+        data = ds.series['sale_qty']['_data']
+        self.assertIsInstance(data, ColumnData)
+        self.assertIs(data, ds.series['price']['_data'])
+        self.assertIsInstance(data['sale_qty'], array)
+        self.assertEqual(len(data), SalesHistory.objects.count())
+
+    def test_single_table(self):
+        self.assertSameChart(
+            [{'options': {'source': SalesHistory.objects.all()},
+              'terms': ['sale_date', 'sale_qty']}],
+            [{'options': {'type': 'line'},
+              'terms': {'sale_date': ['sale_qty']}}])
+
+    def test_multiple_tables_same_x(self):
+        self.assertSameChart(
+            [{'options': {'source': MonthlyWeatherByCity.objects.all()},
+              'terms': ['month', 'houston_temp', 'boston_temp']},
+             {'options': {'source': MonthlyWeatherSeattle.objects.all()},
+              'terms': [{'month_seattle': 'month'}, 'seattle_temp']}],
+            [{'options': {'type': 'line'},
+              'terms': {'month': ['boston_temp', 'houston_temp'],
+                        'month_seattle': ['seattle_temp']}}])
+
+    def test_fn(self):
+        self.assertSameChart(
+            [{'options': {'source': SalesHistory.objects.all()},
+              'terms': ['sale_date', ('sale_qty', lambda qty: qty * 2)]}],
+            [{'options': {'type': 'line'},
+              'terms': {'sale_date': ['sale_qty']}}])
+
+    def test_model_property(self):
+        self.assertSameChart(
+            [{'options': {'source':
+                          SalesHistory.objects.order_by('id')[:10]},
+              'terms': ['bookstore__city__region', 'sale_qty']}],
+            [{'options': {'type': 'column'},
+              'terms': {'bookstore__city__region': ['sale_qty']}}])
+
+    def test_raw_query_set(self):
+        self.assertSameChart(
+            [{'options': {
+                'source': MonthlyWeatherByCity.objects.raw(
+                    "SELECT id, month, houston_temp "
+                    "FROM demoproject_monthlyweatherbycity")},
+              'terms': ['month', 'houston_temp']}],
+            [{'options': {'type': 'scatter'},
+              'terms': {'month': ['houston_temp']}}])
+
+
+class DownsamplingTests(TestCase):
+
+    def setUp(self):
+        # a flat line with a single peak in the middle
+        self.points = [(i, 0) for i in range(1000)]
+        self.points[500] = (500, 100)
+
+    def test_lttb(self):
+        keep = downsampling.lttb(self.points, 50)
+        self.assertEqual(len(keep), 50)
+        self.assertEqual(keep[0], 0)
+        self.assertEqual(keep[-1], 999)
+        self.assertIn(500, keep)
+        self.assertEqual(keep, sorted(keep))
+
+    def test_min_max(self):
+        keep = downsampling.min_max(self.points, 50)
+        self.assertLessEqual(len(keep), 50)
+        self.assertIn(500, keep)
+        self.assertEqual(keep, sorted(keep))
+
+    def test_min_max_stream(self):
+        points = [(i, (i * 7919) % 101) for i in range(1000)]
+        for threshold in (3, 50, 999, 1000):
+            kept = downsampling.min_max_stream(
+                ((x, [y, None]) for (x, y) in points), len(points),
+                [threshold, threshold])
+            self.assertEqual([x for (x, _) in kept],
+                             downsampling.min_max(points, threshold))
+        # the streamed items are all kept for the larger threshold
+        kept = downsampling.min_max_stream(
+            ((x, [y, y]) for (x, y) in points), len(points), [50, 2000])
+        self.assertEqual(len(kept), 1000)
+
+    def test_less_points_than_threshold(self):
+        for algorithm in downsampling.ALGORITHMS.values():
+            self.assertEqual(algorithm(self.points[:10], 50), list(range(10)))
+
+    def test_chart_max_points(self):
+        ds = DataPool(series=[{
+            'options': {
+                'source': DailyWeather.objects.all()},
+            'terms': ['day', 'month', 'temperature']
+        }])
+        chart = Chart(
+            datasource=ds,
+            series_options=[{
+                'options': {
+                    'type': 'line',
+                    'max_points': 100},
+                'terms': {'day': ['temperature']}}])
+        series = chart.hcoptions['series'][0]
+        self.assertNotIn('max_points', series)
+        self.assertEqual(len(series['data']), 100)
+        self.assertEqual(len(chart.hcoptions['xAxis'][0]['categories']), 100)
+        temperatures = DailyWeather.objects.values_list('temperature',
+                                                        flat=True)
+        self.assertIn(max(temperatures), series['data'])
+        self.assertIn(min(temperatures), series['data'])
+
+    def test_datetime_axis_is_downsampled_by_time(self):
+        chart = Chart(
+            datasource=DataPool(series=[{
+                'options': {'source': DailyWeather.objects.all()},
+                'terms': ['day', 'temperature']}]),
+            series_options=[{
+                'options': {'type': 'line', 'max_points': 4},
+                'terms': {'day': ['temperature']}}])
+        # the middle points are kept by their time, not their position
+        days = [0, 12, 41, 47, 56, 60]
+        data = [(date(2017, 1, 1) + timedelta(days=d), [y])
+                for (d, y) in zip(days, [2, 0, 5, 2, 5, 5])]
+        self.assertEqual(downsampling.lttb(
+            [(i, y) for (i, (_, (y,))) in enumerate(data)], 4), [0, 1, 4, 5])
+        for x_axis, kept in (({}, [0, 1, 3, 5]),
+                             ({'type': 'category'}, [0, 1, 4, 5])):
+            self.assertEqual(
+                chart._downsample(data, ['temperature'],
+                                  RecursiveDefaultDict(x_axis)),
+                [data[i] for i in kept])
+
+    def test_chart_max_points_for_some_terms_only(self):
+        ds = DataPool(series=[{
+            'options': {
+                'source': DailyWeather.objects.all()},
+            'terms': ['day', 'month', 'temperature']
+        }])
+        chart = Chart(
+            datasource=ds,
+            series_options=[{
+                'options': {
+                    'type': 'line'},
+                'terms': {'day': [
+                    'month',
+                    {'temperature': {'max_points': 100,
+                                     'downsample': 'minmax'}}]}}])
+        for series in chart.hcoptions['series']:
+            self.assertEqual(len(series['data']), DailyWeather.objects.count())
+
+    def test_bad_max_points(self):
+        ds = DataPool(series=[{
+            'options': {
+                'source': DailyWeather.objects.all()},
+            'terms': ['day', 'temperature']
+        }])
+        for options in ({'max_points': 2}, {'max_points': '100'},
+                        {'max_points': 100, 'downsample': 'average'},
+                        {'max_points': 100, 'type': 'scatter'},
+                        {'max_points': 100, 'type': 'pie'}):
+            options.setdefault('type', 'line')
+            self.assertRaises(APIInputError, Chart, datasource=ds,
+                              series_options=[{
+                                  'options': options,
+                                  'terms': {'day': ['temperature']}}])
+
+
+class StreamingDataPoolTests(TestCase):
+
+    def setUp(self):
+        self.series = [{
+            'options': {
+                'source': SalesHistory.objects.all()
+            },
+            'terms': ['id', 'sale_date', ('sale_qty', lambda qty: qty * 2)]
+        }]
+        self.series_options = [{
+            'options': {
+                'type': 'line',
+                'max_points': 10,
+                'downsample': 'minmax'
+            },
+            'terms': {
+                'id': ['sale_qty']
+            }
+        }]
+
+    def test_data_is_not_stored(self):
+        with self.assertNumQueries(0):
+            ds = DataPool(series=self.series, chunk_size=100)
+        self.assertIsInstance(ds.series['sale_qty']['_data'], StreamedData)
+        # COUNT() and the rows ordered by the x-axis term
+        with CaptureQueriesContext(connection) as queries:
+            Chart(datasource=ds, series_options=self.series_options)
+        self.assertEqual(len(queries), 2)
+        self.assertIn('COUNT(', queries[0]['sql'])
+        self.assertIn('ORDER BY', queries[1]['sql'])
+
+    def test_streamed_chart_is_the_same(self):
+        stored = Chart(datasource=DataPool(series=self.series),
+                       series_options=self.series_options)
+        streamed = Chart(datasource=DataPool(series=self.series,
+                                             chunk_size=100),
+                         series_options=self.series_options)
+        self.assertEqual(stored.hcoptions, streamed.hcoptions)
+        self.assertLessEqual(len(streamed.hcoptions['series'][0]['data']),
+                             10)
+
+    def test_streamed_points_keep_extremes(self):
+        chart = Chart(datasource=DataPool(series=self.series,
+                                          chunk_size=7),
+                      series_options=[{
+                          'options': {'type': 'line', 'max_points': 4},
+                          'terms': {'sale_date': ['sale_qty']}}])
+        dates = SalesHistory.objects.values_list('sale_date', flat=True)
+        x_axis = chart.hcoptions['xAxis'][0]
+        self.assertEqual(x_axis['type'], 'datetime')
+        ys = [y for (_, y) in chart.hcoptions['series'][0]['data']]
+        qtys = SalesHistory.objects.values_list('sale_qty', flat=True)
+        self.assertLessEqual(len(ys), 4)
+        self.assertIn(min(qtys) * 2, ys)
+        self.assertIn(max(qtys) * 2, ys)
+        x_ms = [x for (x, _) in chart.hcoptions['series'][0]['data']]
+        self.assertEqual(x_ms, sorted(x_ms))
+        self.assertEqual(x_ms[0], charts._epoch_ms(charts._utc(min(dates))))
+
+    def test_streaming_requires_max_points(self):
+        ds = DataPool(series=self.series, chunk_size=100)
+        self.assertRaises(APIInputError, Chart, datasource=ds,
+                          series_options=[{
+                              'options': {'type': 'line'},
+                              'terms': {'id': ['sale_qty']}}])
+
+    def test_bad_streamed_options(self):
+        ds = DataPool(series=self.series, chunk_size=100)
+        self.assertRaises(APIInputError, Chart, datasource=ds,
+                          series_options=[{
+                              'options': {'type': 'line', 'max_points': 10,
+                                          'downsample': 'lttb'},
+                              'terms': {'id': ['sale_qty']}}])
+        self.assertRaises(APIInputError, Chart, datasource=ds,
+                          series_options=self.series_options,
+                          x_sortf_mapf_mts=(lambda x: -x, None, False))
+        ds = DataPool(series=[{
+            'options': {'source': SalesHistory.objects.all()[:10]},
+            'terms': ['id', 'sale_qty']
+        }], chunk_size=100)
+        self.assertRaises(APIInputError, Chart, datasource=ds,
+                          series_options=self.series_options)
+        ds = DataPool(series=[{
+            'options': {'source': SalesHistory.objects.all()},
+            'terms': ['id', 'sale_qty']
+        }, {
+            'options': {'source': DailyWeather.objects.all()},
+            'terms': [{'weather_id': 'id'}, 'temperature']
+        }], chunk_size=100)
+        self.assertRaises(APIInputError, Chart, datasource=ds,
+                          series_options=[{
+                              'options': {'type': 'line', 'max_points': 10},
+                              'terms': {'id': ['sale_qty'],
+                                        'weather_id': ['temperature']}}])
+
+    def test_bad_chunk_size(self):
+        self.assertRaises(APIInputError, DataPool, series=self.series,
+                          chunk_size=0)
+        self.assertRaises(APIInputError, DataPool, series=self.series,
+                          chunk_size=100, columnar=True)
+
+
+@skipUnless(getattr(connection.features, 'can_share_in_memory_db', True),
+            "worker threads can't see the in-memory test database")
+class ParallelDataPoolTests(TestCase):
+
+    def setUp(self):
+        self.series = [{
+            'options': {'source': MonthlyWeatherByCity.objects.all()},
+            'terms': ['month', 'houston_temp', 'boston_temp']
+        }, {
+            'options': {'source': MonthlyWeatherSeattle.objects.all()},
+            'terms': [{'month_seattle': 'month'}, 'seattle_temp']
+        }, {
+            'options': {'source': SalesHistory.objects.all()},
+            'terms': ['sale_date', 'sale_qty']
+        }]
+
+    def test_same_data_as_serial(self):
+        serial = DataPool(series=self.series)
+        parallel = DataPool(series=self.series, max_workers=4)
+        for tk, td in serial.series.items():
+            self.assertEqual(td['_data'], parallel.series[tk]['_data'])
+
+    def test_terms_share_data_per_query_group(self):
+        ds = DataPool(series=self.series, max_workers=4, columnar=True)
+        self.assertIs(ds.series['month']['_data'],
+                      ds.series['boston_temp']['_data'])
+        self.assertIsNot(ds.series['month']['_data'],
+                         ds.series['month_seattle']['_data'])
+
+    def test_bad_max_workers(self):
+        self.assertRaises(APIInputError, DataPool, series=self.series,
+                          max_workers=0)
+
+
+@skipIf(sys.version_info < (3, 5), "the asynchronous API needs Python 3.5")
+@skipUnless(getattr(connection.features, 'can_share_in_memory_db', True),
+            "worker threads can't see the in-memory test database")
+class AsyncLoadTests(TestCase):
+    # the worker threads use their own database connections, which only see
+    # the data of the migrations
+
+    def setUp(self):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(4)
+        self.loop.set_default_executor(self.executor)
+        self.series = [{
+            'options': {'source': MonthlyWeatherByCity.objects.all()},
+            'terms': ['month', 'houston_temp', 'boston_temp']
+        }, {
+            'options': {'source': MonthlyWeatherSeattle.objects.all()},
+            'terms': [{'month_seattle': 'month'}, 'seattle_temp']
+        }]
+        self.series_options = [{
+            'options': {'type': 'line'},
+            'terms': {'month': ['boston_temp', 'houston_temp'],
+                      'month_seattle': ['seattle_temp']}
+        }]
+
+    def tearDown(self):
+        self.loop.close()
+        # the worker threads and their connections are gone before the
+        # next test queries the database
+        self.executor.shutdown(wait=True)
+
+    def test_data_pool_aload(self):
+        ds = DataPool(series=self.series, lazy=True)
+        self.assertIs(self.loop.run_until_complete(ds.aload()), ds)
+        self.assertEqual(ds.series['month']['_data'],
+                         DataPool(series=self.series).series['month']['_data'])
+
+    def test_pivot_data_pool_aload(self):
+        series = [{
+            'options': {
+                'source': SalesHistory.objects.all(),
+                'categories': 'bookstore__city__city',
+                'legend_by': 'book__genre__name'},
+            'terms': {'avg_price': Avg('price')}}]
+        ds = PivotDataPool(series=series, lazy=True)
+        self.assertNotIn('cv', ds.__dict__)
+        self.loop.run_until_complete(ds.aload())
+        self.assertEqual(ds.cv, PivotDataPool(series=series).cv)
+
+    def test_chart_acreate(self):
+        chart = self.loop.run_until_complete(Chart.acreate(
+            DataPool(series=self.series, lazy=True),
+            series_options=self.series_options))
+        self.assertEqual(
+            chart.hcoptions,
+            Chart(DataPool(series=self.series),
+                  series_options=self.series_options).hcoptions)
+
+    def test_acreate_propagates_errors(self):
+        self.assertRaises(
+            APIInputError, self.loop.run_until_complete,
+            Chart.acreate(DataPool(series=self.series, lazy=True),
+                          series_options=[{'options': {},
+                                           'terms': {'month': ['foo']}}]))
+
+
+class ChartDataCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.series = [{
+            'options': {'source': MonthlyWeatherByCity.objects.all()},
+            'terms': ['month', 'houston_temp', 'boston_temp']
+        }, {
+            'options': {'source': MonthlyWeatherSeattle.objects.all()},
+            'terms': [{'month_seattle': 'month'}, 'seattle_temp']
+        }]
+
+    def test_identical_pools_share_cached_data(self):
+        with self.assertNumQueries(2):
+            first = DataPool(series=self.series, cache=True)
+        with self.assertNumQueries(0):
+            second = DataPool(series=self.series, cache=ChartDataCache())
+        for tk, td in first.series.items():
+            self.assertEqual(td['_data'], second.series[tk]['_data'])
+
+    def test_different_queries_are_cached_separately(self):
+        DataPool(series=self.series, cache=True)
+        series = [{
+            'options': {
+                'source': MonthlyWeatherByCity.objects.filter(month__lt=6)},
+            'terms': ['month', 'houston_temp', 'boston_temp']
+        }]
+        with self.assertNumQueries(1):
+            ds = DataPool(series=series, cache=True)
+        self.assertEqual(len(ds.series['month']['_data']), 5)
+
+    def test_fn_is_part_of_the_key(self):
+        def series(factor):
+            return [{
+                'options': {'source': MonthlyWeatherSeattle.objects.all()},
+                'terms': ['month', ('seattle_temp', lambda t: t * factor)]
+            }]
+
+        DataPool(series=series(1), cache=True)
+        with self.assertNumQueries(1):
+            DataPool(series=series(2), cache=True)
+        with self.assertNumQueries(0):
+            DataPool(series=series(2), cache=True)
+
+    def test_default_arguments_of_fn_are_part_of_the_key(self):
+        fns = [lambda t, k=k: t * k for k in (1, 100)]
+        pools = [DataPool(series=[{
+            'options': {'source': MonthlyWeatherSeattle.objects.all()},
+            'terms': ['month', ('seattle_temp', fn)]
+        }], cache=True) for fn in fns]
+        temps = [[row['seattle_temp'] for row in ds.series['month']['_data']]
+                 for ds in pools]
+        self.assertEqual(temps[1], [t * 100 for t in temps[0]])
+
+    def test_code_of_fn_is_part_of_the_key(self):
+        fingerprint = chartit_cache._fn_fingerprint
+        self.assertNotEqual(fingerprint(lambda t: t * 2),
+                            fingerprint(lambda t: t * 3))
+        self.assertNotEqual(fingerprint(lambda t: t.upper()),
+                            fingerprint(lambda t: t.lower()))
+        self.assertNotEqual(fingerprint(lambda t: [s * 2 for s in t]),
+                            fingerprint(lambda t: [s * 3 for s in t]))
+        self.assertEqual(fingerprint(lambda t: [s * 2 for s in t]),
+                         fingerprint(lambda t: [s * 2 for s in t]))
+
+    def test_fn_with_unstable_values_is_not_cached(self):
+        class Scale(object):
+            factor = 2
+
+        scale = Scale()
+        series = [{
+            'options': {'source': MonthlyWeatherSeattle.objects.all()},
+            'terms': ['month', ('seattle_temp', lambda t: t * scale.factor)]
+        }]
+        self.assertRaises(chartit_cache._Unstable,
+                          chartit_cache._fn_fingerprint,
+                          series[0]['terms'][1][1])
+        DataPool(series=series, cache=True)
+        with self.assertNumQueries(1):
+            DataPool(series=series, cache=True)
+
+    def test_closures_over_functions_are_part_of_the_key(self):
+        def scaled(factor):
+            def scale(t):
+                return t * factor
+            return lambda t: scale(t)
+
+        fingerprint = chartit_cache._fn_fingerprint
+        self.assertEqual(fingerprint(scaled(2)), fingerprint(scaled(2)))
+        self.assertNotEqual(fingerprint(scaled(2)), fingerprint(scaled(3)))
+
+    def test_columnar_is_part_of_the_key(self):
+        DataPool(series=self.series, cache=True)
+        ds = DataPool(series=self.series, cache=True, columnar=True)
+        self.assertIsInstance(ds.series['month']['_data'], ColumnData)
+
+    def test_pivot_data_pool(self):
+        series = [{
+            'options': {
+                'source': SalesHistory.objects.all(),
+                'categories': 'bookstore__city__city',
+                'legend_by': 'book__genre__name'},
+            'terms': {'avg_price': Avg('price')}}]
+        first = PivotDataPool(series=series, cache=True)
+        with self.assertNumQueries(0):
+            second = PivotDataPool(series=series, cache=True)
+        self.assertEqual(first.cv, second.cv)
+
+    def test_bad_cache(self):
+        self.assertRaises(APIInputError, DataPool, series=self.series,
+                          cache='default')
+
+
+class ChartDataInvalidationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.series = [{
+            'options': {'source': SalesHistory.objects.all()},
+            'terms': ['bookstore__city__city', 'sale_qty']
+        }]
+
+    def test_saving_a_related_model_invalidates(self):
+        DataPool(series=self.series, cache=True)
+        with self.assertNumQueries(0):
+            DataPool(series=self.series, cache=True)
+        city = City.objects.first()
+        city.city = 'Springfield'
+        city.save()
+        with self.assertNumQueries(1):
+            ds = DataPool(series=self.series, cache=True)
+        self.assertIn('Springfield', [row['bookstore__city__city'] for row
+                                      in ds.series['sale_qty']['_data']])
+
+    def test_deleting_invalidates(self):
+        series = [{
+            'options': {'source': MonthlyWeatherSeattle.objects.all()},
+            'terms': ['month', 'seattle_temp']
+        }]
+        DataPool(series=series, cache=True)
+        MonthlyWeatherSeattle.objects.first().delete()
+        with self.assertNumQueries(1):
+            DataPool(series=series, cache=True)
+
+    def test_saving_an_unrelated_model_does_not_invalidate(self):
+        DataPool(series=self.series, cache=True)
+        genre = Genre.objects.first()
+        genre.save()
+        with self.assertNumQueries(0):
+            DataPool(series=self.series, cache=True)
+
+    def test_m2m_changed_invalidates(self):
+        series = [{
+            'options': {'source': Book.objects.all()},
+            'terms': ['title', 'authors__first_name']
+        }]
+        DataPool(series=series, cache=True)
+        Book.objects.first().authors.add(Author.objects.last())
+        with self.assertNumQueries(1):
+            DataPool(series=series, cache=True)
+
+    def test_model_property_dependencies(self):
+        series = [{
+            'options': {'source': SalesHistory.objects.all()[:10]},
+            'terms': ['bookstore__city__region', 'sale_qty']
+        }]
+        ds = DataPool(series=series, lazy=True)
+        (tk_td_tuples, vqs), = ds._generate_vqs()
+        self.assertEqual(dependencies(tk_td_tuples, vqs),
+                         set([SalesHistory, BookStore, City]))
+
+    def test_raw_query_set_dependencies(self):
+        series = [{
+            'options': {'source': MonthlyWeatherByCity.objects.raw(
+                "SELECT w.id, w.month, s.seattle_temp "
+                "FROM demoproject_monthlyweatherbycity w "
+                "JOIN demoproject_monthlyweatherseattle s "
+                "ON w.month = s.month")},
+            'terms': ['month', 'seattle_temp']
+        }]
+        ds = DataPool(series=series, lazy=True)
+        (tk_td_tuples, vqs), = ds._generate_vqs()
+        self.assertEqual(dependencies(tk_td_tuples, vqs),
+                         set([MonthlyWeatherByCity, MonthlyWeatherSeattle]))
+
+    def test_other_processes_invalidate(self):
+        DataPool(series=self.series, cache=True)
+        # e.g. a worker which never created a ChartDataCache
+        constructed = set(chartit_cache._constructed)
+        chartit_cache._constructed.clear()
+        try:
+            with override_settings(CHARTIT_CACHES=[('default', 'chartit')]):
+                City.objects.first().save()
+        finally:
+            chartit_cache._constructed.update(constructed)
+        with self.assertNumQueries(1):
+            DataPool(series=self.series, cache=True)
+
+    def test_configured_caches_invalidate(self):
+        data_cache = ChartDataCache(key_prefix='charts')
+        DataPool(series=self.series, cache=data_cache)
+        chartit_cache._constructed.discard(('default', 'charts'))
+        with override_settings(CHARTIT_CACHES=[('default', 'charts')]):
+            City.objects.first().save()
+        with self.assertNumQueries(1):
+            DataPool(series=self.series, cache=data_cache)
+
+    def test_signals_are_received_once_caching_is_used(self):
+        data_cache = ChartDataCache()
+        data_cache.bump_version(City)
+        version = data_cache.versions([City])
+        for signal, name in ((post_save, 'post_save'),
+                             (post_delete, 'post_delete'),
+                             (m2m_changed, 'm2m_changed')):
+            signal.disconnect(dispatch_uid='chartit_%s' % name)
+        chartit_cache._connected = False
+        City.objects.first().save()
+        self.assertEqual(data_cache.versions([City]), version)
+        ChartDataCache()
+        City.objects.first().save()
+        self.assertNotEqual(data_cache.versions([City]), version)
+
+    def test_raw_saves_do_not_invalidate(self):
+        data_cache = ChartDataCache()
+        data_cache.bump_version(City)
+        version = data_cache.versions([City])
+        post_save.send(sender=City, instance=City.objects.first(),
+                       created=False, raw=True)
+        self.assertEqual(data_cache.versions([City]), version)
+
+    def test_missing_versions_are_not_created(self):
+        City.objects.first().save()
+        self.assertIsNone(cache.get('chartit:version:demoproject.city'))
+
+    def test_data_version(self):
+        ds = DataPool(series=self.series, lazy=True)
+        data_cache = ChartDataCache()
+        version = data_cache.data_version(ds)
+        self.assertEqual(version, data_cache.data_version(ds))
+        BookStore.objects.first().save()
+        self.assertNotEqual(version, data_cache.data_version(ds))
+
+
+class IncrementalRefreshTests(TestCase):
+
+    def setUp(self):
+        self.series = [{
+            'options': {'source': MonthlyWeatherSeattle.objects.all()},
+            'terms': ['month', 'seattle_temp']
+        }]
+
+    def chart(self, ds):
+        return Chart(
+            datasource=ds,
+            series_options=[{
+                'options': {'type': 'line'},
+                'terms': {'month': ['seattle_temp']}
+            }])
+
+    def test_refresh_appends_rows_beyond_high_water_mark(self):
+        ds = DataPool(series=self.series, incremental_on='month')
+        count = len(ds.series['month']['_data'])
+        self.assertEqual(ds.high_water_marks, {'month': 12})
+        MonthlyWeatherSeattle.objects.create(month=13, seattle_temp=40)
+        with self.assertNumQueries(2):
+            new_data = ds.refresh()
+        self.assertEqual([row['month'] for row in new_data['month']], [13])
+        self.assertEqual(len(ds.series['month']['_data']), count + 1)
+        self.assertIs(ds.series['month']['_data'],
+                      ds.series['seattle_temp']['_data'])
+        self.assertEqual(ds.high_water_marks, {'month': 13})
+
+    def test_refresh_without_new_rows(self):
+        ds = DataPool(series=self.series, incremental_on='month')
+        data = list(ds.series['month']['_data'])
+        # the rows at the high-water mark are retrieved again
+        with self.assertNumQueries(2):
+            new_data = ds.refresh()
+        self.assertEqual(list(new_data['month']), [])
+        self.assertEqual(ds.series['month']['_data'], data)
+        self.assertFalse(ds.boundary_replaced)
+
+    def test_refresh_retrieves_rows_at_high_water_mark(self):
+        series = [{
+            'options': {'source': SalesHistory.objects.all()},
+            'terms': ['sale_date', 'sale_qty']
+        }]
+        ds = DataPool(series=series, incremental_on='sale_date')
+        last = ds.high_water_marks['sale_date']
+        sale = SalesHistory.objects.order_by('id').first()
+        SalesHistory.objects.create(
+            bookstore=sale.bookstore, book=sale.book, sale_date=last,
+            sale_qty=1, price=sale.price)
+        SalesHistory.objects.create(
+            bookstore=sale.bookstore, book=sale.book,
+            sale_date=last + timedelta(days=1), sale_qty=2, price=sale.price)
+        ds.refresh()
+        data = ds.series['sale_date']['_data']
+        self.assertTrue(ds.boundary_replaced)
+        self.assertEqual(len(data), SalesHistory.objects.count())
+        self.assertEqual(sorted((row['sale_date'], row['sale_qty'])
+                                for row in data),
+                         sorted(SalesHistory.objects.values_list(
+                             'sale_date', 'sale_qty')))
+        # the next refresh only retrieves the rows of the new date
+        ds.refresh()
+        self.assertFalse(ds.boundary_replaced)
+        self.assertEqual(len(data), SalesHistory.objects.count())
+
+    def test_refresh_replaces_group_at_high_water_mark(self):
+        series = [{
+            'options': {'source': SalesHistory.objects.all(),
+                        'group_by': 'sale_date'},
+            'terms': ['sale_date', {'total_qty': Sum('sale_qty')}]
+        }]
+        for columnar in (False, True):
+            ds = DataPool(series=series, incremental_on='sale_date',
+                          columnar=columnar)
+            last = ds.high_water_marks['sale_date']
+            sale = SalesHistory.objects.order_by('id').first()
+            SalesHistory.objects.create(
+                bookstore=sale.bookstore, book=sale.book, sale_date=last,
+                sale_qty=7, price=sale.price)
+            ds.refresh()
+            data = ds.series['total_qty']['_data']
+            if columnar:
+                totals = list(zip(data['sale_date'], data['total_qty']))
+            else:
+                totals = [(row['sale_date'], row['total_qty'])
+                          for row in data]
+            self.assertEqual(totals, list(
+                SalesHistory.objects.values('sale_date')
+                .annotate(total=Sum('sale_qty')).order_by('sale_date')
+                .values_list('sale_date', 'total')))
+
+    def test_chart_refresh_plots_again_if_rows_are_replaced(self):
+        series = [{
+            'options': {'source': SalesHistory.objects.all(),
+                        'group_by': 'sale_date'},
+            'terms': ['sale_date', {'total_qty': Sum('sale_qty')}]
+        }]
+        ds = DataPool(series=series, incremental_on='sale_date')
+        series_options = [{'options': {'type': 'line'},
+                           'terms': {'sale_date': ['total_qty']}}]
+        cht = Chart(datasource=ds, series_options=series_options)
+        sale = SalesHistory.objects.order_by('id').first()
+        SalesHistory.objects.create(
+            bookstore=sale.bookstore, book=sale.book,
+            sale_date=ds.high_water_marks['sale_date'], sale_qty=7,
+            price=sale.price)
+        cht.refresh()
+        assertOptionDictsEqual(
+            self, cht.hcoptions,
+            Chart(datasource=DataPool(series),
+                  series_options=series_options).hcoptions)
+
+    def test_refresh_columnar(self):
+        ds = DataPool(series=self.series, incremental_on='month',
+                      columnar=True)
+        MonthlyWeatherSeattle.objects.create(month=13, seattle_temp=40)
+        ds.refresh()
+        data = ds.series['month']['_data']
+        self.assertIsInstance(data['month'], array)
+        self.assertEqual(list(data['month']),
+                         [1, 2, 3, 4, 5, 6, 7, 10, 11, 12, 13])
+        self.assertEqual(len(data['seattle_temp']), 11)
+
+    def test_refresh_without_incremental_on_retrieves_everything(self):
+        ds = DataPool(series=self.series)
+        MonthlyWeatherSeattle.objects.create(month=13, seattle_temp=40)
+        with self.assertNumQueries(1):
+            ds.refresh()
+        self.assertEqual(len(ds.series['month']['_data']), 11)
+
+    def test_lazy_refresh_retrieves_everything(self):
+        ds = DataPool(series=self.series, incremental_on='month', lazy=True)
+        ds.refresh()
+        self.assertEqual(len(ds.series['month']['_data']), 10)
+        self.assertEqual(ds.high_water_marks, {'month': 12})
+
+    def test_chart_refresh_appends_to_hcoptions(self):
+        ds = DataPool(series=self.series, incremental_on='month')
+        cht = self.chart(ds)
+        series = cht.hcoptions['series'][0]
+        MonthlyWeatherSeattle.objects.create(month=13, seattle_temp=40)
+        cht.refresh()
+        self.assertIs(cht.hcoptions['series'][0], series)
+        self.assertEqual(cht.hcoptions['xAxis'][0]['categories'],
+                         [1, 2, 3, 4, 5, 6, 7, 10, 11, 12, 13])
+        self.assertEqual(len(series['data']), 11)
+        assertOptionDictsEqual(self, cht.hcoptions,
+                               self.chart(DataPool(self.series)).hcoptions)
+
+    def test_chart_refresh_out_of_order_plots_again(self):
+        ds = DataPool(series=self.series, incremental_on='id')
+        cht = self.chart(ds)
+        MonthlyWeatherSeattle.objects.create(month=0, seattle_temp=40)
+        cht.refresh()
+        self.assertEqual(cht.hcoptions['xAxis'][0]['categories'],
+                         [0, 1, 2, 3, 4, 5, 6, 7, 10, 11, 12])
+        assertOptionDictsEqual(self, cht.hcoptions,
+                               self.chart(DataPool(self.series)).hcoptions)
+
+    def test_incremental_on_validation(self):
+        self.assertRaises(APIInputError, DataPool, self.series,
+                          incremental_on='no_such_field')
+        self.assertRaises(APIInputError, DataPool, self.series,
+                          incremental_on='month', chunk_size=10)
+        series = [{
+            'options': {'source': MonthlyWeatherSeattle.objects.all()[:5]},
+            'terms': ['month', 'seattle_temp']
+        }]
+        self.assertRaises(APIInputError, DataPool, series,
+                          incremental_on='month')
+        series = [{
+            'options': {'source': SalesHistory.objects.all(),
+                        'group_by': 'bookstore__name'},
+            'terms': ['bookstore__name', {'qty': Sum('sale_qty')}]
+        }]
+        self.assertRaises(APIInputError, DataPool, series,
+                          incremental_on='sale_date')
+
+
+class AggregateDataPoolTests(TestCase):
+
+    def setUp(self):
+        self.series = [{
+            'options': {
+                'source': SalesHistory.objects.all(),
+                'group_by': 'sale_date'},
+            'terms': ['sale_date', {'total_qty': Sum('sale_qty')}]
+        }]
+        self.totals = defaultdict(int)
+        for sale in SalesHistory.objects.all():
+            self.totals[sale.sale_date] += sale.sale_qty
+
+    def test_one_row_per_group(self):
+        with self.assertNumQueries(1):
+            ds = DataPool(series=self.series)
+        data = ds.series['total_qty']['_data']
+        self.assertIs(data, ds.series['sale_date']['_data'])
+        self.assertEqual(len(ds.query_groups), 1)
+        self.assertEqual(dict((row['sale_date'], row['total_qty'])
+                              for row in data), self.totals)
+        self.assertEqual([row['sale_date'] for row in data],
+                         sorted(self.totals))
+        self.assertEqual(ds.series['total_qty']['field_alias'], 'total_qty')
+
+    def test_columnar(self):
+        ds = DataPool(series=self.series, columnar=True)
+        data = ds.series['total_qty']['_data']
+        self.assertEqual(dict(zip(data['sale_date'], data['total_qty'])),
+                         self.totals)
+
+    def test_group_by_related_field(self):
+        ds = DataPool(series=[{
+            'options': {
+                'source': SalesHistory.objects.all(),
+                'group_by': ['bookstore__city__city']},
+            'terms': ['bookstore__city__city',
+                      {'sales': {'func': Sum('sale_qty')}}]
+        }])
+        cities = set(SalesHistory.objects.values_list(
+            'bookstore__city__city', flat=True))
+        self.assertEqual(len(ds.series['sales']['_data']), len(cities))
+
+    def test_plain_terms_of_the_same_source_are_another_query(self):
+        series = self.series + [{
+            'options': {'source': SalesHistory.objects.all()},
+            'terms': [{'qty': 'sale_qty'}]
+        }]
+        with self.assertNumQueries(2):
+            ds = DataPool(series=series)
+        self.assertEqual(len(ds.series['qty']['_data']),
+                         SalesHistory.objects.count())
+
+    def test_chart(self):
+        cht = Chart(
+            datasource=DataPool(series=self.series),
+            series_options=[{
+                'options': {'type': 'column'},
+                'terms': {'sale_date': ['total_qty']}
+            }])
+        # the dates are plotted on a datetime axis
+        self.assertEqual([y for (_, y) in cht.hcoptions['series'][0]['data']],
+                         [self.totals[d] for d in sorted(self.totals)])
+
+    def test_aggregate_without_group_by(self):
+        series = [{
+            'options': {'source': SalesHistory.objects.all()},
+            'terms': ['sale_date', {'total_qty': Sum('sale_qty')}]
+        }]
+        self.assertRaises(APIInputError, clean_dps, series)
+
+    def test_term_not_in_group_by(self):
+        self.series[0]['terms'].append('price')
+        self.assertRaises(APIInputError, clean_dps, self.series)
+
+    def test_aggregate_named_like_a_field(self):
+        self.series[0]['terms'] = ['sale_date', {'price': Avg('price')}]
+        self.assertRaises(APIInputError, clean_dps, self.series)
+
+    def test_raw_query_set(self):
+        series = [{
+            'options': {
+                'source': SalesHistory.objects.raw(
+                    'SELECT * FROM demoproject_saleshistory'),
+                'group_by': 'sale_date'},
+            'terms': ['sale_date', {'total_qty': Sum('sale_qty')}]
+        }]
+        self.assertRaises(APIInputError, clean_dps, series)
+
+
+@skipIf(buckets.Trunc is None, "Bucket requires Django 1.10 or newer")
+class BucketTests(TestCase):
+
+    def test_data_pool_buckets_and_aggregates_in_one_query(self):
+        with self.assertNumQueries(1):
+            ds = DataPool(series=[{
+                'options': {
+                    'source': SalesHistory.objects.all(),
+                    'group_by': 'month'},
+                'terms': [{'month': Bucket('sale_date', 'month')},
+                          {'total_qty': Sum('sale_qty')}]
+            }])
+        totals = defaultdict(int)
+        for sale in SalesHistory.objects.all():
+            totals[sale.sale_date.replace(day=1)] += sale.sale_qty
+        data = ds.series['month']['_data']
+        self.assertEqual(dict((row['month'], row['total_qty'])
+                              for row in data), totals)
+        self.assertEqual([row['month'] for row in data], sorted(totals))
+
+    def test_data_pool_time_zone(self):
+        tz = pytz.timezone('America/Los_Angeles')
+        ds = DataPool(series=[{
+            'options': {
+                'source': Book.objects.all(),
+                'group_by': 'day'},
+            'terms': {
+                'day': Bucket('published_at', 'day', tz='America/Los_Angeles'),
+                'books': Count('id')}
+        }])
+        counts = defaultdict(int)
+        for book in Book.objects.all():
+            day = book.published_at.astimezone(tz).date()
+            counts[tz.localize(datetime.combine(day, time.min))] += 1
+        self.assertEqual(dict((row['day'], row['books']) for row
+                              in ds.series['books']['_data']), counts)
+
+    def test_pivot_data_pool_categories(self):
+        ds = PivotDataPool(series=[{
+            'options': {
+                'source': SalesHistory.objects.all(),
+                'categories': [Bucket('sale_date', 'year')]},
+            'terms': {'total_qty': Sum('sale_qty')}
+        }])
+        self.assertEqual(ds.series['total_qty']['categories'],
+                         ['sale_date_year'])
+        totals = defaultdict(int)
+        for sale in SalesHistory.objects.all():
+            totals[(str(date(sale.sale_date.year, 1, 1)),)] += sale.sale_qty
+        self.assertEqual(sorted(ds.cv), sorted(totals))
+        self.assertEqual(dict((cv, lv_dfv[()]) for (cv, lv_dfv) in
+                              ds.series['total_qty']['_cv_lv_dfv'].items()),
+                         totals)
+
+    def test_invalid_buckets(self):
+        self.assertRaises(APIInputError, Bucket, 'sale_date', 'decade')
+        self.assertRaises(APIInputError, Bucket, None, 'day')
+        # a DateField can't be truncated to hours
+        series = [{
+            'options': {'source': SalesHistory.objects.all()},
+            'terms': [{'hour': Bucket('sale_date', 'hour')}, 'sale_qty']
+        }]
+        self.assertRaises(APIInputError, clean_dps, series)
+        series = [{
+            'options': {'source': SalesHistory.objects.raw(
+                'SELECT * FROM demoproject_saleshistory')},
+            'terms': [{'day': Bucket('sale_date', 'day')}]
+        }]
+        self.assertRaises(APIInputError, clean_dps, series)
+
+
+class ProjectionPruningTests(TestCase):
+
+    def setUp(self):
+        self.series = [{
+            'options': {'source': MonthlyWeatherByCity.objects.all()},
+            'terms': ['month', 'boston_temp', 'houston_temp',
+                      'new_york_temp', 'san_francisco_temp']
+        }]
+
+    def series_options(self, *terms):
+        return [{
+            'options': {'type': 'line'},
+            'terms': {'month': list(terms)}
+        }]
+
+    def test_chart_selects_only_plotted_terms(self):
+        ds = DataPool(series=self.series, lazy=True)
+        with CaptureQueriesContext(connection) as queries:
+            Chart(datasource=ds,
+                  series_options=self.series_options('boston_temp'))
+        self.assertEqual(len(queries), 1)
+        sql = queries[0]['sql']
+        self.assertIn('boston_temp', sql)
+        self.assertNotIn('houston_temp', sql)
+        self.assertEqual(set(ds.series['month']['_data'][0]),
+                         set(['month', 'boston_temp']))
+
+    def test_pruned_chart_is_the_same(self):
+        eager = Chart(datasource=DataPool(series=self.series),
+                      series_options=self.series_options('boston_temp'))
+        lazy = Chart(datasource=DataPool(series=self.series, lazy=True),
+                     series_options=self.series_options('boston_temp'))
+        self.assertEqual(eager.hcoptions, lazy.hcoptions)
+
+    def test_charts_sharing_a_pool(self):
+        ds = DataPool(series=self.series, lazy=True)
+        ds.use_terms('month', 'boston_temp', 'houston_temp')
+        with self.assertNumQueries(1):
+            Chart(datasource=ds,
+                  series_options=self.series_options('boston_temp'))
+            Chart(datasource=ds,
+                  series_options=self.series_options('houston_temp'))
+        # a term no chart was declared with is retrieved when it is plotted
+        with self.assertNumQueries(1):
+            Chart(datasource=ds,
+                  series_options=self.series_options('new_york_temp'))
+        self.assertEqual(set(ds.series['month']['_data'][0]),
+                         set(['month', 'boston_temp', 'houston_temp',
+                              'new_york_temp']))
+
+    def test_unused_term_is_retrieved_on_access(self):
+        ds = DataPool(series=self.series, lazy=True)
+        Chart(datasource=ds,
+              series_options=self.series_options('boston_temp'))
+        with self.assertNumQueries(1):
+            data = ds.series['san_francisco_temp']['_data']
+        self.assertIn('san_francisco_temp', data[0])
+        self.assertNotIn('houston_temp', data[0])
+
+    def test_invalid_terms(self):
+        ds = DataPool(series=self.series, lazy=True)
+        self.assertRaises(APIInputError, ds.use_terms, 'no_such_term')
+
+
+class RelatedLookupPlanningTests(TestCase):
+
+    def test_model_property_of_related_model(self):
+        series = [{
+            'options': {'source': SalesHistory.objects.all()},
+            'terms': ['bookstore__city__region', 'sale_qty']
+        }]
+        with self.assertNumQueries(1):
+            ds = DataPool(series=series)
+        data = ds.series['sale_qty']['_data']
+        self.assertEqual(len(data), SalesHistory.objects.count())
+        with self.assertNumQueries(0):
+            regions = [_getattr(obj, 'bookstore__city__region')
+                       for obj in data]
+        self.assertEqual(
+            regions,
+            ['USA:%s' % sh.bookstore.city.city
+             for sh in SalesHistory.objects.all()])
+
+    def test_many_to_many_relations_are_prefetched(self):
+        qs = _select_related(Book.objects.all(),
+                             ['authors__first_name', 'publisher__name'])
+        self.assertEqual(qs.query.select_related, {'publisher': {}})
+        self.assertEqual(list(qs._prefetch_related_lookups), ['authors'])
+        # the books need all fields for the prefetch
+        self.assertEqual(qs.query.deferred_loading[0], set())
+
+    def test_only_the_used_fields_are_selected(self):
+        qs = _select_related(SalesHistory.objects.all(),
+                             ['bookstore__city__region', 'sale_qty'])
+        self.assertEqual(qs.query.deferred_loading,
+                         (set(['bookstore__city', 'sale_qty']), False))
+        # a property of the model itself can use any of its fields
+        qs = _select_related(SalesHistory.objects.all(),
+                             ['__str__', 'sale_qty'])
+        self.assertEqual(qs.query.deferred_loading[0], set())
+        # explicit only() and defer() calls are respected
+        qs = _select_related(SalesHistory.objects.defer('price'),
+                             ['bookstore__city__region', 'sale_qty'])
+        self.assertEqual(qs.query.deferred_loading,
+                         (set(['price']), True))
+
+
+class RawCursorTests(TestCase):
+
+    def raw(self, sql, **kwargs):
+        return SalesHistory.objects.raw(sql, **kwargs)
+
+    def test_rows_are_read_from_the_cursor(self):
+        series = [{
+            'options': {'source': self.raw(
+                "SELECT id, sale_date, price, sale_qty * 2 AS double_qty "
+                "FROM demoproject_saleshistory ORDER BY id")},
+            'terms': ['sale_date', 'price', 'double_qty']
+        }]
+        expected = [{'sale_date': sh.sale_date, 'price': sh.price,
+                     'double_qty': sh.sale_qty * 2}
+                    for sh in SalesHistory.objects.order_by('id')]
+        with self.assertNumQueries(1):
+            ds = DataPool(series=series)
+        # converted like the values of model instances
+        self.assertEqual(ds.series['price']['_data'], expected)
+        ds = DataPool(series=series, columnar=True)
+        data = ds.series['price']['_data']
+        for field in ('sale_date', 'price', 'double_qty'):
+            self.assertEqual(list(data[field]),
+                             [row[field] for row in expected])
+        ds = DataPool(series=series, chunk_size=100)
+        self.assertEqual(list(ds.series['price']['_data']), expected)
+
+    def test_translations(self):
+        series = [{
+            'options': {'source': self.raw(
+                "SELECT id, sale_qty AS qty FROM demoproject_saleshistory",
+                translations={'qty': 'sale_qty'})},
+            'terms': ['sale_qty']
+        }]
+        ds = DataPool(series=series)
+        self.assertEqual(sorted(row['sale_qty'] for row
+                                in ds.series['sale_qty']['_data']),
+                         sorted(SalesHistory.objects.values_list(
+                             'sale_qty', flat=True)))
+
+    def test_model_instances_for_other_terms(self):
+        series = [{
+            'options': {'source': self.raw(
+                "SELECT * FROM demoproject_saleshistory LIMIT 5")},
+            'terms': ['bookstore__city__region', 'book', 'sale_qty']
+        }]
+        ds = DataPool(series=series)
+        for obj in ds.series['sale_qty']['_data']:
+            self.assertIsInstance(obj, SalesHistory)
+        # a deferred field isn't a column of the query
+        series = [{
+            'options': {'source': self.raw(
+                "SELECT id, sale_date FROM demoproject_saleshistory "
+                "LIMIT 5")},
+            'terms': ['sale_date', 'sale_qty']
+        }]
+        ds = DataPool(series=series)
+        for obj in ds.series['sale_qty']['_data']:
+            self.assertIsInstance(obj, SalesHistory)
+
+
+class TopNPerCatTests(TestCase):
+
+    def setUp(self):
+        self.series = [{
+            'options': {
+                'source': SalesHistory.objects.all(),
+                'categories': ['bookstore__city__state'],
+                'legend_by': ['book__title'],
+                'top_n_per_cat': 2},
+            'terms': OrderedDict([('qty', Sum('sale_qty')),
+                                  ('sales', Count('id'))])
+        }]
+
+    def expected(self, field, func, n):
+        rows = (SalesHistory.objects
+                .values('bookstore__city__state', 'book__title')
+                .annotate(value=func(field)))
+        by_cv = defaultdict(dict)
+        for row in rows:
+            by_cv[(row['bookstore__city__state'],)][
+                (row['book__title'],)] = row['value']
+        for lv_dfv in by_cv.values():
+            # all ties of the top n values are kept
+            top = sorted(set(lv_dfv.values()), reverse=True)[:n]
+            for lv in list(lv_dfv):
+                if lv_dfv[lv] not in top:
+                    del lv_dfv[lv]
+        return by_cv
+
+    def assertTopN(self, ds):
+        self.assertEqual(dict(ds.series['qty']['_cv_lv_dfv']),
+                         self.expected('sale_qty', Sum, 2))
+        self.assertEqual(dict(ds.series['sales']['_cv_lv_dfv']),
+                         self.expected('id', Count, 2))
+
+    def test_every_term_of_a_query_keeps_its_top_n(self):
+        self.assertTopN(PivotDataPool(series=self.series))
+
+    @skipUnless(chartdata._supports_window_functions('default'),
+                'the database does not support window functions')
+    def test_window_functions(self):
+        with CaptureQueriesContext(connection) as queries:
+            ds = PivotDataPool(series=self.series)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('DENSE_RANK', queries[0]['sql'])
+        self.assertTopN(ds)
+
+    @skipUnless(chartdata._supports_window_functions('default'),
+                'the database does not support window functions')
+    def test_window_function_columns(self):
+        # both categories are columns called "name" of the inner query
+        ds = PivotDataPool(series=[{
+            'options': {
+                'source': SalesHistory.objects.all(),
+                'categories': ['bookstore__city__state', 'bookstore__name'],
+                'legend_by': ['book__genre__name'],
+                'top_n_per_cat': -1},
+            'terms': OrderedDict([('qty', Sum('sale_qty')),
+                                  ('price', Avg('price'))])
+        }], lazy=True)
+        (tk_td_tuples, vqs), = ds._generate_vqs()
+        sql, _, _, names = chartdata._top_n_per_cat_sql(tk_td_tuples, vqs)
+        ranked = list(vqs)
+        # the same columns, in the same order, as values()
+        self.assertEqual(names, list(ranked[0]))
+        self.assertTrue(sql.endswith('ORDER BY %d, %d, %d ASC' % (
+            names.index('bookstore__city__state') + 1,
+            names.index('bookstore__name') + 1, names.index('qty') + 1)))
+        ranks = [n for n in names if n.startswith(chartdata._RANK_PREFIX)]
+        expected = [dict((n, v) for (n, v) in row.items() if n not in ranks)
+                    for row in ranked if any(row[r] <= 1 for r in ranks)]
+        rows = chartdata._fetch_top_n_per_cat(tk_td_tuples, vqs)
+        self.assertEqual(sorted(rows, key=repr), sorted(expected, key=repr))
+
+        def key(row):
+            return (row['bookstore__city__state'], row['bookstore__name'],
+                    row['qty'])
+        self.assertEqual([key(row) for row in rows],
+                         sorted(key(row) for row in expected))
+
+
+class TopNTests(TestCase):
+
+    def pool(self, top_n, **options):
+        options.update({'source': SalesHistory.objects.all(),
+                        'categories': ['bookstore__name'],
+                        'legend_by': ['book__genre__name']})
+        return PivotDataPool(series=[{
+            'options': options,
+            'terms': {'qty': Sum('sale_qty')}
+        }], top_n_term='qty', top_n=top_n)
+
+    def expected(self, top_n):
+        totals = defaultdict(list)
+        for row in (SalesHistory.objects
+                    .values('bookstore__name', 'book__genre__name')
+                    .annotate(qty=Sum('sale_qty'))):
+            totals[(row['bookstore__name'],)].append(row['qty'])
+        totals = sorted(((cv, sum(qtys)) for (cv, qtys) in totals.items()),
+                        key=itemgetter(1), reverse=top_n > 0)
+        return set(cv for (cv, _) in totals[:abs(top_n)])
+
+    def test_only_top_n_categories_are_pivoted(self):
+        with CaptureQueriesContext(connection) as queries:
+            ds = self.pool(3)
+        self.assertEqual(len(queries), 2)
+        self.assertIn('SUM(', queries[0]['sql'])
+        self.assertNotIn('DISTINCT', queries[0]['sql'])
+        self.assertTrue(queries[0]['sql'].endswith('LIMIT 3'))
+        self.assertEqual(set(ds.cv), self.expected(3))
+        self.assertEqual(set(ds.series['qty']['_cv_lv_dfv']),
+                         self.expected(3))
+
+    def test_bottom_n(self):
+        ds = self.pool(-2)
+        self.assertEqual(set(ds.cv), self.expected(-2))
+
+    def test_top_n_per_cat_is_pivoted_in_python(self):
+        with self.assertNumQueries(1):
+            ds = self.pool(3, top_n_per_cat=1)
+        self.assertEqual(len(ds.cv), 3)
+
+    def test_duplicate_values_in_a_category(self):
+        # the same number of sales of a book in several bookstores
+        counts = defaultdict(list)
+        for row in (SalesHistory.objects
+                    .values('book__title', 'bookstore__name')
+                    .annotate(sales=Count('id'))):
+            counts[(row['book__title'],)].append(row['sales'])
+        self.assertTrue(any(len(set(c)) < len(c) for c in counts.values()))
+        sums = dict((cv, sum(c)) for (cv, c) in counts.items())
+        totals = sorted(sums, key=sums.get)
+        for top_n in (1, 3, -3):
+            series = [{
+                'options': {'source': SalesHistory.objects.all(),
+                            'categories': ['book__title'],
+                            'legend_by': ['bookstore__name']},
+                'terms': {'sales': Count('id')}
+            }]
+            expected = totals[:-top_n] if top_n < 0 else totals[-top_n:]
+            ds = PivotDataPool(series=series, top_n_term='sales',
+                               top_n=top_n)
+            # categories with the same total may be kept instead of others
+            expected = sorted(sums[cv] for cv in expected)
+            self.assertEqual(sorted(sums[cv] for cv in ds.cv), expected)
+            # the categories selected in Python, from all rows in any order
+            ds = PivotDataPool(series=series, top_n_term='sales',
+                               top_n=top_n, lazy=True)
+            ((tk_td_tuples, vqs),) = ds._generate_vqs()
+            rows = list(vqs)
+            for reverse in (False, True):
+                rows.sort(key=itemgetter('book__title', 'bookstore__name'),
+                          reverse=reverse)
+                ds._set_data([(tk_td_tuples, rows)])
+                self.assertEqual(sorted(sums[cv] for cv in ds.cv), expected)
+
+
+class PivotEngineTests(TestCase):
+
+    def test_terms_share_category_and_legend_values(self):
+        ds = PivotDataPool(series=[{
+            'options': {
+                'source': SalesHistory.objects.all(),
+                'categories': ['bookstore__city__state'],
+                'legend_by': ['book__genre__name']},
+            'terms': {'qty': Sum('sale_qty'), 'sales': Count('id')}
+        }])
+        qty, sales = ds.series['qty'], ds.series['sales']
+        self.assertEqual(set(qty['_cv_lv_dfv']), set(sales['_cv_lv_dfv']))
+        self.assertEqual(qty['_lv_set'], sales['_lv_set'])
+        lvs = dict((lv, lv) for lv in qty['_lv_set'])
+        for lv in sales['_lv_set']:
+            self.assertIs(lvs[lv], lv)
+        cvs = dict((cv, cv) for cv in qty['_cv_lv_dfv'])
+        for cv in ds.cv_raw:
+            self.assertIs(cvs[cv], cv)
+
+    @skipUnless(matrix.numpy is None, 'NumPy is installed')
+    def test_dense_requires_numpy(self):
+        self.assertRaises(APIInputError, PivotDataPool, series=[{
+            'options': {'source': SalesHistory.objects.all(),
+                        'categories': ['bookstore__city__state']},
+            'terms': {'qty': Sum('sale_qty')}
+        }], dense=True)
+
+
+@skipIf(matrix.numpy is None, 'NumPy is not installed')
+class DensePivotTests(TestCase):
+
+    def charts(self, series):
+        charts = []
+        for dense in (False, True):
+            ds = PivotDataPool(series=series, dense=dense)
+            charts.append(PivotChart(datasource=ds, series_options=[{
+                'options': {'type': 'column'},
+                'terms': list(ds.series)}]))
+        return charts
+
+    def test_same_chart_as_dicts(self):
+        chart, dense_chart = self.charts([{
+            'options': {
+                'source': SalesHistory.objects.all(),
+                'categories': ['bookstore__city__state'],
+                'legend_by': ['book__genre__name']},
+            'terms': {'qty': Sum('sale_qty'), 'avg_qty': Avg('sale_qty'),
+                      'price': Sum('price'), 'last_sale': Max('sale_date')}
+        }])
+        ds = dense_chart.datasource
+        for td in ds.series.values():
+            self.assertIsInstance(td['_matrix'], matrix.PivotMatrix)
+        self.assertEqual(chart.hcoptions, dense_chart.hcoptions)
+        # the values are python objects of the same types
+        for series, dense_series in zip(chart.hcoptions['series'],
+                                        dense_chart.hcoptions['series']):
+            self.assertEqual([type(v) for v in series['data']],
+                             [type(v) for v in dense_series['data']])
+
+    def test_sparse_data_stays_in_dicts(self):
+        chart, dense_chart = self.charts([{
+            'options': {
+                'source': SalesHistory.objects.all(),
+                'categories': ['sale_date'],
+                'legend_by': ['book__title', 'bookstore__name']},
+            'terms': {'qty': Sum('sale_qty')}
+        }])
+        self.assertIsNone(dense_chart.datasource.series['qty']['_matrix'])
+        self.assertEqual(chart.hcoptions, dense_chart.hcoptions)
+
+
+class RollupTests(TestCase):
+
+    def pivot(self, rollup=True, **options):
+        options.setdefault('categories', ['bookstore__city__state',
+                                          'bookstore__city__city'])
+        options['source'] = SalesHistory.objects.all()
+        options['rollup'] = rollup
+        return PivotDataPool(series=[{
+            'options': options,
+            'terms': {'qty': Sum('sale_qty'), 'price': Sum('price')}
+        }])
+
+    def test_subtotals(self):
+        with CaptureQueriesContext(connection) as queries:
+            ds = self.pivot()
+        # all levels are retrieved in a single query
+        self.assertEqual(len(queries), 1)
+        qty = ds.series['qty']['_cv_lv_dfv']
+        sales = SalesHistory.objects.all()
+        for state in sales.values_list('bookstore__city__state',
+                                       flat=True).distinct():
+            expected = sales.filter(bookstore__city__state=state) \
+                            .aggregate(Sum('sale_qty'))['sale_qty__sum']
+            self.assertEqual(qty[(state, u'Total')][()], expected)
+        self.assertEqual(qty[(u'Total', u'Total')][()],
+                         sales.aggregate(Sum('sale_qty'))['sale_qty__sum'])
+        # the rows grouped by all categories are there too
+        without = self.pivot(rollup=False).series['price']['_cv_lv_dfv']
+        for cv, lv_dfv in without.items():
+            self.assertEqual(ds.series['price']['_cv_lv_dfv'][cv], lv_dfv)
+        self.assertEqual(len(ds.cv), len(without) +
+                         len(set(cv[0] for cv in without)) + 1)
+
+    def test_label_and_legend_by(self):
+        ds = self.pivot(rollup='All', categories=['bookstore__city__state'],
+                        legend_by=['book__genre__name'])
+        qty = ds.series['qty']['_cv_lv_dfv']
+        sales = SalesHistory.objects.all()
+        for genre, total in sales.values_list('book__genre__name') \
+                                 .annotate(Sum('sale_qty')):
+            self.assertEqual(qty[(u'All',)][(genre,)], total)
+        self.assertIn((u'All',), ds.cv)
+
+    def test_subtotals_by_legend(self):
+        with CaptureQueriesContext(connection) as queries:
+            ds = self.pivot(legend_by=['book__genre__name'])
+        if chartdata._supports_rollup('default'):
+            self.assertIn('ROLLUP', queries[-1]['sql'])
+            self.assertNotIn('UNION', queries[-1]['sql'])
+        else:
+            self.assertIn('UNION ALL', queries[-1]['sql'])
+        qty = ds.series['qty']['_cv_lv_dfv']
+        sales = SalesHistory.objects.all()
+        for state, genre, total in sales.values_list(
+                'bookstore__city__state', 'book__genre__name') \
+                .annotate(Sum('sale_qty')):
+            self.assertEqual(qty[(state, u'Total')][(genre,)], total)
+        for genre, total in sales.values_list('book__genre__name') \
+                                 .annotate(Sum('sale_qty')):
+            self.assertEqual(qty[(u'Total', u'Total')][(genre,)], total)
+        # no rows with the legend_by rolled up
+        self.assertEqual(
+            set(lv for lv_dfv in qty.values() for lv in lv_dfv),
+            set((genre,) for genre in
+                sales.values_list('book__genre__name', flat=True)))
+
+    def test_top_n_per_cat(self):
+        ds = self.pivot(categories=['bookstore__city__state'],
+                        legend_by=['book__title'], top_n_per_cat=2)
+        for cv, lv_dfv in ds.series['qty']['_cv_lv_dfv'].items():
+            self.assertLessEqual(len(set(lv_dfv.values())), 2)
+        self.assertIn((u'Total',), ds.cv)
+
+    def test_bad_rollup(self):
+        self.assertRaises(APIInputError, self.pivot, rollup=1)
+        self.assertRaises(APIInputError, PivotDataPool, series=[{
+            'options': {'source': SalesHistory.objects.all(),
+                        'categories': ['bookstore__city__state'],
+                        'rollup': True},
+            'terms': {'qty': Sum('sale_qty')}
+        }], top_n_term='qty', top_n=2)
+
+
+class ParetoTests(TestCase):
+
+    def pivot(self, **kwargs):
+        return PivotDataPool(series=[{
+            'options': {'source': SalesHistory.objects.all(),
+                        'categories': ['bookstore__name']},
+            'terms': {'qty': Sum('sale_qty'), 'price': Avg('price')}
+        }], pareto_term='qty', **kwargs)
+
+    def totals(self):
+        return dict(SalesHistory.objects.values_list('bookstore__name')
+                    .annotate(Sum('sale_qty')))
+
+    def test_pareto_order_and_cumulative_percentages(self):
+        ds = self.pivot()
+        totals = self.totals()
+        expected = sorted(totals, key=totals.get, reverse=True)
+        self.assertEqual([cv[0] for cv in ds.cv_raw], expected)
+        cum = 0
+        for name, pct in zip(expected, ds.pareto_cum_pct):
+            cum += totals[name]
+            self.assertAlmostEqual(pct, 100.0 * cum / sum(totals.values()))
+        self.assertAlmostEqual(ds.pareto_cum_pct[-1], 100)
+
+    def test_pareto_of_top_n(self):
+        ds = self.pivot(top_n_term='price', top_n=3)
+        prices = dict(SalesHistory.objects.values_list('bookstore__name')
+                      .annotate(Avg('price')))
+        top_3 = set(sorted(prices, key=prices.get, reverse=True)[:3])
+        totals = self.totals()
+        self.assertEqual([cv[0] for cv in ds.cv_raw],
+                         sorted(top_3, key=totals.get, reverse=True))
+        self.assertEqual(len(ds.pareto_cum_pct), 3)
+
+    def test_pareto_line(self):
+        ds = self.pivot()
+        chart = PivotChart(
+            datasource=ds,
+            series_options=[{'options': {'type': 'column'},
+                             'terms': ['qty']}],
+            chart_options={'yAxis': {'title': {'text': 'Quantity'}}},
+            pareto_line={'color': 'red'})
+        y_axes = chart.hcoptions['yAxis']
+        self.assertEqual(len(y_axes), 2)
+        self.assertEqual(y_axes[0]['title']['text'], 'Quantity')
+        self.assertTrue(y_axes[1]['opposite'])
+        line = chart.hcoptions['series'][-1]
+        self.assertEqual(line['type'], 'line')
+        self.assertEqual(line['color'], 'red')
+        self.assertEqual(line['yAxis'], 1)
+        self.assertEqual(line['data'], ds.pareto_cum_pct)
+        self.assertEqual(len(line['data']),
+                         len(chart.hcoptions['xAxis']['categories']))
+
+    def test_pareto_line_requires_pareto_term(self):
+        ds = PivotDataPool(series=[{
+            'options': {'source': SalesHistory.objects.all(),
+                        'categories': ['bookstore__name']},
+            'terms': {'qty': Sum('sale_qty')}
+        }])
+        self.assertIsNone(ds.pareto_cum_pct)
+        series_options = [{'options': {'type': 'column'}, 'terms': ['qty']}]
+        self.assertRaises(APIInputError, PivotChart, datasource=ds,
+                          series_options=series_options, pareto_line=True)
+        self.assertRaises(APIInputError, PivotChart, datasource=self.pivot(),
+                          series_options=series_options, pareto_line='red')
+
+
+class SeriesOptionsTests(TestCase):
+
+    def test_base_is_shared_until_modified(self):
+        base = {'type': 'line', 'marker': {'enabled': False},
+                'zones': [{'value': 10}]}
+        first = SeriesOptions(base, {'name': 'first', 'data': [1, 2]})
+        second = SeriesOptions(base, {'name': 'second', 'data': [3]})
+        self.assertIs(dict.__getitem__(first, 'marker'), base['marker'])
+        first['marker']['enabled'] = True
+        first['zones'].append({'value': 20})
+        self.assertEqual(base, {'type': 'line', 'marker': {'enabled': False},
+                                'zones': [{'value': 10}]})
+        self.assertEqual(second['marker'], {'enabled': False})
+        self.assertEqual(json.loads(json.dumps(first)),
+                         {'type': 'line', 'marker': {'enabled': True},
+                          'zones': [{'value': 10}, {'value': 20}],
+                          'name': 'first', 'data': [1, 2]})
+        # missing options are created like in RecursiveDefaultDict
+        second['tooltip']['valueSuffix'] = '%'
+        self.assertNotIn('tooltip', base)
+
+    def test_pickle(self):
+        base = {'marker': {'enabled': False}}
+        series = pickle.loads(pickle.dumps(SeriesOptions(base, {'data': [1]})))
+        self.assertIsInstance(series, SeriesOptions)
+        self.assertEqual(series, {'marker': {'enabled': False}, 'data': [1]})
+        series['marker']['enabled'] = True
+        self.assertFalse(base['marker']['enabled'])
+
+    def test_series_options_are_not_modified(self):
+        ds = PivotDataPool(series=[{
+            'options': {'source': SalesHistory.objects.all(),
+                        'categories': ['bookstore__city__state'],
+                        'legend_by': ['book__genre__name']},
+            'terms': {'qty': Sum('sale_qty')}
+        }])
+        options = {'type': 'column', 'marker': {'enabled': False}}
+        chart = PivotChart(datasource=ds, series_options=[{
+            'options': options, 'terms': ['qty']}])
+        for series in chart.hcoptions['series']:
+            self.assertIsInstance(series, SeriesOptions)
+            self.assertEqual(series['type'], 'column')
+        chart.hcoptions['series'][0]['marker']['enabled'] = True
+        self.assertEqual(options['marker'], {'enabled': False})
+        self.assertEqual(chart.hcoptions['series'][1]['marker'],
+                         {'enabled': False})
+
+
+class RecursiveDefaultDictTests(TestCase):
+
+    def test_missing_options_are_created(self):
+        options = RecursiveDefaultDict({'chart': {'type': 'line'}})
+        options['title']['text'] = 'Sales'
+        self.assertEqual(options, {'chart': {'type': 'line'},
+                                   'title': {'text': 'Sales'}})
+        self.assertIsInstance(options['chart'], RecursiveDefaultDict)
+
+    def test_assigned_dicts_are_converted(self):
+        chart = {'type': 'line'}
+        axes = [{'title': {'text': 'x'}}]
+        options = RecursiveDefaultDict({'chart': chart})
+        options['xAxis'] = axes
+        options['chart']['renderTo'] = 'container'
+        options['xAxis'][0]['title']['text'] = 'y'
+        options['xAxis'][0]['opposite']['value'] = True
+        self.assertEqual(chart, {'type': 'line'})
+        self.assertEqual(axes, [{'title': {'text': 'x'}}])
+        self.assertIsInstance(options['xAxis'][0], RecursiveDefaultDict)
+
+    def test_data_is_stored_as_is(self):
+        data = [{'x': 1, 'y': 2}, {'x': 2, 'y': 3}]
+        categories = ['a', 'b']
+        options = RecursiveDefaultDict()
+        options['data'] = data
+        options['xAxis'] = {'categories': categories}
+        self.assertIs(options['data'], data)
+        self.assertIs(options['xAxis']['categories'], categories)
+        self.assertNotIsInstance(options['data'][0], RecursiveDefaultDict)
+
+    def test_pickle(self):
+        options = RecursiveDefaultDict({'chart': {'type': 'line'},
+                                        'series': [{'data': [1, 2]}]})
+        loaded = pickle.loads(pickle.dumps(options))
+        self.assertEqual(loaded, options)
+        loaded['title']['text'] = 'Sales'
+        self.assertIsInstance(loaded['series'][0], RecursiveDefaultDict)
+
+
+class XAlignmentTests(TestCase):
+
+    def test_align_x_y_values(self):
+        aligned = charts._align_x_y_values([
+            (2, [(1, [10, 11]), (2, [20, 21])]),
+            (1, iter([(3, (32,)), (2, (22,)), (3, (33,))])),
+            (1, []),
+        ])
+        self.assertEqual(list(aligned.items()),
+                         [(1, [10, 11, None, None]),
+                          (2, [20, 21, 22, None]),
+                          (3, [None, None, 33, None])])
+
+    def test_partially_overlapping_sources(self):
+        ds = DataPool(series=[
+            {'options': {'source': MonthlyWeatherByCity.objects.filter(
+                month__lte=8)},
+             'terms': ['month', 'boston_temp', 'houston_temp']},
+            {'options': {'source': MonthlyWeatherSeattle.objects.filter(
+                month__gte=5)},
+             'terms': [{'month_seattle': 'month'}, 'seattle_temp']}])
+        chart = Chart(datasource=ds, series_options=[
+            {'options': {'type': 'line'},
+             'terms': {'month': ['boston_temp', 'houston_temp'],
+                       'month_seattle': ['seattle_temp']}}])
+        months = chart.hcoptions['xAxis'][0]['categories']
+        self.assertEqual(months, sorted(set(
+            list(MonthlyWeatherByCity.objects.filter(month__lte=8)
+                 .values_list('month', flat=True)) +
+            list(MonthlyWeatherSeattle.objects.filter(month__gte=5)
+                 .values_list('month', flat=True)))))
+        boston = dict(MonthlyWeatherByCity.objects.values_list(
+            'month', 'boston_temp'))
+        seattle = dict(MonthlyWeatherSeattle.objects.values_list(
+            'month', 'seattle_temp'))
+        series = dict((s['name'], s['data'])
+                      for s in chart.hcoptions['series'])
+        self.assertEqual(series['boston temp'],
+                         [boston.get(m) if m <= 8 else None for m in months])
+        self.assertEqual(series['seattle temp'],
+                         [seattle.get(m) if m >= 5 else None for m in months])
+
+
+class DatetimeAxisTests(TestCase):
+
+    def plot(self, x_values, x_axis=None):
+        x_axis = RecursiveDefaultDict(x_axis)
+        series = [SeriesOptions({'type': 'line'})]
+        charts._plot_points(x_axis, series,
+                            [(x, [i]) for (i, x) in enumerate(x_values)])
+        return x_axis, series[0]
+
+    def test_regular_dates(self):
+        x_axis, series = self.plot([date(2017, 1, 1), date(2017, 1, 2),
+                                    date(2017, 1, 3)])
+        self.assertEqual(x_axis, {'type': 'datetime'})
+        self.assertEqual(series['pointStart'], 1483228800000)
+        self.assertEqual(series['pointInterval'], 24 * 3600 * 1000)
+        self.assertEqual(series['data'], [0, 1, 2])
+
+    def test_months_and_years(self):
+        # pointIntervalUnit isn't supported by the bundled Highcharts
+        months = [date(2017, m, 1) for m in (1, 2, 3)]
+        _, series = self.plot(months)
+        self.assertNotIn('pointIntervalUnit', series)
+        self.assertNotIn('pointStart', series)
+        self.assertEqual(series['data'], [[1483228800000, 0],
+                                          [1485907200000, 1],
+                                          [1488326400000, 2]])
+        _, series = self.plot([date(y, 7, 1) for y in (2015, 2016, 2017)])
+        self.assertNotIn('pointStart', series)
+        self.assertEqual([x for (x, _) in series['data']],
+                         [1435708800000, 1467331200000, 1498867200000])
+
+    def test_irregular_datetimes(self):
+        eastern = pytz.timezone('US/Eastern')
+        x_axis, series = self.plot([
+            eastern.localize(datetime(2017, 1, 1, 19)),
+            datetime(2017, 1, 2, 0, 30),
+            datetime(2017, 1, 5)])
+        self.assertNotIn('pointStart', series)
+        self.assertEqual(series['data'], [[1483315200000, 0],
+                                          [1483317000000, 1],
+                                          [1483574400000, 2]])
+
+    def test_axis_type(self):
+        x_values = [date(2017, 1, 1), date(2017, 1, 2)]
+        x_axis, series = self.plot(x_values, {'type': 'category'})
+        self.assertEqual(x_axis['categories'], x_values)
+        self.assertEqual(series['data'], [0, 1])
+        x_axis, series = self.plot([1000, 3000, 4000], {'type': 'datetime'})
+        self.assertEqual(series['data'], [[1000, 0], [3000, 1], [4000, 2]])
+        x_axis, series = self.plot([1, 2])
+        self.assertEqual(x_axis['categories'], [1, 2])
+
+    def test_chart(self):
+        totals = defaultdict(int)
+        for sale in SalesHistory.objects.all():
+            totals[sale.sale_date] += sale.sale_qty
+        cht = Chart(
+            datasource=DataPool(series=[{
+                'options': {'source': SalesHistory.objects.all(),
+                            'group_by': 'sale_date'},
+                'terms': ['sale_date', {'total_qty': Sum('sale_qty')}]}]),
+            series_options=[{
+                'options': {'type': 'column'},
+                'terms': {'sale_date': ['total_qty']}}])
+        self.assertEqual(cht.hcoptions['xAxis'][0]['type'], 'datetime')
+        self.assertNotIn('categories', cht.hcoptions['xAxis'][0])
+        epoch = date(1970, 1, 1)
+        self.assertEqual(
+            cht.hcoptions['series'][0]['data'],
+            [[(d - epoch).days * 24 * 3600 * 1000, totals[d]]
+             for d in sorted(totals)])
+
+
+class SerializationTests(TestCase):
+
+    def chart(self):
+        ds = DataPool(series=[{
+            'options': {'source': MonthlyWeatherByCity.objects.all()},
+            'terms': ['month', 'boston_temp', 'houston_temp']}])
+        return Chart(datasource=ds, series_options=[{
+            'options': {'type': 'line'},
+            'terms': {'month': ['boston_temp', 'houston_temp']}}])
+
+    def test_to_native(self):
+        column = [1, 2.5, None, u'a']
+        native = serialization.to_native({
+            'data': column,
+            'decimals': [Decimal('1.5'), None],
+            'points': ((date(2017, 1, 2), Decimal('2')),),
+            1: array('d', [1.0]),
+            'time': datetime(2017, 1, 2, 3, 4, 5)})
+        self.assertIs(native['data'], column)
+        self.assertEqual(native, {
+            'data': column,
+            'decimals': [1.5, None],
+            'points': [['2017-01-02', 2.0]],
+            '1': [1.0],
+            'time': '2017-01-02T03:04:05'})
+
+    def test_backends(self):
+        chart = self.chart()
+        expected = json.loads(json.dumps(
+            chart.hcoptions, default=chartit.json_serializer))
+        backends = ['json'] + [name for name in ('orjson', 'ujson')
+                               if getattr(serialization, name) is not None]
+        for backend in backends:
+            with override_settings(CHARTIT_JSON_BACKEND=backend):
+                self.assertEqual(serialization.backend(), backend)
+                self.assertEqual(json.loads(chart.to_json()), expected)
+
+    def test_bad_backend(self):
+        with override_settings(CHARTIT_JSON_BACKEND='marshal'):
+            self.assertRaises(ValueError, serialization.dumps, {})
+
+    def test_to_json_with_decimals(self):
+        data = json.loads(self.chart().to_json())
+        boston = [float(t) for t in MonthlyWeatherByCity.objects.order_by(
+            'month').values_list('boston_temp', flat=True)]
+        series = dict((s['name'], s['data']) for s in data['series'])
+        self.assertEqual(series['boston temp'], boston)
+
+    def test_load_charts(self):
+        html = chartit.load_charts(self.chart(), 'weather')
+        hco_array = html.split('var _chartit_hco_array = ')[1] \
+                        .split(';\n</script>')[0]
+        self.assertEqual(json.loads(hco_array)[0]['chart']['renderTo'],
+                         'weather')
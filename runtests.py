@@ -8,7 +8,8 @@ try:
     from django.conf import settings
     from django.core.management import call_command
 
-    settings.DATABASES['default']['NAME'] = ':memory:'
+    if settings.DATABASES['default']['ENGINE'].endswith('sqlite3'):
+        settings.DATABASES['default']['NAME'] = ':memory:'
 
     try:
         import django